@@ -0,0 +1,1088 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Adding nodes, changing settings and rendering configurations, used by the
+# vwgen commands and by callers that would otherwise run them and parse their
+# output, such as provisioning services. The functions work on the dictionaries
+# of common.Config, the Network class wraps them for a whole network
+#
+#     network = Network.load('wg-meshvpn')
+#     network.add_nodes(['node4'])
+#     network.save()
+#     wg_quick_conf = network.render_wg_quick('node4')
+#     network.close()
+
+import binascii
+import concurrent.futures
+import encodings.idna
+import errno
+import ipaddress
+import os
+import random
+import sys
+import time
+from typing import Any, cast, Dict, Iterator, List, Mapping, NamedTuple, Optional, Set, Tuple, Union
+from . import common
+
+
+class KeyCriteria(NamedTuple):
+    used_macs: Set[int]
+    used_hosts: Set[int]
+    # Host part of the IPv6 address pool, 0 without a pool
+    hostmask: int
+    # Whether the derived IPv6 address must be unique, which it need not be
+    # without a pool or when addresses are allocated statically
+    unique_hosts: bool
+    # Required leading bits of the derived MAC and IPv6 address, as value and mask
+    mac_prefix: Tuple[int, int]
+    ipv6_prefix: Tuple[int, int]
+
+
+class SearchOptions(NamedTuple):
+    mac_prefix: Optional[str]
+    ipv6_prefix: Optional[ipaddress.IPv6Network]
+    workers: int
+    attempts: int
+    seconds: float
+
+
+# Keys checked by a worker per task, small enough to stop soon after a match
+SEARCH_BATCH_SIZE = 256
+
+
+def add_nodes(network_name: str, network: common.Config.NetworkType, nodes: common.Config.NodesType, node_names: List[str], options: Optional[SearchOptions] = None) -> int:
+    if options is None:
+        options = search_options()
+    return_value = 0
+
+    criteria = build_key_criteria(network, nodes, options)
+    ipv6_allocation = network.get('IPv6Allocation', 'pubkey')
+    ipv6_allocator: Optional[common.IPv6Allocator] = None
+    if ipv6_allocation != 'pubkey' and 'AddressPoolIPv6' in network:
+        ipv6_allocator = common.IPv6Allocator.from_nodes(network, nodes)
+
+    for node_name in node_names:
+        if node_name in nodes:
+            print("vwgen: Network '{}' already has node '{}'".format(network_name, node_name), file=sys.stderr)
+            return_value = return_value or errno.EEXIST
+            continue
+
+        node: Dict[str, Any] = common.SortedDict()
+        if 'AddressPoolIPv4' in network:
+            ipv4 = generate_random_ipv4(network, nodes)
+            if ipv4 is None:
+                print('vwgen: IPv4 address pool is full', file=sys.stderr)
+                return_value = return_value or errno.ENOSPC
+                break
+            node['Address'] = [ipv4]
+        else:
+            node['Address'] = []
+
+        ipv4ll = generate_random_ipv4ll(nodes)
+        if ipv4ll is None:
+            print('vwgen: Link-layer address pool is full', file=sys.stderr)
+            return_value = return_value or errno.ENOSPC
+            break
+
+        node['AllowedIPs'] = [ipv4ll + '/32']
+        node['Endpoint'] = None
+        node['FwMark'] = 0
+        node['LinkLayerAddress'] = [ipv4ll + '/16']
+        node['ListenPort'] = random.randint(32768, 60999)
+        node['NAT'] = False
+        node['PersistentKeepalive'] = common.PERSISTENT_KEEPALIVE_AUTO
+        secret, attempts, seconds = search_key(criteria, options)
+        if secret is None:
+            print("vwgen: No acceptable key for node '{}' after {} attempts in {:.1f}s, {:.0f} keys/s".format(node_name, attempts, seconds, attempts / max(seconds, 1e-6)), file=sys.stderr)
+            return_value = return_value or errno.ETIMEDOUT
+            continue
+        if options.mac_prefix is not None or options.ipv6_prefix is not None or attempts > 1:
+            print("vwgen: Found key for node '{}' after {} attempts in {:.1f}s, {:.0f} keys/s".format(node_name, attempts, seconds, attempts / max(seconds, 1e-6)), file=sys.stderr)
+        public_key = common.pubkey(secret)
+        criteria.used_macs.add(derived_mac(public_key))
+        if criteria.unique_hosts:
+            criteria.used_hosts.add(int.from_bytes(public_key[-16:], 'big') & criteria.hostmask)
+        node['PrivateKey'] = binascii.b2a_base64(secret, newline=False).decode('ascii')
+        if ipv6_allocator is not None:
+            ipv6 = ipv6_allocator.allocate(ipv6_allocation, node_name)
+            if ipv6 is None:
+                print('vwgen: IPv6 address pool is full', file=sys.stderr)
+                return_value = return_value or errno.ENOSPC
+                break
+            node['Address'].append(ipv6)
+        node['SaveConfig'] = False
+        node['UPnP'] = False
+
+        node['PreUp'] = []
+        node['PostUp'] = []
+        node['PreDown'] = []
+        node['PostDown'] = []
+
+        nodes[node_name] = node
+
+    return return_value
+
+
+def derived_mac(public_key: bytes) -> int:
+    # The same bits as common.generate_pubkey_macaddr
+    return int.from_bytes(public_key[-6:], 'big') & ~(0x01 << 40) | (0x02 << 40)
+
+
+def build_key_criteria(network: common.Config.NetworkType, nodes: common.Config.NodesType, options: SearchOptions) -> KeyCriteria:
+    hostmask = 0
+    if 'AddressPoolIPv6' in network:
+        hostmask = int(ipaddress.IPv6Network(network['AddressPoolIPv6'], strict=False).hostmask)
+    unique_hosts = hostmask != 0 and network.get('IPv6Allocation', 'pubkey') == 'pubkey'
+
+    used_macs: Set[int] = set()
+    used_hosts: Set[int] = set()
+    for node in nodes.values():
+        public_key = common.generate_pubkey(node)
+        if public_key is None:
+            continue
+        public_key_bytes = binascii.a2b_base64(public_key)
+        used_macs.add(derived_mac(public_key_bytes))
+        if unique_hosts:
+            used_hosts.add(int.from_bytes(public_key_bytes[-16:], 'big') & hostmask)
+
+    mac_prefix = (0, 0)
+    if options.mac_prefix is not None:
+        digits = options.mac_prefix.replace(':', '')
+        bits = len(digits) * 4
+        mac_prefix = (int(digits or '0', 16) << (48 - bits), ((1 << bits) - 1) << (48 - bits))
+
+    ipv6_prefix = (0, 0)
+    if options.ipv6_prefix is not None:
+        # Only the host part comes from the key, the rest is the address pool
+        ipv6_prefix = (int(options.ipv6_prefix.network_address) & hostmask, int(options.ipv6_prefix.netmask) & hostmask)
+
+    return KeyCriteria(used_macs, used_hosts, hostmask, unique_hosts, mac_prefix, ipv6_prefix)
+
+
+_criteria: Optional[KeyCriteria] = None
+
+
+def _init_search_worker(criteria: KeyCriteria) -> None:
+    global _criteria
+    _criteria = criteria
+
+
+def _search_batch(batch_size: int) -> Tuple[Optional[bytes], int]:
+    criteria = _criteria
+    assert criteria is not None
+    mac_value, mac_mask = criteria.mac_prefix
+    ipv6_value, ipv6_mask = criteria.ipv6_prefix
+    for attempt in range(1, batch_size + 1):
+        secret = common.genkey()
+        public_key = common.pubkey(secret)
+        mac = derived_mac(public_key)
+        host = int.from_bytes(public_key[-16:], 'big') & criteria.hostmask
+        if mac & mac_mask == mac_value and host & ipv6_mask == ipv6_value and mac not in criteria.used_macs and host not in criteria.used_hosts:
+            return secret, attempt
+    return None, batch_size
+
+
+def search_key(criteria: KeyCriteria, options: SearchOptions) -> Tuple[Optional[bytes], int, float]:
+    start_time = time.monotonic()
+    deadline = start_time + options.seconds
+    attempts = 0
+
+    if options.workers == 1:
+        _init_search_worker(criteria)
+        while True:
+            secret, batch_attempts = _search_batch(1)
+            attempts += batch_attempts
+            if secret is not None:
+                return secret, attempts, time.monotonic() - start_time
+            if (options.attempts and attempts >= options.attempts) or time.monotonic() >= deadline:
+                return None, attempts, time.monotonic() - start_time
+
+    secret = None
+    with concurrent.futures.ProcessPoolExecutor(options.workers, initializer=_init_search_worker, initargs=(criteria,)) as executor:
+        # Keep every worker busy with one queued batch while results are checked
+        pending = {executor.submit(_search_batch, SEARCH_BATCH_SIZE) for _ in range(options.workers * 2)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                batch_secret, batch_attempts = future.result()
+                attempts += batch_attempts
+                if batch_secret is not None and secret is None:
+                    secret = batch_secret
+            out_of_budget = (options.attempts and attempts >= options.attempts) or time.monotonic() >= deadline
+            if secret is not None or out_of_budget:
+                for future in pending:
+                    future.cancel()
+                break
+            pending |= {executor.submit(_search_batch, SEARCH_BATCH_SIZE) for _ in done}
+    # Scalar multiplications in the worker processes are not seen by their own counters
+    common.STATS.count('pubkey.scalarmult.workers', attempts)
+    return secret, attempts, time.monotonic() - start_time
+
+
+def generate_random_ipv4(network: common.Config.NetworkType, nodes: common.Config.NodesType) -> Optional[str]:
+    with common.STATS.timer('ipv4.allocate'):
+        return _generate_random_ipv4(network, nodes)
+
+
+def _generate_random_ipv4(network: common.Config.NetworkType, nodes: common.Config.NodesType) -> Optional[str]:
+
+    address_pool = ipaddress.IPv4Network(network['AddressPoolIPv4'], strict=False)
+
+    if address_pool.prefixlen < 31:
+        num_hosts = address_pool.num_addresses - 2
+    else:
+        num_hosts = address_pool.num_addresses
+
+    # Only IPv4 addresses inside the pool take up its hosts, nodes may also have IPv6 or other addresses
+    existing_addresses: Set[str] = set()
+    for node in nodes.values():
+        for address in node.get('Address', []):
+            try:
+                ip = ipaddress.ip_interface(address).ip
+            except ValueError:
+                continue
+            if ip.version == 4 and ip in address_pool:
+                existing_addresses.add(ip.compressed)
+
+    if len(existing_addresses) >= num_hosts:
+        return None
+
+    while True:
+
+        if address_pool.prefixlen >= 32:
+            host = 0
+        elif address_pool.prefixlen == 31:
+            host = random.randint(0, 1)
+        else:
+            host = random.randint(1, (0xffffffff >> address_pool.prefixlen) - 1)
+
+        ipv4 = ipaddress.IPv4Address(int(address_pool.network_address) | host).compressed
+        common.STATS.count('ipv4.probes')
+
+        if ipv4 not in existing_addresses:
+            break
+
+    return ipv4 + '/' + str(address_pool.prefixlen)
+
+
+def generate_random_ipv4ll(nodes: common.Config.NodesType) -> Optional[str]:
+
+    existing_addresses: Set[str] = set((str(j).split('/', 1)[0] for i in nodes.values() for j in i.get('LinkLayerAddress', [])))
+
+    if len(existing_addresses) >= 0xa9feff00 - 0xa9fe0100:
+        return None
+
+    while True:
+
+        ipv4ll = ipaddress.IPv4Address(random.randint(0xa9fe0100, 0xa9fefeff)).compressed
+
+        if ipv4ll not in existing_addresses:
+            break
+
+    return ipv4ll
+
+
+# Returns the options of 'vwgen add' with the defaults filled in
+def search_options(mac_prefix: Optional[str] = None, ipv6_prefix: Optional[str] = None, workers: int = 0, attempts: int = 0, seconds: float = 60.0) -> SearchOptions:
+    if mac_prefix is not None:
+        mac_prefix = mac_prefix.lower()
+        if not all(i in '0123456789abcdef:' for i in mac_prefix) or len(mac_prefix.replace(':', '')) > 12:
+            raise ValueError("'{}' is not a MAC address prefix".format(mac_prefix))
+    ipv6_network = ipaddress.IPv6Network(ipv6_prefix, strict=False) if ipv6_prefix is not None else None
+    if workers <= 0:
+        # Without constraints, the first key almost never collides
+        workers = os.cpu_count() or 1 if mac_prefix is not None or ipv6_network is not None else 1
+    return SearchOptions(mac_prefix, ipv6_network, workers, attempts, seconds)
+
+
+# Options of 'vwgen set' and the number of values each takes, network options
+# come before any 'node' directive or after it, node options only after it
+NETWORK_OPTIONS = {
+    'pool-ipv4': 1, 'pool-ipv6': 1, 'ipv6-allocation': 1, 'vxlan-id': 1, 'vxlan-mtu': 1, 'vxlan-port': 1,
+    'segment': 2, 'nosegment': 1, 'journal': 1, 'snapshots': 1,
+}
+NODE_OPTIONS = {
+    'addr': 1, 'allowed-ips': 1, 'segments': 1, 'segment-addr': 2, 'endpoint': 1, 'endpoints': 1, 'site': 1,
+    'fwmark': 1, 'll-addr': 1, 'listen-port': 1, 'underlay-mtu': 1, 'persistent-keepalive': 1, 'private-key': 1,
+    'save-config': 0, 'nosave-config': 0, 'nat': 0, 'nonat': 0, 'upnp': 0, 'noupnp': 0,
+}
+
+
+# Applies one network option of 'vwgen set', raises ValueError on invalid values
+def set_network_option(network: common.Config.NetworkType, nodes: common.Config.NodesType, option: str, values: List[str]) -> None:
+    if option == 'pool-ipv4':
+        network['AddressPoolIPv4'] = ipaddress.IPv4Network(values[0], strict=False).compressed
+
+    elif option == 'pool-ipv6':
+        network['AddressPoolIPv6'] = ipaddress.IPv6Network(values[0], strict=False).compressed
+
+    elif option == 'ipv6-allocation':
+        if values[0] not in common.IPV6_ALLOCATION_MODES:
+            raise ValueError("Invalid IPv6 allocation mode '{}', use one of {}".format(values[0], ', '.join(common.IPV6_ALLOCATION_MODES)))
+        network['IPv6Allocation'] = values[0]
+
+    elif option == 'vxlan-id':
+        network['VxlanID'] = int(values[0])
+
+    elif option == 'vxlan-mtu':
+        if values[0] == 'auto':
+            network.pop('VxlanMTU', None)
+        else:
+            network['VxlanMTU'] = int(values[0])
+
+    elif option == 'vxlan-port':
+        network['VxlanPort'] = int(values[0])
+
+    elif option == 'segment':
+        segment_name = values[0]
+        if not common.is_valid_segment_name(segment_name):
+            raise ValueError("Invalid segment name '{}', it is used as interface name".format(segment_name))
+        if 'Segments' not in network:
+            network['Segments'] = common.SortedDict()
+        if segment_name not in network['Segments']:
+            network['Segments'][segment_name] = common.SortedDict()
+        network['Segments'][segment_name]['VxlanID'] = int(values[1])
+
+    elif option == 'nosegment':
+        segment_name = values[0]
+        network.get('Segments', {}).pop(segment_name, None)
+        for i in nodes.values():
+            if segment_name in i.get('Segments', []):
+                i['Segments'].remove(segment_name)
+            i.get('SegmentAddress', {}).pop(segment_name, None)
+
+    elif option == 'journal':
+        if values[0] not in ('on', 'off'):
+            raise ValueError("Invalid journal mode '{}', use 'on' or 'off'".format(values[0]))
+        network['Journal'] = values[0] == 'on'
+
+    elif option == 'snapshots':
+        if values[0] not in ('on', 'off'):
+            raise ValueError("Invalid snapshots mode '{}', use 'on' or 'off'".format(values[0]))
+        network['Snapshots'] = values[0] == 'on'
+
+    else:
+        raise ValueError("Invalid directive '{}'".format(option))
+
+
+# Applies one node option of 'vwgen set', raises ValueError on invalid values
+def set_node_option(node: common.Config.NodeType, option: str, values: List[str]) -> None:
+    if option == 'addr':
+        node['Address'] = list(map(str.strip, values[0].split(',')))
+
+    elif option == 'allowed-ips':
+        node['AllowedIPs'] = list(map(str.strip, values[0].split(',')))
+
+    elif option == 'segments':
+        node['Segments'] = [i for i in map(str.strip, values[0].split(',')) if i]
+
+    elif option == 'segment-addr':
+        if 'SegmentAddress' not in node:
+            node['SegmentAddress'] = common.SortedDict()
+        node['SegmentAddress'][values[0]] = [i for i in map(str.strip, values[1].split(',')) if i]
+
+    elif option == 'endpoint':
+        if values[0]:
+            node['Endpoint'] = common.normalize_endpoint(values[0], node.get('ListenPort', 0))
+        else:
+            node['Endpoint'] = None
+
+    elif option == 'endpoints':
+        endpoints: List[str] = []
+        for tagged_endpoint in map(str.strip, values[0].split(',')):
+            if not tagged_endpoint:
+                continue
+            endpoint, tag = common.split_endpoint_tag(tagged_endpoint)
+            endpoint = common.normalize_endpoint(endpoint, node.get('ListenPort', 0))
+            endpoints.append(endpoint if tag is None else endpoint + '@' + tag)
+        node['Endpoints'] = endpoints
+
+    elif option == 'site':
+        node['Site'] = values[0] or None
+
+    elif option == 'fwmark':
+        if values[0] == 'off':
+            node['FwMark'] = 0
+        else:
+            node['FwMark'] = int(values[0], base=0)
+
+    elif option == 'll-addr':
+        node['LinkLayerAddress'] = list(map(str.strip, values[0].split(',')))
+        # Written by older versions instead of LinkLayerAddress
+        node.pop('LinkLayerAddr', None)
+
+    elif option == 'listen-port':
+        node['ListenPort'] = int(values[0])
+
+    elif option == 'underlay-mtu':
+        node['UnderlayMTU'] = int(values[0])
+
+    elif option == 'persistent-keepalive':
+        # Only sent toward peers that need them, see common.keepalive_interval
+        if values[0] == 'auto':
+            node['PersistentKeepalive'] = common.PERSISTENT_KEEPALIVE_AUTO
+        elif values[0] == 'off':
+            node['PersistentKeepalive'] = 0
+        else:
+            node['PersistentKeepalive'] = int(values[0])
+
+    elif option == 'private-key':
+        node['PrivateKey'] = values[0]
+
+    elif option in ('save-config', 'nosave-config'):
+        node['SaveConfig'] = option == 'save-config'
+
+    elif option in ('nat', 'nonat'):
+        node['NAT'] = option == 'nat'
+
+    elif option in ('upnp', 'noupnp'):
+        node['UPnP'] = option == 'upnp'
+
+    else:
+        raise ValueError("Invalid directive '{}'".format(option))
+
+
+# Gives static addresses from AddressPoolIPv6 to the given nodes, by default to
+# every node still using the address derived from its key, as 'vwgen set
+# assign-ipv6' does. Returns the new address of each node, None once the pool is full
+def assign_ipv6(network: common.Config.NetworkType, nodes: common.Config.NodesType, node_names: Optional[List[str]] = None) -> Dict[str, Optional[str]]:
+    allocations = common.allocate_node_ipv6(network, nodes, node_names)
+    for node_name, ipv6 in allocations.items():
+        if ipv6 is not None:
+            nodes[node_name]['Address'] = list(nodes[node_name].get('Address', [])) + [ipv6]
+    return allocations
+
+
+
+class Peer(NamedTuple):
+    name: str
+    public_key: Optional[str]
+    allowed_ips: List[str]
+    endpoint: Optional[str]
+    persistent_keepalive: int
+    link_layer_addresses: List[str]
+    blacklisted: bool
+    segments: List[str]
+
+
+class Segment(NamedTuple):
+    # None for the main segment, whose device is named after the interface
+    name: Optional[str]
+    vxlan_id: int
+    mtu: int
+    addresses: List[str]
+
+
+def render_wg_quick(network_name: str, network: common.Config.NetworkType, nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_name: str, batch: bool = False) -> str:
+    node = nodes[node_name]
+    lines: List[str] = []
+
+    lines.append('# Network {}, generated by VxWireguard-Generator'.format(network_name))
+
+    lines.append('')
+
+    lines.append('# Node {}'.format(node_name))
+
+    lines.append('[Interface]')
+
+    lines.append('ListenPort = {:d}'.format(node.get('ListenPort', 0)))
+
+    if 'PrivateKey' in node:
+        lines.append('PrivateKey = {}'.format(node['PrivateKey']))
+
+    if 'LinkLayerAddress' in node:
+        lines.append('Address = {}'.format(', '.join(node['LinkLayerAddress'])))
+
+    addresses = common.vtep_addresses(network, node)
+
+    segments = generate_segments(network, nodes, blacklist, node_name, addresses)
+
+    lines.append('MTU = {}'.format(wireguard_mtu(segments)))
+
+    lines.append('Table = off')
+
+    if node.get('FwMark', 0) != 0:
+        lines.append('FwMark = {:x}'.format(node['FwMark']))
+
+    if node.get('SaveConfig', False):
+        lines.append('SaveConfig = true')
+
+    for script in node.get('PreUp', []):
+        lines.append('PreUp = {}'.format(script))
+
+    peers = generate_peers(nodes, blacklist, node_name)
+
+    # Only checked on paths where an underlay MTU is known, since networks
+    # created with a VXLAN MTU of 1500 deliberately let full-sized frames be fragmented
+    for segment in segments:
+        safe_mtu = min((common.path_vxlan_mtu(node, nodes[peer.name]) for peer in peers if not peer.blacklisted and (segment.name is None or segment.name in peer.segments) and ('UnderlayMTU' in node or 'UnderlayMTU' in nodes[peer.name])), default=None)
+        if safe_mtu is not None and segment.mtu > safe_mtu:
+            print("vwgen: VXLAN MTU {} of {} is fragmented on some paths of node '{}', at most {} is safe".format(segment.mtu, "segment '{}'".format(segment.name) if segment.name else 'the network', node_name, safe_mtu), file=sys.stderr)
+
+    if not batch:
+
+        for segment in segments:
+            setup = common.vxlan_setup(network, node, segment.name or 'v%i', segment.vxlan_id, segment.mtu, segment.addresses)
+
+            lines.append('PreUp = ip {} || true'.format(setup.link))
+
+            for command in setup.tuning:
+                lines.append('PreUp = {}'.format(command))
+
+            for command in setup.addresses:
+                lines.append('PreUp = ip {} || true'.format(command))
+
+    else:
+
+        lines.append('PreUp = ip -force -batch /etc/wireguard/%i.ip.batch || true')
+
+        for segment in segments:
+            for command in common.vxlan_setup(network, node, segment.name or 'v%i', segment.vxlan_id, segment.mtu, []).tuning:
+                lines.append('PreUp = {}'.format(command))
+
+    if node.get('UPnP', False) and node.get('ListenPort', 0) != 0:
+        lines.append('PreUp = upnpc -r {} udp &'.format(node['ListenPort']))
+
+    if not batch:
+
+        for segment in segments:
+            for peer in peers:
+                if segment.name is not None and segment.name not in peer.segments:
+                    continue
+                comment_prefix = '#' if peer.blacklisted else ''
+
+                for address in peer.link_layer_addresses:
+                    lines.append('{}PostUp = bridge fdb append 00:00:00:00:00:00 dev {} dst {} via %i'.format(comment_prefix, segment.name or 'v%i', address))
+
+    else:
+
+        lines.append('PostUp = bridge -force -batch /etc/wireguard/%i.bridge.batch || true')
+
+    for segment in segments:
+        lines.append('PostUp = ip link set {} up'.format(segment.name or 'v%i'))
+
+    for script in node.get('PostUp', []):
+        lines.append('PostUp = {}'.format(script))
+
+    for script in node.get('PreDown', []):
+        lines.append('PreDown = {}'.format(script))
+
+    for segment in segments:
+        lines.append('PreDown = ip link set {} down'.format(segment.name or 'v%i'))
+
+    for segment in segments:
+        lines.append('PostDown = ip link delete {}'.format(segment.name or 'v%i'))
+
+    for script in node.get('PostDown', []):
+        lines.append('PostDown = {}'.format(script))
+
+    lines.append('')
+
+    for peer in peers:
+        comment_prefix = '#' if peer.blacklisted else ''
+
+        lines.append('{}# Peer node {}'.format(comment_prefix, peer.name))
+
+        lines.append('{}[Peer]'.format(comment_prefix))
+
+        if peer.public_key:
+            lines.append('{}PublicKey = {}'.format(comment_prefix, peer.public_key))
+
+        if peer.allowed_ips:
+            lines.append('{}AllowedIPs = {}'.format(comment_prefix, ', '.join(peer.allowed_ips)))
+
+        if peer.endpoint:
+            lines.append('{}Endpoint = {}'.format(comment_prefix, peer.endpoint))
+
+        if peer.persistent_keepalive != 0:
+            lines.append('{}PersistentKeepalive = {}'.format(comment_prefix, peer.persistent_keepalive))
+
+        lines.append('')
+
+    lines.append('# Network {}, node {}, generated by VxWireguard-Generator'.format(network_name, node_name))
+
+    return '\n'.join(lines) + '\n'
+
+
+def render_batch(network_name: str, network: common.Config.NetworkType, nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_name: str) -> Tuple[str, str]:
+    node = nodes[node_name]
+    # Batch files are not processed by wg-quick, so %i is not available there
+    interface = common.interface_name(network_name)
+
+    segments = generate_segments(network, nodes, blacklist, node_name, common.vtep_addresses(network, node))
+    peers = generate_peers(nodes, blacklist, node_name)
+
+    ip_lines: List[str] = []
+    for segment in segments:
+        setup = common.vxlan_setup(network, node, segment.name or common.vxlan_device_name(interface), segment.vxlan_id, segment.mtu, segment.addresses)
+        ip_lines.append(setup.link)
+        ip_lines += setup.addresses
+
+    bridge_lines: List[str] = []
+    for segment in segments:
+        for peer in peers:
+            if peer.blacklisted or (segment.name is not None and segment.name not in peer.segments):
+                continue
+            for address in peer.link_layer_addresses:
+                bridge_lines.append('fdb append 00:00:00:00:00:00 dev {} dst {} via {}'.format(segment.name or common.vxlan_device_name(interface), address, interface))
+
+    return ''.join(i + '\n' for i in ip_lines), ''.join(i + '\n' for i in bridge_lines)
+
+
+# Shell commands that set the private key of a running interface, the key goes
+# through a file only readable by root, never through a command line
+def private_key_commands(interface: str, private_key: str) -> List[str]:
+    return [
+        'key_file=$(umask 077 && mktemp)',
+        "cat > \"$key_file\" <<'EOF'",
+        private_key,
+        'EOF',
+        'wg set {} private-key "$key_file"'.format(interface),
+        'rm -f "$key_file"',
+    ]
+
+
+def generate_segments(network: common.Config.NetworkType, nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_name: str, addresses: List[str]) -> List[Segment]:
+    node = nodes[node_name]
+    # Without a configured VXLAN MTU, each segment uses the largest one its paths carry unfragmented
+    vxlan_mtu = network.get('VxlanMTU')
+    segments = [Segment(None, network.get('VxlanID', 0), int(vxlan_mtu) if vxlan_mtu is not None else common.auto_vxlan_mtu(nodes, blacklist, node_name, None), addresses)]
+    network_segments = network.get('Segments', {})
+    for segment_name in node.get('Segments', []):
+        if segment_name not in network_segments:
+            continue
+        segment = network_segments[segment_name]
+        segment_mtu = segment.get('VxlanMTU', vxlan_mtu)
+        segments.append(Segment(segment_name, segment.get('VxlanID', 0), int(segment_mtu) if segment_mtu is not None else common.auto_vxlan_mtu(nodes, blacklist, node_name, segment_name), list(node.get('SegmentAddress', {}).get(segment_name, []))))
+    return segments
+
+
+# The WireGuard interface carries the VXLAN packets of every segment of the node
+def wireguard_mtu(segments: List[Segment]) -> int:
+    return max(segment.mtu for segment in segments) + common.VXLAN_OVERHEAD
+
+
+def generate_peers(nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_name: str) -> List[Peer]:
+    peers: List[Peer] = []
+
+    for peer_name, peer in nodes.items():
+        if peer_name == node_name:
+            continue
+
+        public_key: Optional[str] = None
+        if peer.get('PrivateKey'):
+            public_key = common.generate_pubkey(peer)
+            if public_key is None:
+                print("vwgen: Node '{}' has incorrect PrivateKey".format(peer_name), file=sys.stderr)
+
+        peers.append(generate_peer(nodes, blacklist, node_name, peer_name, public_key))
+
+    return peers
+
+
+def generate_peer(nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_name: str, peer_name: str, public_key: Optional[str]) -> Peer:
+    node, peer = nodes[node_name], nodes[peer_name]
+    node_segments = node.get('Segments', [])
+    return Peer(
+        name=peer_name,
+        public_key=public_key,
+        allowed_ips=list(peer.get('AllowedIPs', [])),
+        endpoint=common.select_endpoint(node, peer),
+        persistent_keepalive=common.keepalive_interval(node, peer),
+        link_layer_addresses=[str(address).split('/', 1)[0] for address in peer.get('LinkLayerAddress', [])],
+        blacklisted=not common.peering_allowed(nodes, blacklist, node_name, peer_name),
+        segments=[i for i in peer.get('Segments', []) if i in node_segments],
+    )
+
+
+class Record(NamedTuple):
+    owner: str
+    rtype: str
+    data: str
+
+
+class ReverseZone(NamedTuple):
+    domain_suffix: str
+    records: List[Record]
+
+
+# Renders the zone of one network, PTR records are moved to reverse_zones if given
+def render_zone(network_name: str, network: common.Config.NetworkType, nodes: common.Config.NodesType, domain_suffix: str, reverse_zones: Optional[Dict[str, ReverseZone]] = None) -> Tuple[str, int]:
+    lines = ['', ';; Network {}'.format(network_name), '$ORIGIN                         {}'.format(domain_suffix), '$TTL                            300']
+
+    records, return_value = generate_records(network, nodes, domain_suffix)
+
+    if reverse_zones is not None:
+        records, error = split_reverse_zones(network, records, domain_suffix, reverse_zones)
+        return_value = return_value or error
+
+    lines.append('{}300     IN      SOA     ns1.{} hostmaster.{} {:.0f} 86400 7200 604800 300'.format(pad_to_tab(domain_suffix, 32), domain_suffix, domain_suffix, time.time()))
+
+    for record in records:
+        lines.append(format_record(record))
+
+    return ''.join(i + '\n' for i in lines), return_value
+
+
+def normalize_domain_suffix(domain_suffix: str) -> str:
+    return encodings.idna.ToASCII(''.join((c for c in domain_suffix.strip('.') + '.' if ord(c) > 32))).decode('ascii').lstrip('.')
+
+
+def generate_records(network: common.Config.NetworkType, nodes: common.Config.NodesType, domain_suffix: str) -> Tuple[List[Record], int]:
+    return_value = 0
+
+    A_records: List[Record] = []
+    AAAA_records: List[Record] = []
+    PTR_IP_records: List[Record] = []
+    PTR_IP6_records: List[Record] = []
+
+    for node_name, node in nodes.items():
+        safe_node_name = encodings.idna.ToASCII(''.join((c for c in node_name if ord(c) > 32))).decode('ascii')
+        fqdn = safe_node_name + '.' + domain_suffix
+
+        addresses: List[str] = list(node.get('Address', []))
+
+        pubkey_ipv6: Optional[str] = common.generate_pubkey_ipv6(network, node)
+        if pubkey_ipv6:
+            addresses.append(pubkey_ipv6)
+
+        for address in addresses:
+            address = address.split('/', 1)[0]
+            ip: Optional[ipaddress._BaseAddress] = None
+
+            try:
+                ip = ipaddress.IPv4Address(address)
+            except ipaddress.AddressValueError:
+                ip = None
+
+            if ip is None:
+                try:
+                    ip = ipaddress.IPv6Address(address)
+                except ipaddress.AddressValueError:
+                    pass
+
+            if ip is None:
+                print("vwgen: Invalid IP address '{}'".format(address), file=sys.stderr)
+                return_value = return_value or errno.EADDRNOTAVAIL
+                continue
+
+            if isinstance(ip, ipaddress.IPv4Address):
+
+                A_records.append(Record(fqdn, 'A', ip.compressed))
+
+                PTR_IP_records.append(Record(ip.reverse_pointer + '.', 'PTR', fqdn))
+
+            elif isinstance(ip, ipaddress.IPv6Address):
+
+                AAAA_records.append(Record(fqdn, 'AAAA', ip.compressed))
+
+                PTR_IP6_records.append(Record(ip.reverse_pointer + '.', 'PTR', fqdn))
+
+    return A_records + AAAA_records + PTR_IP_records + PTR_IP6_records, return_value
+
+
+def reverse_zone_networks(network: common.Config.NetworkType) -> List[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]]:
+    zone_networks: List[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]] = []
+
+    if 'AddressPoolIPv4' in network:
+        pool_ipv4 = ipaddress.IPv4Network(network['AddressPoolIPv4'], strict=False)
+        # in-addr.arpa can only be delegated on octet boundaries
+        zone_networks.extend(pool_ipv4.subnets(new_prefix=(pool_ipv4.prefixlen + 7) // 8 * 8))
+
+    if 'AddressPoolIPv6' in network:
+        pool_ipv6 = ipaddress.IPv6Network(network['AddressPoolIPv6'], strict=False)
+        # ip6.arpa can only be delegated on nibble boundaries
+        zone_networks.extend(pool_ipv6.subnets(new_prefix=(pool_ipv6.prefixlen + 3) // 4 * 4))
+
+    return zone_networks
+
+
+def reverse_zone_name(zone_network: Union[ipaddress.IPv4Network, ipaddress.IPv6Network]) -> str:
+    bits_per_label = 8 if zone_network.version == 4 else 4
+    host_labels = (zone_network.max_prefixlen - zone_network.prefixlen) // bits_per_label
+    return zone_network.network_address.reverse_pointer.split('.', host_labels)[-1] + '.'
+
+
+def split_reverse_zones(network: common.Config.NetworkType, records: List[Record], domain_suffix: str, reverse_zones: Dict[str, ReverseZone]) -> Tuple[List[Record], int]:
+    return_value = 0
+
+    labels_to_strip = set()
+    for zone_network in reverse_zone_networks(network):
+        zone_name = reverse_zone_name(zone_network)
+        if zone_name not in reverse_zones:
+            reverse_zones[zone_name] = ReverseZone(domain_suffix, [])
+        labels_to_strip.add(len(zone_network.network_address.reverse_pointer.split('.')) - len(zone_name.split('.')) + 1)
+
+    forward_records: List[Record] = []
+    for record in records:
+        if record.rtype != 'PTR':
+            forward_records.append(record)
+            continue
+
+        for i in labels_to_strip:
+            zone_name = record.owner.split('.', i)[-1]
+            if zone_name in reverse_zones:
+                reverse_zones[zone_name].records.append(record)
+                break
+        else:
+            print("vwgen: PTR record '{}' is outside of the address pools, skipping".format(record.owner), file=sys.stderr)
+            return_value = return_value or errno.EADDRNOTAVAIL
+
+    return forward_records, return_value
+
+
+def format_record(record: Record, ttl: int = 300) -> str:
+    owner_width = 80 if record.owner.endswith('.ip6.arpa.') else 32
+    return '{}{}IN      {}{}'.format(pad_to_tab(record.owner, owner_width), str(ttl).ljust(8), record.rtype.ljust(8), record.data)
+
+
+def pad_to_tab(s: str, min_width: int) -> str:
+    return s.ljust(max(len(s), min_width - 1) // 8 * 8 + 8)
+
+
+class _Record(Mapping[str, Any]):
+    # Records keep one slot per known field instead of a dictionary per node,
+    # and read like the dictionaries of common.Config, so that the generators
+    # of the commands accept both. Fields set to None are absent.
+    __slots__ = ('extra',)
+    FIELDS: Dict[str, str] = {}
+
+    def __init__(self, **fields: Any) -> None:
+        for attr in self.FIELDS.values():
+            setattr(self, attr, None)
+        # Unknown fields are kept as they are, so that saving does not drop them
+        self.extra: Dict[str, Any] = {}
+        for attr, value in fields.items():
+            if attr not in self.__slots__:
+                raise TypeError("{} has no field '{}'".format(type(self).__name__, attr))
+            setattr(self, attr, value)
+
+    def _set_from_dict(self, values: Mapping[str, Any]) -> None:
+        for key, value in values.items():
+            attr = self.FIELDS.get(key)
+            if attr is None:
+                self.extra[key] = value
+            else:
+                setattr(self, attr, value)
+
+    def to_dict(self) -> common.SortedDict[str, Any]:
+        values = common.SortedDict[str, Any]()
+        for key in self:
+            values[key] = self[key]
+        return values
+
+    def __getitem__(self, key: str) -> Any:
+        attr = self.FIELDS.get(key)
+        if attr is None:
+            return self.extra[key]
+        value = getattr(self, attr)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        for key, attr in self.FIELDS.items():
+            if getattr(self, attr) is not None:
+                yield key
+        yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(attr, getattr(self, attr)) for attr in self.__slots__ if getattr(self, attr) not in (None, {})))
+
+
+class NetworkSettings(_Record):
+    __slots__ = ('address_pool_ipv4', 'address_pool_ipv6', 'ipv6_allocation', 'journal', 'segments', 'snapshots', 'vxlan_id', 'vxlan_mtu', 'vxlan_port')
+    FIELDS = {
+        'AddressPoolIPv4': 'address_pool_ipv4',
+        'AddressPoolIPv6': 'address_pool_ipv6',
+        'IPv6Allocation': 'ipv6_allocation',
+        'Journal': 'journal',
+        'Segments': 'segments',
+        'Snapshots': 'snapshots',
+        'VxlanID': 'vxlan_id',
+        'VxlanMTU': 'vxlan_mtu',
+        'VxlanPort': 'vxlan_port',
+    }
+
+    @classmethod
+    def from_dict(cls, values: Mapping[str, Any]) -> 'NetworkSettings':
+        settings = cls()
+        settings._set_from_dict(values)
+        return settings
+
+
+class Node(_Record):
+    __slots__ = (
+        'name', 'address', 'allowed_ips', 'endpoint', 'endpoints', 'fw_mark', 'link_layer_address', 'listen_port', 'nat',
+        'peers', 'persistent_keepalive', 'post_down', 'post_up', 'pre_down', 'pre_up', 'private_key', 'save_config',
+        'segment_address', 'segments', 'site', 'underlay_mtu', 'upnp',
+    )
+    FIELDS = {
+        'Address': 'address',
+        'AllowedIPs': 'allowed_ips',
+        'Endpoint': 'endpoint',
+        'Endpoints': 'endpoints',
+        'FwMark': 'fw_mark',
+        'LinkLayerAddress': 'link_layer_address',
+        'ListenPort': 'listen_port',
+        'NAT': 'nat',
+        'Peers': 'peers',
+        'PersistentKeepalive': 'persistent_keepalive',
+        'PostDown': 'post_down',
+        'PostUp': 'post_up',
+        'PreDown': 'pre_down',
+        'PreUp': 'pre_up',
+        'PrivateKey': 'private_key',
+        'SaveConfig': 'save_config',
+        'SegmentAddress': 'segment_address',
+        'Segments': 'segments',
+        'Site': 'site',
+        'UnderlayMTU': 'underlay_mtu',
+        'UPnP': 'upnp',
+    }
+
+    def __init__(self, name: str, **fields: Any) -> None:
+        super().__init__(**fields)
+        self.name = name
+
+    @classmethod
+    def from_dict(cls, name: str, values: Mapping[str, Any]) -> 'Node':
+        node = cls(name)
+        node._set_from_dict(values)
+        return node
+
+    def public_key(self) -> Optional[str]:
+        return common.generate_pubkey(self)
+
+
+class Network:
+    __slots__ = ('name', 'settings', 'nodes', 'blacklist', '_config')
+
+    def __init__(self, name: str, settings: NetworkSettings, nodes: Dict[str, Node], blacklist: common.Config.BlacklistType, config: common.Config) -> None:
+        self.name = name
+        self.settings = settings
+        self.nodes = nodes
+        self.blacklist = blacklist
+        self._config = config
+
+    # Loads a network like the commands do, holding its lock until close()
+    @classmethod
+    def load(cls, name: str, create: bool = False, writable: bool = False) -> 'Network':
+        config = common.Config()
+        if not config.load(name, writable) and not create:
+            config.close()
+            raise FileNotFoundError(errno.ENOENT, 'Unable to find configuration file', config.storage().file_name(config.network_name()))
+        config.tolerate_errors()
+        settings = NetworkSettings.from_dict(config.network())
+        config_nodes = config.nodes()
+        nodes = {node_name: Node.from_dict(node_name, node) for node_name, node in config_nodes.items()}
+        # The dictionaries are rebuilt from the records when saving
+        config_nodes.clear()
+        return cls(config.network_name(), settings, nodes, config.blacklist(), config)
+
+    def save(self) -> None:
+        network = self._config.network()
+        network.clear()
+        network.update(self.settings.to_dict())
+        nodes = self._config.nodes()
+        nodes.clear()
+        for node_name, node in self.nodes.items():
+            nodes[node_name] = node.to_dict()
+        try:
+            self._config.save()
+        finally:
+            nodes.clear()
+
+    def close(self) -> None:
+        self._config.close()
+
+    def __enter__(self) -> 'Network':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def validate(self) -> List[common.ValidationError]:
+        return common.validate({'Network': self.settings, 'Node': self.nodes, 'PeerBlacklist': {'Blacklist': self.blacklist}})
+
+    # Adds nodes with fresh keys and addresses, as 'vwgen add' does, and returns
+    # the nodes that were added; problems are reported on stderr
+    def add_nodes(self, node_names: List[str], options: Optional[SearchOptions] = None) -> List[Node]:
+        nodes = cast(common.Config.NodesType, self.nodes)
+        add_nodes(self.name, self._settings_dict(), nodes, node_names, options)
+        added: List[Node] = []
+        for node_name in node_names:
+            node = nodes.get(node_name)
+            if isinstance(node, dict):
+                self.nodes[node_name] = Node.from_dict(node_name, node)
+                added.append(self.nodes[node_name])
+        return added
+
+    # Changes network settings like 'vwgen set <network> <option> <value>...'
+    def set(self, option: str, *values: str) -> None:
+        network = self.settings.to_dict()
+        nodes = self._node_dicts() if option == 'nosegment' else {}
+        set_network_option(network, nodes, option, list(values))
+        self.settings = NetworkSettings.from_dict(network)
+        # Only removing a segment changes nodes as well
+        for node_name, node in nodes.items():
+            self.nodes[node_name] = Node.from_dict(node_name, node)
+
+    # Changes a node like 'vwgen set <network> node <node> <option> <value>...'
+    def set_node(self, node_name: str, option: str, *values: str) -> None:
+        node = self.nodes[node_name].to_dict()
+        set_node_option(node, option, list(values))
+        self.nodes[node_name] = Node.from_dict(node_name, node)
+
+    # Gives static addresses from AddressPoolIPv6 to many nodes at once, by default
+    # to every node still using the address derived from its key
+    # Returns the new address of each node, None once the pool is full
+    def assign_ipv6(self, node_names: Optional[List[str]] = None) -> Dict[str, Optional[str]]:
+        allocations = common.allocate_node_ipv6(self._settings_dict(), self._nodes_dict(), node_names)
+        for node_name, ipv6 in allocations.items():
+            if ipv6 is not None:
+                self.nodes[node_name].address = list(self.nodes[node_name].address or []) + [ipv6]
+        return allocations
+
+    def render_wg_quick(self, node_name: str, batch: bool = False) -> str:
+        return render_wg_quick(self.name, self._settings_dict(), self._nodes_dict(), self.blacklist, node_name, batch)
+
+    # Returns the ip and bridge batch files used with render_wg_quick(batch=True)
+    def render_batch(self, node_name: str) -> Tuple[str, str]:
+        return render_batch(self.name, self._settings_dict(), self._nodes_dict(), self.blacklist, node_name)
+
+    def render_zone(self, domain_suffix: str) -> str:
+        return render_zone(self.name, self._settings_dict(), self._nodes_dict(), normalize_domain_suffix(domain_suffix))[0]
+
+    def _settings_dict(self) -> common.Config.NetworkType:
+        return cast(common.Config.NetworkType, self.settings)
+
+    def _node_dicts(self) -> common.Config.NodesType:
+        return {node_name: node.to_dict() for node_name, node in self.nodes.items()}
+
+    def _nodes_dict(self) -> common.Config.NodesType:
+        return cast(common.Config.NodesType, self.nodes)
@@ -23,15 +23,22 @@
 # SOFTWARE.
 
 import binascii
+import bisect
 import collections
 import errno
 import fcntl
+import hashlib
 import ipaddress
+import json
 import nacl.bindings
+import os
 import random
+import sqlite3
 import sys
+import time
 import toml
-from typing import Any, cast, Dict, KeysView, ItemsView, Iterator, List, Optional, Set, TextIO, TypeVar, ValuesView
+import zlib
+from typing import Any, cast, Dict, Iterable, KeysView, ItemsView, Iterator, List, NamedTuple, Optional, Set, TextIO, Tuple, Type, TypeVar, ValuesView
 
 T = TypeVar('T')
 KT = TypeVar('KT')
@@ -127,6 +134,654 @@ class NamePair(FakeList[str]):
         return hash(tuple(self))
 
 
+# Timers and counters reported by --stats
+# Everything is a no-op until enabled, so instrumented code costs an attribute lookup otherwise
+class Stats:
+    def __init__(self) -> None:
+        self.enabled = False
+        # Name -> [calls, seconds]
+        self.timers: Dict[str, List[float]] = {}
+        self.counters: Dict[str, int] = {}
+
+    def count(self, name: str, value: int = 1) -> None:
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timer(self, name: str) -> '_Timer':
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+
+    def report(self) -> List[str]:
+        lines = []
+        width = max((len(i) for i in list(self.timers) + list(self.counters)), default=0)
+        for name, (calls, seconds) in sorted(self.timers.items()):
+            lines.append('{:<{}}  {:>8} {:<5}  {:>10.3f} ms'.format(name, width, int(calls), 'call' if calls == 1 else 'calls', seconds * 1000))
+        for name, value in sorted(self.counters.items()):
+            lines.append('{:<{}}  {:>8}'.format(name, width, value))
+        return lines
+
+
+class _Timer:
+    __slots__ = ('_stats', '_name', '_start')
+
+    def __init__(self, stats: Optional[Stats], name: str) -> None:
+        self._stats = stats
+        self._name = name
+        self._start = 0.0
+
+    def __enter__(self) -> None:
+        if self._stats is not None:
+            self._start = time.perf_counter()
+
+    def __exit__(self, *args: Any) -> None:
+        if self._stats is not None:
+            self._stats.add_time(self._name, time.perf_counter() - self._start)
+
+
+_NULL_TIMER = _Timer(None, '')
+STATS = Stats()
+
+
+class LockTimeoutError(TimeoutError):
+    pass
+
+
+# Reader/writer lock on <network>.conf.lock, using byte ranges of the file:
+# byte 0 is a turnstile that a waiting writer holds so new readers queue up behind it,
+# byte 1 is the lock itself. The holder writes its PID at the start of the file,
+# so that a waiting process can tell which process it is waiting for
+class FileLock:
+    TURNSTILE = 0
+    LOCK = 1
+    RECORD_SIZE = 32
+
+    # Seconds to wait for a lock, None waits forever and 0 fails at once if the lock is taken
+    # Set by vwgen --lock-timeout, --no-wait or the VWGEN_LOCK_TIMEOUT environment variable
+    timeout: Optional[float] = None
+
+    def __init__(self, file_name: str) -> None:
+        self.file_name = file_name
+        self._fd: Optional[int] = None
+        self._fd_writable = False
+        self._locked = False
+        self._writable = False
+
+    def acquire(self, writable: bool = False) -> None:
+        if self._locked and self._writable >= writable:
+            return
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with STATS.timer('lock.wait'):
+            if self._locked:
+                # Upgrade in place while no other process reads, otherwise release the
+                # lock and queue up behind the turnstile like any other writer, as two
+                # readers upgrading at the same time would wait for each other forever
+                STATS.count('lock.upgrade')
+                try:
+                    fcntl.lockf(cast(int, self._fd), fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.LOCK)
+                except OSError as e:
+                    if e.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                    self.release()
+                else:
+                    self._writable = True
+                    self._write_record()
+                    return
+            self._open(writable)
+            if self._fd is None:
+                # Neither the lock file nor the configuration file exists, and the
+                # directory is not writable, so nobody else can write either
+                self._locked = True
+                return
+            try:
+                if self._fd_writable:
+                    self._wait(fcntl.LOCK_EX, self.TURNSTILE, deadline)
+                try:
+                    self._wait(fcntl.LOCK_EX if writable else fcntl.LOCK_SH, self.LOCK, deadline)
+                finally:
+                    if self._fd_writable:
+                        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self.TURNSTILE)
+            except BaseException:
+                self.release()
+                raise
+        self._locked = True
+        self._writable = writable
+        self._write_record()
+
+    def release(self) -> None:
+        if self._fd is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 0, 0)
+            os.close(self._fd)
+        self._fd = None
+        self._locked = False
+        self._writable = False
+
+    # Returns the PID and mode of the last process that took the lock
+    def holder(self) -> Tuple[Optional[int], str]:
+        if self._fd is None:
+            return None, ''
+        fields = os.pread(self._fd, self.RECORD_SIZE, 0).decode('ascii', 'replace').split()
+        try:
+            return int(fields[0]), fields[1] if len(fields) > 1 else ''
+        except (IndexError, ValueError):
+            return None, ''
+
+    def _open(self, writable: bool) -> None:
+        try:
+            self._fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT, 0o666)
+            self._fd_writable = True
+        except OSError as e:
+            # Readers can still share the lock if the directory is read-only
+            if writable or e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            try:
+                self._fd = os.open(self.file_name, os.O_RDONLY)
+            except FileNotFoundError:
+                self._fd = None
+            self._fd_writable = False
+
+    def _wait(self, operation: int, start: int, deadline: Optional[float]) -> None:
+        assert self._fd is not None
+        try:
+            fcntl.lockf(self._fd, operation | fcntl.LOCK_NB, 1, start)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+
+        STATS.count('lock.contended')
+        pid, mode = self.holder()
+        holder = 'process {}{}'.format(pid, ' ({})'.format(mode) if mode else '') if pid is not None else 'another process'
+        if deadline is not None and deadline <= time.monotonic():
+            raise LockTimeoutError(errno.EAGAIN, 'The configuration file is being used by {}'.format(holder), self.file_name)
+        print('The configuration file is being used by {}, waiting.'.format(holder), end='', file=sys.stderr, flush=True)
+        start_time = time.monotonic()
+        with STATS.timer('lock.wait.contended'):
+            if deadline is None:
+                fcntl.lockf(self._fd, operation, 1, start)
+            else:
+                delay = 0.001
+                while True:
+                    time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+                    delay = min(delay * 2, 0.1)
+                    try:
+                        fcntl.lockf(self._fd, operation | fcntl.LOCK_NB, 1, start)
+                        break
+                    except OSError as e:
+                        if e.errno not in (errno.EACCES, errno.EAGAIN):
+                            raise
+                    if time.monotonic() >= deadline:
+                        print(file=sys.stderr, flush=True)
+                        raise LockTimeoutError(errno.ETIMEDOUT, 'Timed out after {:.1f}s waiting for {}'.format(time.monotonic() - start_time, holder), self.file_name)
+        print(' {:.1f}s'.format(time.monotonic() - start_time), file=sys.stderr, flush=True)
+
+    def _write_record(self) -> None:
+        if self._fd is not None and self._fd_writable:
+            record = '{} {}'.format(os.getpid(), 'write' if self._writable else 'read')
+            os.pwrite(self._fd, '{:<{}}\n'.format(record, self.RECORD_SIZE - 1).encode('ascii'), 0)
+
+
+# Where a Config is loaded from and saved to
+class Storage:
+    extension = ''
+
+    def file_name(self, conf_name: str) -> str:
+        return conf_name + self.extension
+
+    # Storages that lock take the lock for writing right away if writable is set,
+    # instead of upgrading it on the first save
+    def load(self, conf_name: str, writable: bool = False) -> Optional[SortedDict[str, Any]]:
+        raise NotImplementedError
+
+    # Returns whether anything changed since the last load or save
+    def save(self, conf_name: str, conf: SortedDict[str, Any]) -> bool:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+# Plain-text TOML file, rewritten as a whole on every save
+# If the network has Journal enabled, saves append the changes to
+# <network>.conf.journal instead, which is folded back once it grows too large
+class TomlStorage(Storage):
+    extension = '.conf'
+
+    # The journal is compacted once it is larger than this, or a quarter of the TOML file
+    JOURNAL_COMPACT_SIZE = 65536
+
+    def __init__(self) -> None:
+        self._conf_file: Optional[TextIO] = None
+        self._conf_name: Optional[str] = None
+        self._lock: Optional[FileLock] = None
+        self._writable = False
+        # Serialized values as of the last load or save, to find out what has changed
+        self._values: Optional[Dict[Tuple[str, ...], str]] = None
+        self._blacklist: Set[Tuple[str, str]] = set()
+
+    def journal_file_name(self, conf_name: str) -> str:
+        return conf_name + '.conf.journal'
+
+    def lock_file_name(self, conf_name: str) -> str:
+        return conf_name + '.conf.lock'
+
+    def load(self, conf_name: str, writable: bool = False) -> Optional[SortedDict[str, Any]]:
+        try:
+            self._open_file(conf_name, writable)
+        except FileNotFoundError:
+            return None
+        assert self._conf_file is not None
+        with STATS.timer('toml.parse'):
+            conf = cast(SortedDict[str, Any], toml.load(self._conf_file, SortedDict))
+        if STATS.enabled:
+            STATS.count('bytes.read', self._conf_file.tell())
+        self._replay_journal(conf_name, conf)
+        self._values, self._blacklist = self._flatten(conf)
+        return conf
+
+    def save(self, conf_name: str, conf: SortedDict[str, Any]) -> bool:
+        self._open_file(conf_name, writable=True, create=True)
+        assert self._conf_file is not None
+
+        values, blacklist = self._flatten(conf)
+        changed = self._values != values or self._blacklist != blacklist
+
+        if conf.get('Network', {}).get('Journal', False) and self._values is not None:
+            journal_size = self._append_journal(conf_name, values, blacklist)
+            if journal_size <= max(self.JOURNAL_COMPACT_SIZE, os.fstat(self._conf_file.fileno()).st_size // 4):
+                return changed
+
+        with STATS.timer('toml.dump'):
+            data: str = toml.dumps(conf)
+        self._conf_file.seek(0)
+        self._conf_file.truncate()
+        self._conf_file.write(data)
+        self._conf_file.flush()
+        if STATS.enabled:
+            STATS.count('bytes.written', len(data.encode('utf-8')))
+        # Replaying a journal over a TOML file that already has its changes is harmless,
+        # so a crash before the journal is removed does not lose or duplicate anything
+        try:
+            os.remove(self.journal_file_name(conf_name))
+        except FileNotFoundError:
+            pass
+        self._values, self._blacklist = values, blacklist
+        return changed
+
+    def close(self) -> None:
+        self._close_file()
+
+    @staticmethod
+    def _flatten(conf: SortedDict[str, Any]) -> Tuple[Dict[Tuple[str, ...], str], Set[Tuple[str, str]]]:
+        values: Dict[Tuple[str, ...], str] = {}
+        for key, value in conf.get('Network', {}).items():
+            values[('Network', key)] = json.dumps(value, sort_keys=True)
+        for node_name, node in conf.get('Node', {}).items():
+            values[('Node', node_name)] = ''
+            for key, value in node.items():
+                values[('Node', node_name, key)] = json.dumps(value, sort_keys=True)
+        blacklist = set((str(i), str(j)) for i, j in conf.get('PeerBlacklist', {}).get('Blacklist', []))
+        return values, blacklist
+
+    def _append_journal(self, conf_name: str, values: Dict[Tuple[str, ...], str], blacklist: Set[Tuple[str, str]]) -> int:
+        assert self._values is not None
+
+        entries: List[str] = []
+        for path in self._values.keys() - values.keys():
+            # Deleting a node deletes all its values at once
+            if len(path) == 3 and ('Node', path[1]) not in values:
+                continue
+            entries.append(json.dumps(['del', list(path)]))
+        for path, value in values.items():
+            if self._values.get(path) != value and value:
+                entries.append('["set", {}, {}]'.format(json.dumps(list(path)), value))
+        for pair in sorted(self._blacklist - blacklist):
+            entries.append(json.dumps(['blacklist-del', list(pair)]))
+        for pair in sorted(blacklist - self._blacklist):
+            entries.append(json.dumps(['blacklist-add', list(pair)]))
+
+        if not entries:
+            try:
+                return os.path.getsize(self.journal_file_name(conf_name))
+            except FileNotFoundError:
+                return 0
+
+        with open(self.journal_file_name(conf_name), 'a') as f:
+            for entry in entries:
+                f.write(entry + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            journal_size = f.tell()
+        if STATS.enabled:
+            STATS.count('bytes.written', sum(len(i.encode('utf-8')) + 1 for i in entries))
+
+        self._values, self._blacklist = values, blacklist
+        return journal_size
+
+    def _replay_journal(self, conf_name: str, conf: SortedDict[str, Any]) -> None:
+        try:
+            journal = open(self.journal_file_name(conf_name), 'r')
+        except FileNotFoundError:
+            return
+        with journal:
+            if STATS.enabled:
+                STATS.count('bytes.read', os.fstat(journal.fileno()).st_size)
+            for line in journal:
+                try:
+                    entry = json.loads(line, object_hook=SortedDict)
+                except ValueError:
+                    # Only the last line can be incomplete, if a save was interrupted
+                    break
+
+                if entry[0] == 'set':
+                    table = conf
+                    for key in entry[1][:-1]:
+                        if key not in table:
+                            table[key] = SortedDict()
+                        table = table[key]
+                    table[entry[1][-1]] = entry[2]
+
+                elif entry[0] == 'del':
+                    table = conf
+                    for key in entry[1][:-1]:
+                        table = table.get(key, {})
+                    table.pop(entry[1][-1], None)
+
+                elif entry[0] in ('blacklist-add', 'blacklist-del'):
+                    if 'PeerBlacklist' not in conf:
+                        conf['PeerBlacklist'] = {}
+                    blacklist = conf['PeerBlacklist'].get('Blacklist', [])
+                    if not isinstance(blacklist, SortedSet):
+                        blacklist = SortedSet((NamePair(i, j) for i, j in blacklist))
+                    pair = NamePair(entry[1][0], entry[1][1])
+                    if entry[0] == 'blacklist-add':
+                        blacklist.add(pair)
+                    elif pair in blacklist:
+                        blacklist.remove(pair)
+                    conf['PeerBlacklist']['Blacklist'] = blacklist
+
+    def _close_file(self) -> None:
+        if self._conf_file is not None:
+            self._conf_file.close()
+            self._conf_file = None
+        if self._lock is not None:
+            self._lock.release()
+            self._lock = None
+
+    def _open_file(self, conf_name: str, writable: bool = False, create: bool = False) -> None:
+        if self._conf_name != conf_name:
+            self._close_file()
+        self._conf_name = conf_name
+        if self._conf_file is None or self._writable < writable:
+            # Opened before locking, so that loading a missing network leaves no lock file behind
+            # Saves rewrite the file in place, the content is read only after locking
+            if writable:
+                # Do not truncate here, nor at all if only the journal is written
+                conf_file = open(os.open(conf_name + '.conf', os.O_RDWR | os.O_CREAT if create else os.O_RDWR, 0o666), 'r+')
+            else:
+                conf_file = open(conf_name + '.conf', 'r')
+            if self._conf_file is not None:
+                self._conf_file.close()
+            self._conf_file = conf_file
+            self._writable = writable
+        if self._lock is None:
+            self._lock = FileLock(self.lock_file_name(conf_name))
+        try:
+            self._lock.acquire(writable)
+        except BaseException:
+            self._close_file()
+            raise
+        self._conf_file.seek(0)
+
+
+# SQLite database, where a save only writes the rows that have changed
+class SqliteStorage(Storage):
+    extension = '.db'
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS network (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS nodes (name TEXT PRIMARY KEY, attributes TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS addresses (node TEXT NOT NULL, position INTEGER NOT NULL, address TEXT NOT NULL, PRIMARY KEY (node, position));
+        CREATE TABLE IF NOT EXISTS blacklist (left_node TEXT NOT NULL, right_node TEXT NOT NULL, PRIMARY KEY (left_node, right_node));
+    '''
+
+    def __init__(self) -> None:
+        self._db: Optional[sqlite3.Connection] = None
+        # Serialized rows as of the last load or save, to find out what has changed
+        self._network_rows: Dict[str, str] = {}
+        self._node_rows: Dict[str, Tuple[str, List[str]]] = {}
+        self._blacklist_rows: Set[Tuple[str, str]] = set()
+        self._writable = False
+
+    def load(self, conf_name: str, writable: bool = False) -> Optional[SortedDict[str, Any]]:
+        if not os.path.exists(self.file_name(conf_name)):
+            return None
+        db = self._connect(conf_name)
+        self._writable = writable
+
+        conf = SortedDict[str, Any]()
+        # A writable load keeps the write lock until close, like the lock file of
+        # TomlStorage, so that no other process changes rows between load and save
+        db.execute('BEGIN IMMEDIATE' if writable else 'BEGIN')
+        try:
+            network = SortedDict[str, Any]()
+            for key, value in db.execute('SELECT key, value FROM network'):
+                network[key] = json.loads(value)
+                self._network_rows[key] = value
+            if network:
+                conf['Network'] = network
+
+            addresses: Dict[str, List[str]] = collections.defaultdict(list)
+            for node_name, address in db.execute('SELECT node, address FROM addresses ORDER BY node, position'):
+                addresses[node_name].append(address)
+
+            nodes = SortedDict[str, Any]()
+            for node_name, attributes in db.execute('SELECT name, attributes FROM nodes'):
+                node = cast(SortedDict[str, Any], json.loads(attributes, object_hook=SortedDict))
+                node['Address'] = addresses.get(node_name, [])
+                nodes[node_name] = node
+                self._node_rows[node_name] = (attributes, list(node['Address']))
+            if nodes:
+                conf['Node'] = nodes
+
+            blacklist = SortedSet[NamePair]()
+            for left_node, right_node in db.execute('SELECT left_node, right_node FROM blacklist'):
+                blacklist.add(NamePair(left_node, right_node))
+                self._blacklist_rows.add((left_node, right_node))
+            if blacklist:
+                conf['PeerBlacklist'] = {'Blacklist': blacklist}
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        if not writable:
+            db.execute('COMMIT')
+
+        return conf
+
+    def save(self, conf_name: str, conf: SortedDict[str, Any]) -> bool:
+        db = self._connect(conf_name)
+
+        network_rows = {key: json.dumps(value, sort_keys=True) for key, value in conf.get('Network', {}).items()}
+        node_rows: Dict[str, Tuple[str, List[str]]] = {}
+        for node_name, node in conf.get('Node', {}).items():
+            attributes = json.dumps({key: value for key, value in node.items() if key != 'Address'}, sort_keys=True)
+            node_rows[node_name] = (attributes, [str(i) for i in node.get('Address', [])])
+        blacklist_rows = set((str(i), str(j)) for i, j in conf.get('PeerBlacklist', {}).get('Blacklist', []))
+
+        # BEGIN IMMEDIATE takes the write lock up front, readers are not blocked in WAL mode
+        if not db.in_transaction:
+            db.execute('BEGIN IMMEDIATE')
+        try:
+            for key in self._network_rows.keys() - network_rows.keys():
+                db.execute('DELETE FROM network WHERE key = ?', (key, ))
+            for key, value in network_rows.items():
+                if self._network_rows.get(key) != value:
+                    db.execute('INSERT OR REPLACE INTO network (key, value) VALUES (?, ?)', (key, value))
+
+            for node_name in self._node_rows.keys() - node_rows.keys():
+                db.execute('DELETE FROM nodes WHERE name = ?', (node_name, ))
+                db.execute('DELETE FROM addresses WHERE node = ?', (node_name, ))
+            for node_name, (attributes, addresses) in node_rows.items():
+                old_attributes, old_addresses = self._node_rows.get(node_name, (None, None))
+                if old_attributes != attributes:
+                    db.execute('INSERT OR REPLACE INTO nodes (name, attributes) VALUES (?, ?)', (node_name, attributes))
+                if old_addresses != addresses:
+                    db.execute('DELETE FROM addresses WHERE node = ?', (node_name, ))
+                    db.executemany('INSERT INTO addresses (node, position, address) VALUES (?, ?, ?)', ((node_name, position, address) for position, address in enumerate(addresses)))
+
+            db.executemany('DELETE FROM blacklist WHERE left_node = ? AND right_node = ?', self._blacklist_rows - blacklist_rows)
+            db.executemany('INSERT INTO blacklist (left_node, right_node) VALUES (?, ?)', blacklist_rows - self._blacklist_rows)
+        except sqlite3.IntegrityError as e:
+            db.execute('ROLLBACK')
+            self._writable = False
+            raise ConfigError(["Unable to save network '{}': {}".format(conf_name, e)])
+        except Exception:
+            db.execute('ROLLBACK')
+            self._writable = False
+            raise
+        db.execute('COMMIT')
+        if self._writable:
+            db.execute('BEGIN IMMEDIATE')
+
+        changed = self._network_rows != network_rows or self._node_rows != node_rows or self._blacklist_rows != blacklist_rows
+        self._network_rows = network_rows
+        self._node_rows = node_rows
+        self._blacklist_rows = blacklist_rows
+        return changed
+
+    def close(self) -> None:
+        if self._db is None:
+            return
+        # Everything was committed by save, the open transaction only holds the lock
+        if self._db.in_transaction:
+            self._db.execute('ROLLBACK')
+        self._db.close()
+        self._db = None
+        self._writable = False
+
+    def _connect(self, conf_name: str) -> sqlite3.Connection:
+        if self._db is None:
+            # Transactions are managed explicitly
+            timeout = 3600 if FileLock.timeout is None else FileLock.timeout
+            self._db = sqlite3.connect(self.file_name(conf_name), isolation_level=None, timeout=timeout)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(self.SCHEMA)
+        return self._db
+
+
+STORAGE_TYPES: Dict[str, Type[Storage]] = {
+    'toml': TomlStorage,
+    'sqlite': SqliteStorage,
+}
+
+
+class Snapshot(NamedTuple):
+    id: int
+    time: float
+    # Object name of the snapshot, which lists the objects of its parts
+    manifest: str
+    node_count: int
+
+
+# Keeps every saved version of a network in <network>.snapshots, stored as
+# zlib-compressed JSON objects named by their SHA-256. The node table is cut
+# into chunks at nodes whose name hashes to a boundary, so that changing or
+# adding a node only stores the chunk around it again.
+class SnapshotStore:
+    # Nodes per chunk on average
+    NODE_CHUNK_SIZE = 32
+
+    def __init__(self, conf_name: str) -> None:
+        self._directory = conf_name + '.snapshots'
+
+    def log_file_name(self) -> str:
+        return os.path.join(self._directory, 'log')
+
+    def snapshots(self) -> List[Snapshot]:
+        try:
+            with open(self.log_file_name(), 'r') as f:
+                return [i for i in map(self._parse_log_line, f) if i is not None]
+        except FileNotFoundError:
+            return []
+
+    def latest(self) -> Optional[Snapshot]:
+        # Only read the end of the log, it grows with every save
+        try:
+            with open(self.log_file_name(), 'rb') as f:
+                f.seek(max(f.seek(0, os.SEEK_END) - 4096, 0))
+                lines = f.read().decode('utf-8').splitlines()
+        except FileNotFoundError:
+            return None
+        return self._parse_log_line(lines[-1]) if lines else None
+
+    @staticmethod
+    def _parse_log_line(line: str) -> Optional[Snapshot]:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != 4:
+            return None
+        return Snapshot(int(fields[0]), float(fields[1]), fields[2], int(fields[3]))
+
+    # Stores the configuration unless it equals the latest snapshot, returns its manifest
+    def add(self, conf: Dict[str, Any]) -> str:
+        node_chunks: List[str] = []
+        chunk: Dict[str, Any] = {}
+        nodes: Dict[str, Any] = conf.get('Node', {})
+        for node_name, node in nodes.items():
+            # TOML has no null, so None values are dropped by saving anyway
+            chunk[node_name] = {key: value for key, value in node.items() if value is not None}
+            if zlib.crc32(node_name.encode('utf-8')) % self.NODE_CHUNK_SIZE == 0:
+                node_chunks.append(self._put(chunk))
+                chunk = {}
+        if chunk:
+            node_chunks.append(self._put(chunk))
+
+        blacklist = sorted(list(i) for i in conf.get('PeerBlacklist', {}).get('Blacklist', []))
+        manifest = self._put({'Network': self._put(conf.get('Network', {})), 'Node': node_chunks, 'Blacklist': self._put(blacklist)})
+
+        latest = self.latest()
+        if latest is None or latest.manifest != manifest:
+            with open(self.log_file_name(), 'a') as f:
+                f.write('{}\t{:.3f}\t{}\t{}\n'.format(latest.id + 1 if latest else 1, time.time(), manifest, len(nodes)))
+        return manifest
+
+    def load(self, manifest: str) -> SortedDict[str, Any]:
+        objects = self._get(manifest)
+        nodes = SortedDict[str, Any]()
+        for chunk in objects['Node']:
+            nodes.update(self._get(chunk))
+        blacklist = SortedSet((NamePair(i, j) for i, j in self._get(objects['Blacklist'])))
+        return SortedDict(Network=self._get(objects['Network']), Node=nodes, PeerBlacklist={'Blacklist': blacklist})
+
+    def _object_file_name(self, digest: str) -> str:
+        return os.path.join(self._directory, 'objects', digest[:2], digest[2:])
+
+    def _put(self, value: Any) -> str:
+        data = json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        file_name = self._object_file_name(digest)
+        if not os.path.exists(file_name):
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            temp_file_name = file_name + '.tmp'
+            with open(temp_file_name, 'wb') as f:
+                STATS.count('bytes.written', f.write(zlib.compress(data)))
+            os.replace(temp_file_name, file_name)
+        return digest
+
+    def _get(self, digest: str) -> Any:
+        with open(self._object_file_name(digest), 'rb') as f:
+            data = f.read()
+        STATS.count('bytes.read', len(data))
+        return json.loads(zlib.decompress(data).decode('utf-8'), object_pairs_hook=SortedDict)
+
+
 class Config:
     NetworkType = Dict[str, Any]
     NodeType = Dict[str, Any]
@@ -135,27 +790,42 @@ class Config:
 
     def __init__(self) -> None:
         self._conf = SortedDict[str, Any]()
-        self._conf_file: Optional[TextIO] = None
         self._conf_name: Optional[str] = None
-        self._writable = False
+        self._storage: Storage = TomlStorage()
+        self._tolerated_errors: Optional[Set[Tuple[str, ...]]] = None
 
     def __del__(self) -> None:
         try:
-            self._close_file()
+            self._storage.close()
         except Exception:
             pass
 
-    def load(self, conf_name: str) -> bool:
-        if conf_name.endswith('.conf'):
-            conf_name = conf_name[:-5]
-        try:
-            self._open_file(conf_name)
-        except FileNotFoundError:
+    # Commands that change the network load it writable, so that the lock is
+    # not upgraded later while another process is waiting for it as well
+    def load(self, conf_name: str, writable: bool = False) -> bool:
+        storage_type: Type[Storage] = TomlStorage
+        for i in STORAGE_TYPES.values():
+            if conf_name.endswith(i.extension):
+                conf_name = conf_name[:-len(i.extension)]
+                storage_type = i
+                break
+        else:
+            # Use whichever file exists, TOML for new networks
+            for i in STORAGE_TYPES.values():
+                if os.path.exists(conf_name + i.extension):
+                    storage_type = i
+                    break
+        self._storage.close()
+        self._storage = storage_type()
+        self._conf_name = conf_name
+        self._tolerated_errors = None
+
+        with STATS.timer('config.load'):
+            conf = self._storage.load(conf_name, writable)
+        if conf is None:
             self._conf = SortedDict()
-            self._conf_name = conf_name
             return False
-        assert self._conf_file is not None
-        self._conf = cast(SortedDict[str, Any], toml.load(self._conf_file, SortedDict))
+        self._conf = conf
         return True
 
     def save(self) -> None:
@@ -163,14 +833,53 @@ class Config:
             return
         elif self._conf_name is None:
             return
-        self._open_file(self._conf_name, writable=True)
-        assert self._conf_file is not None
-        data: str = toml.dumps(self._conf)
-        self._conf_file.truncate()
-        self._conf_file.write(data)
+        # Commands save once right after loading, errors that are already in
+        # the file then are tolerated, so that they can still be fixed
+        with STATS.timer('config.validate'):
+            errors = validate(self._conf)
+        if self._tolerated_errors is None:
+            self._tolerated_errors = set(i.key for i in errors)
+        else:
+            errors = [i for i in errors if i.key not in self._tolerated_errors]
+            if errors:
+                raise ConfigError(errors)
+        with STATS.timer('config.save'):
+            changed = self._storage.save(self._conf_name, self._conf)
+        # Snapshots are opt-in, they cost a pass over every node
+        if changed and self._conf.get('Network', {}).get('Snapshots', False):
+            with STATS.timer('snapshot.add'):
+                self.snapshot_store().add(self._conf)
+
+    def snapshot_store(self) -> SnapshotStore:
+        if self._conf_name is None:
+            raise ValueError('Config not loaded')
+        return SnapshotStore(self._conf_name)
+
+    def validate(self, warnings: Optional[List[str]] = None) -> 'List[ValidationError]':
+        return validate(self._conf, warnings)
+
+    # Tolerates the errors currently in the configuration when saving, as if
+    # it had been saved right after loading
+    def tolerate_errors(self) -> None:
+        self._tolerated_errors = set(i.key for i in validate(self._conf))
 
     def close(self) -> None:
-        self._close_file()
+        self._storage.close()
+
+    # Saves the configuration to another storage backend and switches to it
+    # Returns the file name of the previous storage, which is left in place
+    def convert(self, storage: Storage) -> str:
+        if self._conf_name is None:
+            raise ValueError('Config not loaded')
+        self.blacklist()
+        old_file_name = self._storage.file_name(self._conf_name)
+        storage.save(self._conf_name, self._conf)
+        self._storage.close()
+        self._storage = storage
+        return old_file_name
+
+    def storage(self) -> Storage:
+        return self._storage
 
     def network_name(self) -> str:
         if self._conf_name is None:
@@ -183,8 +892,9 @@ class Config:
             self._conf['Network']['AddressPoolIPv4'] = '192.168.{}.0/24'.format(random.randint(2, 255))
             self._conf['Network']['AddressPoolIPv6'] = '{:x}:{:x}:{:x}::/80'.format(random.randint(0xfd00, 0xfdff), random.randint(0x1000, 0xffff), random.randint(0x1000, 0xffff))
             self._conf['Network']['VxlanID'] = random.randint(1, 0xffffff)
-            # To make each UDP packet 1582 bytes
-            self._conf['Network']['VxlanMTU'] = 1500
+            # VxlanMTU is left unset, so that no UDP packet is fragmented
+            ## To make each UDP packet 1582 bytes
+            #self._conf['Network']['VxlanMTU'] = 1500
             ## To make each UDP packet 2048 bytes
             #self._conf['Network']['VxlanMTU'] = 1966
             self._conf['Network']['VxlanPort'] = 4789
@@ -204,44 +914,305 @@ class Config:
             self._conf['PeerBlacklist']['Blacklist'] = SortedSet((NamePair(i, j) for i, j in self._conf['PeerBlacklist']['Blacklist']))
         return cast(Config.BlacklistType, self._conf['PeerBlacklist']['Blacklist'])
 
-    def _close_file(self) -> None:
-        if self._conf_file is None:
-            return
-        fcntl.lockf(self._conf_file, fcntl.LOCK_UN)
-        self._conf_file.close()
-        self._conf_file = None
 
-    def _open_file(self, conf_name: str, writable: bool = False) -> None:
-        if self._conf_file is not None and self._conf_name == conf_name and self._writable >= writable:
-            self._conf_file.seek(0)
-            return
-        self._close_file()
-        if writable:
-            conf_file = open(conf_name + '.conf', 'w+')
+def peering_allowed(nodes: Config.NodesType, blacklist: Config.BlacklistType, node_name: str, peer_name: str) -> bool:
+    if NamePair(node_name, peer_name) in blacklist:
+        return False
+    # Nodes with a Peers list only peer with those, unless the other side lists them
+    # Nodes without one, such as those added later, still peer with everyone
+    node, peer = nodes[node_name], nodes[peer_name]
+    if 'Peers' in node and 'Peers' in peer:
+        return peer_name in node['Peers'] or node_name in peer['Peers']
+    return True
+
+
+DEFAULT_UNDERLAY_MTU = 1500
+# Outer IP header, UDP header, WireGuard data header and authentication tag
+WIREGUARD_OVERHEAD = {4: 20 + 8 + 16 + 16, 6: 40 + 8 + 16 + 16}
+# Link-local IPv4 header, UDP header, VXLAN header and inner Ethernet header
+VXLAN_OVERHEAD = 20 + 8 + 8 + 14
+
+
+def endpoint_family(endpoint: Optional[str]) -> Optional[int]:
+    if not endpoint:
+        return None
+    host = endpoint.rsplit(':', 1)[0].strip('[]')
+    try:
+        return ipaddress.ip_address(host).version
+    except ValueError:
+        return None
+
+
+def normalize_endpoint(endpoint: str, listen_port: int) -> str:
+    if endpoint.startswith('[') and endpoint.endswith(']'):
+        endpoint += ':' + str(listen_port)
+    elif ':' not in endpoint:
+        endpoint += ':' + str(listen_port)
+    elif endpoint.count(':') > 1 and not endpoint.startswith('['):
+        endpoint = '[' + endpoint + ']:' + str(listen_port)
+    return endpoint
+
+
+ENDPOINT_FAMILY_TAGS = {'ipv4': 4, 'ipv6': 6}
+
+
+def split_endpoint_tag(tagged_endpoint: str) -> Tuple[str, Optional[str]]:
+    # An endpoint is tagged with a site name or an address family, like
+    # 192.168.1.2:51820@rack1 or node1.example.com:51820@ipv6
+    endpoint, _, tag = tagged_endpoint.rpartition('@')
+    if not endpoint:
+        return tagged_endpoint, None
+    return endpoint, tag
+
+
+def node_endpoints(node: Config.NodeType) -> List[Tuple[str, Optional[str], Optional[int]]]:
+    endpoints: List[Tuple[str, Optional[str], Optional[int]]] = []
+    if node.get('Endpoint'):
+        endpoints.append((node['Endpoint'], None, endpoint_family(node['Endpoint'])))
+    for tagged_endpoint in node.get('Endpoints', []):
+        endpoint, tag = split_endpoint_tag(tagged_endpoint)
+        if tag in ENDPOINT_FAMILY_TAGS:
+            endpoints.append((endpoint, None, ENDPOINT_FAMILY_TAGS[tag]))
         else:
-            conf_file = open(conf_name + '.conf', 'r')
-        try:
+            endpoints.append((endpoint, tag, endpoint_family(endpoint)))
+    return endpoints
+
+
+def select_endpoint(node: Config.NodeType, peer: Config.NodeType) -> Optional[str]:
+    # Picks the endpoint of peer that node should use: a private address in the
+    # same site first, then a public one of an address family node also has
+    endpoints = node_endpoints(peer)
+    if not endpoints:
+        return None
+    site = node.get('Site')
+    families = {family for _, tag, family in node_endpoints(node) if tag is None and family is not None}
+
+    best: Optional[str] = None
+    best_rank = 3
+    for endpoint, tag, family in endpoints:
+        if tag is not None:
+            if tag != site:
+                continue
+            rank = 0
+        elif not families or family is None or family in families:
+            rank = 1
+        else:
+            rank = 2
+        if rank < best_rank:
+            best, best_rank = endpoint, rank
+    return best
+
+
+def path_family(node: Config.NodeType, peer: Config.NodeType) -> int:
+    families = {endpoint_family(select_endpoint(peer, node)), endpoint_family(select_endpoint(node, peer))}
+    # Unknown families are assumed to be IPv6, which has the larger header
+    if 6 in families or families == {None}:
+        return 6
+    return 4
+
+
+def path_vxlan_mtu(node: Config.NodeType, peer: Config.NodeType) -> int:
+    underlay_mtu = min(int(node.get('UnderlayMTU', DEFAULT_UNDERLAY_MTU)), int(peer.get('UnderlayMTU', DEFAULT_UNDERLAY_MTU)))
+    return underlay_mtu - WIREGUARD_OVERHEAD[path_family(node, peer)] - VXLAN_OVERHEAD
+
+
+# The largest VXLAN MTU of a segment (None for the network itself) that is not
+# fragmented on the path to any peer of the node in it, assuming IPv6 without peers
+def auto_vxlan_mtu(nodes: Config.NodesType, blacklist: Config.BlacklistType, node_name: str, segment_name: Optional[str]) -> int:
+    node = nodes[node_name]
+    return min((path_vxlan_mtu(node, peer) for peer_name, peer in nodes.items() if peer_name != node_name and (segment_name is None or segment_name in peer.get('Segments', [])) and peering_allowed(nodes, blacklist, node_name, peer_name)), default=int(node.get('UnderlayMTU', DEFAULT_UNDERLAY_MTU)) - WIREGUARD_OVERHEAD[6] - VXLAN_OVERHEAD)
+
+
+DEFAULT_PERSISTENT_KEEPALIVE = 25
+# PersistentKeepalive 0 or unset never sends keepalives, as in older versions,
+# this value sends them only where needed
+PERSISTENT_KEEPALIVE_AUTO = -1
+
+
+def keepalive_interval(node: Config.NodeType, peer: Config.NodeType) -> int:
+    # Keepalives from node only help peer reach node, when node is behind NAT or
+    # its address is unknown to others; public nodes never need to send them
+    interval = int(node.get('PersistentKeepalive', 0))
+    if interval == 0:
+        return 0
+    node_endpoint = select_endpoint(peer, node)
+    if not node.get('NAT', False) and node_endpoint:
+        return 0
+    # Neither side can start a handshake, so nothing would be kept alive
+    if not node_endpoint and not select_endpoint(node, peer):
+        return 0
+    return DEFAULT_PERSISTENT_KEEPALIVE if interval == PERSISTENT_KEEPALIVE_AUTO else interval
+
+
+def is_valid_segment_name(name: str) -> bool:
+    # Segment names are used as VXLAN interface names, and sysctl splits on dots
+    return 0 < len(name) <= 15 and all((c.isalnum() or c in '-_') for c in name)
+
+
+# An error found by validate, compared by key when deciding whether a save
+# introduces it, so that an error is not new just because its details changed,
+# like the node it collides with
+class ValidationError(str):
+    key: Tuple[str, ...]
+
+    def __new__(cls, message: str, *key: str) -> 'ValidationError':
+        error = super().__new__(cls, message)
+        error.key = key or (message, )
+        return error
+
+
+class ConfigError(ValueError):
+    def __init__(self, errors: List[str]) -> None:
+        super().__init__('\n'.join(errors))
+        self.errors = errors
+
+
+NETWORK_FIELDS = {'AddressPoolIPv4', 'AddressPoolIPv6', 'IPv6Allocation', 'Journal', 'Segments', 'Snapshots', 'VxlanID', 'VxlanMTU', 'VxlanPort'}
+NODE_FIELDS = {
+    'Address', 'AllowedIPs', 'Endpoint', 'Endpoints', 'FwMark', 'LinkLayerAddress', 'ListenPort', 'NAT', 'Peers',
+    'PersistentKeepalive', 'PostDown', 'PostUp', 'PreDown', 'PreUp', 'PrivateKey', 'SaveConfig', 'SegmentAddress',
+    'Segments', 'Site', 'UnderlayMTU', 'UPnP',
+}
+IPV4LL_NETWORK = ipaddress.IPv4Network('169.254.0.0/16')
+
+
+# Checks the whole configuration in one pass over the nodes, using indexes of
+# the values that must be unique, and returns every error found
+# Addresses outside of the pools are only warnings, since existing addresses are
+# not moved when a pool changes
+def validate(conf: Dict[str, Any], warnings: Optional[List[str]] = None) -> List[ValidationError]:
+    errors: List[ValidationError] = []
+
+    for key in conf:
+        if key not in ('Network', 'Node', 'PeerBlacklist'):
+            errors.append(ValidationError("Unknown section '{}'".format(key)))
+
+    network: Dict[str, Any] = conf.get('Network', {})
+    for key in network:
+        if key not in NETWORK_FIELDS:
+            errors.append(ValidationError("Network has unknown field '{}'".format(key)))
+
+    pools: Dict[int, Optional[Any]] = {4: None, 6: None}
+    for version, key in ((4, 'AddressPoolIPv4'), (6, 'AddressPoolIPv6')):
+        if key in network:
             try:
-                if writable:
-                    fcntl.lockf(conf_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                else:
-                    fcntl.lockf(conf_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
-            except OSError as e:
-                if e.errno in (errno.EACCES, errno.EAGAIN):
-                    print('The configuration file is being used by another process, waiting.', end='', file=sys.stderr, flush=True)
-                    if writable:
-                        fcntl.lockf(conf_file, fcntl.LOCK_EX)
-                    else:
-                        fcntl.lockf(conf_file, fcntl.LOCK_SH)
-                    print(file=sys.stderr, flush=True)
-                else:
-                    raise
-        except Exception as e:
-            conf_file.close()
-            raise
-        self._conf_file = conf_file
-        self._conf_name = conf_name
-        self._writable = writable
+                pool = ipaddress.ip_network(network[key], strict=False)
+            except ValueError:
+                errors.append(ValidationError("Network has invalid {} '{}'".format(key, network[key])))
+                continue
+            if pool.version != version:
+                errors.append(ValidationError("Network has {} '{}' of the wrong address family".format(key, network[key])))
+                continue
+            pools[version] = pool
+
+    if network.get('IPv6Allocation', 'pubkey') not in IPV6_ALLOCATION_MODES:
+        errors.append(ValidationError("Network has invalid IPv6Allocation '{}'".format(network['IPv6Allocation'])))
+
+    _validate_int(errors, 'Network', network, 'VxlanID', 0, 0xffffff)
+    _validate_int(errors, 'Network', network, 'VxlanMTU', 68, 65535)
+    _validate_int(errors, 'Network', network, 'VxlanPort', 0, 65535)
+
+    vxlan_ids = {network.get('VxlanID'): 'the network'}
+    segments: Dict[str, Any] = network.get('Segments', {})
+    for segment_name, segment in segments.items():
+        owner = "Segment '{}'".format(segment_name)
+        if not is_valid_segment_name(segment_name):
+            errors.append(ValidationError('{} has an invalid interface name'.format(owner)))
+        _validate_int(errors, owner, segment, 'VxlanID', 0, 0xffffff)
+        _validate_int(errors, owner, segment, 'VxlanMTU', 68, 65535)
+        if segment.get('VxlanID') in vxlan_ids:
+            errors.append(ValidationError('{} has the same VxlanID as {}'.format(owner, vxlan_ids[segment.get('VxlanID')]), owner, 'VxlanID'))
+        vxlan_ids[segment.get('VxlanID')] = owner.lower()
+
+    nodes: Dict[str, Dict[str, Any]] = conf.get('Node', {})
+    used_addresses: Dict[Any, str] = {}
+    used_allowed_ips: Dict[Any, str] = {}
+    used_private_keys: Dict[str, str] = {}
+
+    for node_name, node in nodes.items():
+        owner = "Node '{}'".format(node_name)
+        for key in node:
+            if key not in NODE_FIELDS:
+                errors.append(ValidationError("{} has unknown field '{}'".format(owner, key)))
+
+        private_key = node.get('PrivateKey')
+        if private_key:
+            try:
+                key_length = len(binascii.a2b_base64(private_key))
+            except (binascii.Error, TypeError):
+                key_length = 0
+            if key_length != 32:
+                errors.append(ValidationError('{} has a PrivateKey that is not a base64 encoded 32-byte key'.format(owner)))
+            elif private_key in used_private_keys:
+                errors.append(ValidationError('{} has the same PrivateKey as {}'.format(owner, used_private_keys[private_key]), owner, 'PrivateKey'))
+            else:
+                used_private_keys[private_key] = owner.lower()
+
+        _validate_int(errors, owner, node, 'ListenPort', 0, 65535)
+        _validate_int(errors, owner, node, 'FwMark', 0, 0xffffffff)
+        _validate_int(errors, owner, node, 'PersistentKeepalive', PERSISTENT_KEEPALIVE_AUTO, 65535)
+        _validate_int(errors, owner, node, 'UnderlayMTU', 1280, 65535)
+
+        for address in _validate_interfaces(errors, owner, node, 'Address'):
+            pool = pools[address.version]
+            if pool is not None and address.ip not in pool and warnings is not None:
+                warnings.append("{} has Address '{}' outside of the pool {}".format(owner, address, pool))
+            _validate_unique(errors, owner, 'Address', address.ip, used_addresses)
+
+        for address in _validate_interfaces(errors, owner, node, 'LinkLayerAddress'):
+            if address.ip not in IPV4LL_NETWORK:
+                errors.append(ValidationError("{} has LinkLayerAddress '{}' outside of {}".format(owner, address, IPV4LL_NETWORK)))
+            _validate_unique(errors, owner, 'LinkLayerAddress', address.ip, used_addresses)
+
+        for allowed_ip in _validate_interfaces(errors, owner, node, 'AllowedIPs'):
+            # WireGuard routes each network to a single peer
+            _validate_unique(errors, owner, 'AllowedIPs', allowed_ip.network, used_allowed_ips)
+
+        for endpoint in ([node['Endpoint']] if node.get('Endpoint') else []) + list(node.get('Endpoints', [])):
+            endpoint = split_endpoint_tag(endpoint)[0]
+            port = endpoint.rpartition(':')[2]
+            if not port.isdigit() or not 0 < int(port) <= 65535:
+                errors.append(ValidationError("{} has Endpoint '{}' without a valid port".format(owner, endpoint)))
+
+        for segment_name in node.get('Segments', []):
+            if segment_name not in segments:
+                errors.append(ValidationError("{} is a member of unknown segment '{}'".format(owner, segment_name)))
+
+        for peer_name in node.get('Peers', []):
+            if peer_name not in nodes:
+                errors.append(ValidationError("{} peers with unknown node '{}'".format(owner, peer_name)))
+
+    for pair in conf.get('PeerBlacklist', {}).get('Blacklist', []):
+        for node_name in pair:
+            if node_name not in nodes:
+                errors.append(ValidationError("Blacklist refers to unknown node '{}'".format(node_name)))
+
+    return errors
+
+
+def _validate_int(errors: List[ValidationError], owner: str, section: Dict[str, Any], key: str, minimum: int, maximum: int) -> None:
+    if key not in section:
+        return
+    value = section[key]
+    if not isinstance(value, int) or isinstance(value, bool) or not minimum <= value <= maximum:
+        errors.append(ValidationError('{} has {} {!r} outside of {}..{}'.format(owner, key, value, minimum, maximum)))
+
+
+def _validate_interfaces(errors: List[ValidationError], owner: str, node: Dict[str, Any], key: str) -> List[Any]:
+    interfaces: List[Any] = []
+    for value in node.get(key, []):
+        try:
+            interfaces.append(ipaddress.ip_interface(value))
+        except ValueError:
+            errors.append(ValidationError("{} has invalid {} '{}'".format(owner, key, value)))
+    return interfaces
+
+
+def _validate_unique(errors: List[ValidationError], owner: str, key: str, value: Any, used: Dict[Any, str]) -> None:
+    if value in used:
+        errors.append(ValidationError("{} has {} '{}' already used by {}".format(owner, key, value, used[value]), owner, key, str(value)))
+    else:
+        used[value] = owner.lower()
 
 
 def genpsk() -> bytes:
@@ -258,9 +1229,26 @@ def genkey() -> bytes:
 
 
 def pubkey(secret: bytes) -> bytes:
+    if STATS.enabled:
+        with STATS.timer('pubkey.scalarmult'):
+            return cast(bytes, nacl.bindings.crypto_scalarmult_base(secret))
     return cast(bytes, nacl.bindings.crypto_scalarmult_base(secret))
 
 
+def generate_pubkey(node: Config.NodeType) -> Optional[str]:
+    if 'PrivateKey' not in node:
+        return None
+    secret_base64: str = node['PrivateKey']
+    try:
+        secret: bytes = binascii.a2b_base64(secret_base64)
+    except binascii.Error:
+        return None
+    if len(secret) != 32:
+        return None
+
+    return binascii.b2a_base64(pubkey(secret), newline=False).decode('ascii')
+
+
 def generate_pubkey_macaddr(node: Config.NodeType) -> Optional[str]:
     if 'PrivateKey' not in node:
         return None
@@ -278,6 +1266,10 @@ def generate_pubkey_ipv6(network: Config.NetworkType, node: Config.NodeType) ->
         return None
     address_pool = ipaddress.IPv6Network(network['AddressPoolIPv6'], strict=False)
 
+    # Nodes that got an address from IPv6Allocator use it instead
+    if network.get('IPv6Allocation', 'pubkey') != 'pubkey' and pool_ipv6_offsets(address_pool, node):
+        return None
+
     if 'PrivateKey' not in node:
         return None
     secret_base64: str = node['PrivateKey']
@@ -289,3 +1281,160 @@ def generate_pubkey_ipv6(network: Config.NetworkType, node: Config.NodeType) ->
     ipv6 = ipaddress.IPv6Address(int(address_pool.network_address) | (int(host) & int(address_pool.hostmask)))
 
     return ipv6.compressed + '/' + str(address_pool.prefixlen)
+
+
+# Name of the WireGuard interface, the network may be given as a path to its configuration
+def interface_name(network_name: str) -> str:
+    return os.path.basename(network_name)
+
+
+# Device of the main VXLAN segment, named after the WireGuard interface
+def vxlan_device_name(interface: str) -> str:
+    return 'v' + interface
+
+
+# Addresses of a node on the main VXLAN segment, the static ones and the one derived from its key
+def vtep_addresses(network: Config.NetworkType, node: Config.NodeType) -> List[str]:
+    addresses = list(node.get('Address', []))
+    pubkey_ipv6 = generate_pubkey_ipv6(network, node)
+    if pubkey_ipv6:
+        addresses.append(pubkey_ipv6)
+    return addresses
+
+
+class VxlanSetup(NamedTuple):
+    # Creates the device, as ip subcommand without the leading 'ip' so that it also fits ip -batch files
+    link: str
+    # Shell commands to run once the device exists
+    tuning: List[str]
+    # Adds the addresses, as ip subcommands
+    addresses: List[str]
+
+
+def vxlan_setup(network: Config.NetworkType, node: Config.NodeType, device: str, vxlan_id: int, mtu: int, addresses: List[str]) -> VxlanSetup:
+    mac_address = generate_pubkey_macaddr(node)
+    mac_address_cmdline = 'address {} '.format(mac_address) if mac_address else ''
+    return VxlanSetup(
+        'link add {} {}mtu {} type vxlan id {} dstport {} ttl 1 noudpcsum'.format(device, mac_address_cmdline, mtu, vxlan_id, network.get('VxlanPort', 4789)),
+        [
+            'ethtool -K {} tx off rx off'.format(device),
+            'sysctl -w net.ipv4.conf.{0}.accept_redirects=0 net.ipv4.conf.{0}.send_redirects=0 net.ipv6.conf.{0}.accept_redirects=0'.format(device),
+        ],
+        ['address add {} dev {}'.format(address, device) for address in addresses],
+    )
+
+
+# Host parts of the static addresses of a node inside the pool
+def pool_ipv6_offsets(address_pool: ipaddress.IPv6Network, node: Config.NodeType) -> List[int]:
+    offsets = []
+    for address in node.get('Address', []):
+        try:
+            ip = ipaddress.ip_interface(address).ip
+        except ValueError:
+            continue
+        if ip.version == 6 and ip in address_pool:
+            offsets.append(int(ip) - int(address_pool.network_address))
+    return offsets
+
+
+IPV6_ALLOCATION_MODES = ('pubkey', 'sequential', 'hashed', 'random')
+
+
+# Assigns static addresses from AddressPoolIPv6, instead of deriving them from the public key
+# Used addresses are kept as a sorted list of host parts, where the first free address at or
+# after any point is found with a binary search over the runs of consecutive used addresses
+class IPv6Allocator:
+    # Random placement falls back to probing after this many collisions in a crowded pool
+    RANDOM_ATTEMPTS = 64
+
+    def __init__(self, address_pool: ipaddress.IPv6Network, used: Iterable[int] = ()) -> None:
+        self.address_pool = address_pool
+        # The all-zero host is the subnet-router anycast address, only usable in a /127 or /128
+        self.first = 1 if address_pool.prefixlen < 127 else 0
+        self.last = address_pool.num_addresses - 1
+        self._used = sorted(set(i for i in used if self.first <= i <= self.last))
+
+    # Indexes the static addresses of every node, and the derived ones of nodes without
+    @classmethod
+    def from_nodes(cls, network: Config.NetworkType, nodes: Config.NodesType) -> 'IPv6Allocator':
+        address_pool = ipaddress.IPv6Network(network['AddressPoolIPv6'], strict=False)
+        used: List[int] = []
+        for node in nodes.values():
+            offsets = pool_ipv6_offsets(address_pool, node)
+            if not offsets:
+                pubkey_ipv6 = generate_pubkey_ipv6(network, node)
+                if pubkey_ipv6 is not None:
+                    offsets = [int(ipaddress.IPv6Interface(pubkey_ipv6).ip) - int(address_pool.network_address)]
+            used += offsets
+        return cls(address_pool, used)
+
+    def __contains__(self, offset: int) -> bool:
+        index = bisect.bisect_left(self._used, offset)
+        return index < len(self._used) and self._used[index] == offset
+
+    def __len__(self) -> int:
+        return len(self._used)
+
+    def add(self, offset: int) -> None:
+        if self.first <= offset <= self.last and offset not in self:
+            bisect.insort(self._used, offset)
+
+    # Returns an address with the prefix length of the pool, or None if the pool is full
+    # Hashed placement puts the same node name at the same address in every network with this pool
+    def allocate(self, mode: str, node_name: str) -> Optional[str]:
+        with STATS.timer('ipv6.allocate'):
+            if mode == 'sequential':
+                offset = self._first_free(self.first)
+            elif mode == 'hashed':
+                digest = hashlib.sha256(node_name.encode('utf-8')).digest()
+                offset = self._first_free(self.first + int.from_bytes(digest[:16], 'big') % (self.last - self.first + 1))
+                if offset is None:
+                    offset = self._first_free(self.first)
+            elif mode == 'random':
+                offset = self._random_free()
+            else:
+                raise ValueError("Invalid IPv6 allocation mode '{}'".format(mode))
+            if offset is None:
+                return None
+            bisect.insort(self._used, offset)
+            return '{}/{}'.format(ipaddress.IPv6Address(int(self.address_pool.network_address) + offset).compressed, self.address_pool.prefixlen)
+
+    # Assigns addresses to many nodes at once, in the given order
+    def allocate_many(self, mode: str, node_names: Iterable[str]) -> Dict[str, Optional[str]]:
+        return {node_name: self.allocate(mode, node_name) for node_name in node_names}
+
+    def _first_free(self, start: int) -> Optional[int]:
+        used = self._used
+        begin = bisect.bisect_left(used, start)
+        # used[i] - (i - begin) only grows, and stays at start while the run from start is unbroken
+        low, high = begin, len(used)
+        while low < high:
+            middle = (low + high) // 2
+            if used[middle] - (middle - begin) > start:
+                high = middle
+            else:
+                low = middle + 1
+        offset = start + (low - begin)
+        return offset if offset <= self.last else None
+
+    def _random_free(self) -> Optional[int]:
+        if len(self._used) > self.last - self.first:
+            return None
+        for _ in range(self.RANDOM_ATTEMPTS):
+            offset = random.randint(self.first, self.last)
+            if offset not in self:
+                return offset
+        offset = self._first_free(random.randint(self.first, self.last))
+        return offset if offset is not None else self._first_free(self.first)
+
+
+# Picks static addresses for the given nodes, by default for every node still using the
+# address derived from its key; the caller adds them to the Address of each node
+def allocate_node_ipv6(network: Config.NetworkType, nodes: Config.NodesType, node_names: Optional[Iterable[str]] = None) -> Dict[str, Optional[str]]:
+    mode = network.get('IPv6Allocation', 'pubkey')
+    if mode == 'pubkey' or 'AddressPoolIPv6' not in network:
+        raise ValueError('Static IPv6 addresses need an AddressPoolIPv6 and an IPv6Allocation other than pubkey')
+    allocator = IPv6Allocator.from_nodes(network, nodes)
+    if node_names is None:
+        node_names = [i for i in nodes if not pool_ipv6_offsets(allocator.address_pool, nodes[i])]
+    return allocator.allocate_many(mode, node_names)
@@ -22,15 +22,45 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import cProfile
 import errno
 import importlib
 import nacl
+import os
 import sys
 import toml
 import typing
+from . import common
 
 
 def main(argv: typing.List[str]) -> int:
+    # Global options come before the subcommand, which is then called with them removed
+    stats = False
+    profile_file: typing.Optional[str] = None
+    lock_timeout = os.environ.get('VWGEN_LOCK_TIMEOUT')
+    while len(argv) >= 2 and argv[1] in ('--stats', '--profile', '--lock-timeout', '--no-wait'):
+        if argv[1] == '--stats':
+            stats = True
+            argv = argv[:1] + argv[2:]
+        elif argv[1] == '--no-wait':
+            lock_timeout = '0'
+            argv = argv[:1] + argv[2:]
+        elif len(argv) < 3:
+            print('vwgen: {} requires an argument'.format(argv[1]), file=sys.stderr)
+            return errno.EINVAL
+        elif argv[1] == '--profile':
+            profile_file = argv[2]
+            argv = argv[:1] + argv[3:]
+        else:
+            lock_timeout = argv[2]
+            argv = argv[:1] + argv[3:]
+    if lock_timeout:
+        try:
+            common.FileLock.timeout = float(lock_timeout)
+        except ValueError:
+            print("vwgen: Invalid lock timeout '{}'".format(lock_timeout), file=sys.stderr)
+            return errno.EINVAL
+
     if len(argv) < 2 or argv[1] == '--help':
         print_help(argv[0])
         return 0
@@ -40,21 +70,68 @@ def main(argv: typing.List[str]) -> int:
         print("Error: {}".format(e), file=sys.stderr)
         print("vwgen: Invalid command '{}'".format(argv[1]), file=sys.stderr)
         return errno.ENOENT
-    submodule.main(argv)
-    return 0
+
+    common.STATS.enabled = stats
+    profiler = cProfile.Profile() if profile_file is not None else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with common.STATS.timer('command'):
+            return run_command(submodule, argv)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        if stats:
+            print('vwgen: Statistics for {}'.format(argv[1]), file=sys.stderr)
+            for line in common.STATS.report():
+                print('  ' + line, file=sys.stderr)
+
+
+def run_command(submodule: typing.Any, argv: typing.List[str]) -> int:
+    # The exit status is the errno value returned by the command, see "Exit status" in Readme.md
+    try:
+        return submodule.main(argv)
+    except common.ConfigError as e:
+        for error in e.errors:
+            print('vwgen: {}'.format(error), file=sys.stderr)
+        print('vwgen: Configuration not saved', file=sys.stderr)
+        return errno.EINVAL
+    except common.LockTimeoutError as e:
+        print("vwgen: {}: '{}'".format(e.strerror, e.filename), file=sys.stderr)
+        return e.errno
 
 
 def print_help(program_name: str) -> None:
-    print('Usage vwgen <cmd> [<args>]')
+    print('Usage vwgen [--stats] [--profile <file>] [--lock-timeout <seconds> | --no-wait] <cmd> [<args>]')
+    print()
+    print('  --stats: Print timers and counters of expensive operations to stderr')
+    print('  --profile <file>: Write a cProfile dump, to be read with pstats')
+    print('  --lock-timeout <seconds>: Give up if another process holds the network for longer,')
+    print('                            defaults to $VWGEN_LOCK_TIMEOUT or waiting forever')
+    print('  --no-wait: Give up at once if another process holds the network')
     print()
     print('Available subcommands')
     print('  show: Shows the current configuration of the mesh network')
     print('  showconf: Generate a configuration file for a given node')
+    print('  shownetworkd: Generate systemd-networkd units for given nodes')
+    print("  showwg: Generate a configuration for 'wg setconf' and a separate setup script")
+    print('  showdelta: Generate a script to apply changes to a running node without restart')
+    print('  diff: List the configuration changes between two versions of a network by node')
+    print('  deploy: Install generated configurations on the nodes concurrently')
     print('  add: Add new nodes to the mesh network')
     print('  set: Change the configuration of nodes')
     print('  del: Delete nodes from the mesh network')
+    print('  validate: Check the configuration for errors')
+    print('  discover: Update node endpoints from wg show output collected from nodes')
+    print('  mtu: Compute the largest VXLAN MTU that avoids fragmentation')
+    print('  optimize: Select direct peers of each node from measured round-trip times')
     print('  blacklist: Manage peering blacklist between specified nodes')
+    print('  convert: Convert the network between TOML and SQLite storage')
+    print('  snapshot: List, show and restore earlier versions of the network')
     print('  zone: Generate BIND-style DNS zone records')
+    print('  nsupdate: Generate nsupdate script of DNS record changes since last commit')
+    print('  simulate: Report the commands a generated configuration runs on bring-up')
     print('  genkey: Generates a new private key and writes it to stdout')
     print('  genpsk: Generates a new preshared key and writes it to stdout')
     print('  pubkey: Reads a private key from stdin and writes a public key to stdout')
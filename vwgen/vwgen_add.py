@@ -22,12 +22,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import binascii
 import errno
-import ipaddress
-import random
 import sys
-from typing import Any, Dict, List, Optional, Set
+from typing import List, Optional, Tuple
+from . import api
 from . import common
 
 
@@ -36,53 +34,20 @@ def main(argv: List[str]) -> int:
     if len(argv) < 3 or argv[2] == '--help':
         print_usage()
         return 0
+    try:
+        options, node_names = parse_search_options(argv[3:])
+    except (IndexError, ValueError) as e:
+        print('vwgen: Invalid option: {}'.format(e), file=sys.stderr)
+        return errno.EINVAL
+
     network_name = argv[2]
     config = common.Config()
-    config.load(network_name)
+    config.load(network_name, writable=True)
     network = config.network()
     nodes = config.nodes()
-    blacklist = config.blacklist()
     config.save()
 
-    return_value = 0
-
-    for node_name in argv[3:]:
-        if node_name in nodes:
-            print("vwgen: Network '{}' already has node '{}'".format(network_name, node_name), file=sys.stderr)
-            return_value = return_value or errno.EEXIST
-            continue
-
-        node: Dict[str, Any] = common.SortedDict()
-        if 'AddressPoolIPv4' in network:
-            ipv4 = generate_random_ipv4(network, nodes)
-            if ipv4 is None:
-                print('vwgen: IPv4 address pool is full')
-                break
-            node['Address'] = [ipv4]
-        else:
-            node['Address'] = []
-
-        ipv4ll = generate_random_ipv4ll(nodes)
-        if ipv4ll is None:
-            print('vwgen: Link-layer address pool is full')
-            break
-
-        node['AllowedIPs'] = [ipv4ll + '/32']
-        node['Endpoint'] = None
-        node['FwMark'] = 0
-        node['LinkLayerAddress'] = [ipv4ll + '/16']
-        node['ListenPort'] = random.randint(32768, 60999)
-        node['PersistentKeepalive'] = 0
-        node['PrivateKey'] = binascii.b2a_base64(common.genkey(), newline=False).decode('ascii')
-        node['SaveConfig'] = False
-        node['UPnP'] = False
-
-        node['PreUp'] = []
-        node['PostUp'] = []
-        node['PreDown'] = []
-        node['PostDown'] = []
-
-        nodes[node_name] = node
+    return_value = api.add_nodes(config.network_name(), network, nodes, node_names, options)
 
     config.save()
     config.close()
@@ -90,55 +55,39 @@ def main(argv: List[str]) -> int:
 
 
 def print_usage() -> None:
-    print('Usage: vwgen add <network> <node> [<node> ...]')
-
-
-def generate_random_ipv4(network: common.Config.NetworkType, nodes: common.Config.NodesType) -> Optional[str]:
-
-    address_pool = ipaddress.IPv4Network(network['AddressPoolIPv4'], strict=False)
-
-    if address_pool.prefixlen < 31:
-        num_hosts = address_pool.num_addresses - 2
-    else:
-        num_hosts = address_pool.num_addresses
-
-    existing_addresses: Set[str] = set((str(j).split('/', 1)[0] for i in nodes.values() for j in i.get('Address', [])))
-
-    if len(existing_addresses) == num_hosts:
-        return None
-
-    while True:
-
-        if address_pool.prefixlen >= 32:
-            host = 0
-        elif address_pool.prefixlen == 31:
-            host = random.randint(0, 1)
+    print('Usage: vwgen add <network> [--mac-prefix <xx:xx...>] [--ipv6-prefix <ipv6/cidr>]')
+    print('                 [--workers <count>] [--attempts <count>] [--time <seconds>]')
+    print('                 <node> [<node> ...]')
+    print()
+    print('The MAC and IPv6 addresses of a node are derived from its public key. New keys')
+    print('are generated until these do not collide with existing nodes and, if given,')
+    print('start with --mac-prefix and lie in --ipv6-prefix, using several processes.')
+    print('The search stops after --attempts keys or --time seconds, 60 by default.')
+
+
+def parse_search_options(args: List[str]) -> Tuple[api.SearchOptions, List[str]]:
+    mac_prefix: Optional[str] = None
+    ipv6_prefix: Optional[str] = None
+    workers = 0
+    attempts = 0
+    seconds = 60.0
+
+    while args and args[0].startswith('--'):
+        if args[0] == '--mac-prefix':
+            mac_prefix = args[1]
+        elif args[0] == '--ipv6-prefix':
+            ipv6_prefix = args[1]
+        elif args[0] == '--workers':
+            workers = int(args[1])
+        elif args[0] == '--attempts':
+            attempts = int(args[1])
+        elif args[0] == '--time':
+            seconds = float(args[1])
         else:
-            host = random.randint(1, (0xffffffff >> address_pool.prefixlen) - 1)
-
-        ipv4 = ipaddress.IPv4Address(int(address_pool.network_address) | host).compressed
-
-        if ipv4 not in existing_addresses:
-            break
-
-    return ipv4 + '/' + str(address_pool.prefixlen)
-
-
-def generate_random_ipv4ll(nodes: common.Config.NodesType) -> Optional[str]:
-
-    existing_addresses: Set[str] = set((str(j).split('/', 1)[0] for i in nodes.values() for j in i.get('LinkLayerAddress', [])))
-
-    if len(existing_addresses) >= 0xa9feff00 - 0xa9fe0100:
-        return None
-
-    while True:
-
-        ipv4ll = ipaddress.IPv4Address(random.randint(0xa9fe0100, 0xa9fefeff)).compressed
-
-        if ipv4ll not in existing_addresses:
-            break
+            raise ValueError("unknown option '{}'".format(args[0]))
+        args = args[2:]
 
-    return ipv4ll
+    return api.search_options(mac_prefix, ipv6_prefix, workers, attempts, seconds), args
 
 
 if __name__ == '__main__':
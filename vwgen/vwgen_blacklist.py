@@ -38,7 +38,7 @@ def main(argv: List[str]) -> int:
         return 0
     network_name = argv[2]
     config = common.Config()
-    config.load(network_name)
+    config.load(network_name, writable=True)
     network = config.network()
     nodes = config.nodes()
     blacklist = config.blacklist()
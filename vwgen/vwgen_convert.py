@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import os
+import sys
+from typing import List
+from . import common
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) != 4 or argv[2] == '--help' or argv[3] not in common.STORAGE_TYPES:
+        print_usage()
+        return 0
+
+    network_name = argv[2]
+    storage_type = common.STORAGE_TYPES[argv[3]]
+    config = common.Config()
+
+    if not config.load(network_name):
+        print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+        return errno.ENOENT
+
+    if isinstance(config.storage(), storage_type):
+        print("vwgen: Network '{}' is already stored as {}".format(config.network_name(), argv[3]), file=sys.stderr)
+        return 0
+
+    storage = storage_type()
+    if os.path.exists(storage.file_name(config.network_name())):
+        print("vwgen: File '{}' already exists".format(storage.file_name(config.network_name())), file=sys.stderr)
+        return errno.EEXIST
+
+    network_name = config.network_name()
+    old_storage = config.storage()
+    old_file_name = config.convert(storage)
+    # Otherwise both files exist and the old one would keep being used
+    os.replace(old_file_name, old_file_name + '.bak')
+
+    config.close()
+
+    if isinstance(old_storage, common.TomlStorage):
+        # The journal is already part of the converted network, it is kept with the
+        # old file so that both can be restored together
+        journal_file_name = old_storage.journal_file_name(network_name)
+        if os.path.exists(journal_file_name):
+            os.replace(journal_file_name, journal_file_name + '.bak')
+        try:
+            os.remove(old_storage.lock_file_name(network_name))
+        except FileNotFoundError:
+            pass
+
+    return 0
+
+
+def print_usage() -> None:
+    print('Usage: vwgen convert <network> <toml | sqlite>')
+    print()
+    print('Converts the network to another storage format. The previous file and its')
+    print('journal are kept with a .bak suffix. New networks are created as TOML unless')
+    print("the network name passed to 'vwgen add' ends with '.db'.")
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
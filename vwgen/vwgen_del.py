@@ -39,7 +39,7 @@ def main(argv: List[str]) -> int:
     network_name = argv[2]
     config = common.Config()
 
-    if not config.load(network_name):
+    if not config.load(network_name, writable=True):
         print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
         return errno.ENOENT
 
@@ -61,6 +61,10 @@ def main(argv: List[str]) -> int:
             if node_name in i:
                 blacklist.remove(i)
 
+        for i in nodes.values():
+            if node_name in i.get('Peers', []):
+                i['Peers'].remove(node_name)
+
     config.save()
     config.close()
     return return_value
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import errno
+import io
+import os
+import shlex
+import sys
+import tarfile
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from . import api
+from . import common
+
+
+class DeployError(Exception):
+    pass
+
+
+class Deployment(NamedTuple):
+    node_name: str
+    host: str
+    hub: bool
+    # File contents by path on the host
+    files: Dict[str, str]
+    # Shell command run on the host after the files are in place
+    command: Optional[str]
+
+
+class Result(NamedTuple):
+    node_name: str
+    error: Optional[str]
+    attempts: int
+    seconds: float
+
+
+class Transport:
+    async def push(self, deployment: Deployment) -> None:
+        raise NotImplementedError
+
+
+class SshTransport(Transport):
+    # Unpacks the files and runs the command in a single ssh round trip, with
+    # the files as a tar stream on stdin so that private keys never show up in argv
+    async def push(self, deployment: Deployment) -> None:
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for path, content in deployment.files.items():
+                data = content.encode('utf-8')
+                info = tarfile.TarInfo(path.lstrip('/'))
+                info.size = len(data)
+                info.mode = 0o600
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+
+        script = 'umask 077 && tar -x -o -f - -C /'
+        if deployment.command:
+            script += ' && ' + deployment.command
+
+        process = await asyncio.create_subprocess_exec(
+            'ssh', '-o', 'BatchMode=yes', deployment.host, script,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await process.communicate(archive.getvalue())
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            raise DeployError(stderr.decode('utf-8', 'replace').strip() or 'ssh exited with status {}'.format(process.returncode))
+
+
+class LocalTransport(Transport):
+    # Stands in for the hosts with <directory>/<node>/, for testing without a network
+    def __init__(self, directory: str) -> None:
+        self._directory = directory
+
+    async def push(self, deployment: Deployment) -> None:
+        node_dir = os.path.join(self._directory, deployment.node_name)
+        os.makedirs(node_dir, exist_ok=True)
+        for path, content in deployment.files.items():
+            fd = os.open(os.path.join(node_dir, os.path.basename(path)), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, 'w') as f:
+                f.write(content)
+        if deployment.command:
+            with open(os.path.join(node_dir, 'commands.sh'), 'a') as f:
+                f.write(deployment.command + '\n')
+
+
+class Options(NamedTuple):
+    transport: Transport
+    host_template: str
+    concurrency: int
+    timeout: float
+    retries: int
+    batch_size: int
+    hubs: Optional[List[str]]
+    hub_quorum: Optional[int]
+    restart: bool
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) < 3 or argv[2] == '--help':
+        print_usage()
+        return 0
+
+    try:
+        options, args = parse_options(argv[2:])
+    except (IndexError, ValueError) as e:
+        print('vwgen: Invalid option: {}'.format(e), file=sys.stderr)
+        return errno.EINVAL
+    if not args:
+        print_usage()
+        return errno.EINVAL
+
+    network_name, node_names = args[0], args[1:]
+    config = common.Config()
+
+    if not config.load(network_name):
+        print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+        return errno.ENOENT
+
+    network = config.network()
+    nodes = config.nodes()
+    blacklist = config.blacklist()
+
+    for node_name in node_names:
+        if node_name not in nodes:
+            print("vwgen: Network '{}' does not have node '{}'".format(config.network_name(), node_name), file=sys.stderr)
+            return errno.ENOENT
+
+    # Render everything before connecting anywhere, and do not hold the lock meanwhile
+    deployments = render_deployments(config.network_name(), network, nodes, blacklist, node_names or list(nodes), options)
+    config.close()
+
+    batches = plan_batches(deployments, options)
+    results = asyncio.run(deploy(batches, options))
+
+    failed = [i for i in results if i.error is not None]
+    print('{} of {} nodes deployed, {} failed, {} not attempted'.format(len(results) - len(failed), len(deployments), len(failed), len(deployments) - len(results)))
+    return errno.EIO if failed or len(results) != len(deployments) else 0
+
+
+def print_usage() -> None:
+    print('Usage: vwgen deploy [--transport <ssh | local:<directory>>] [--host <template>]')
+    print('                    [--concurrency <count>] [--timeout <seconds>] [--retries <count>]')
+    print('                    [--batch-size <count>] [--hubs <node>[,<node>...]] [--hub-quorum <count>]')
+    print('                    [--no-restart] <network> [<node> ...]')
+    print()
+    print('Installs the configuration of the given nodes, or all nodes, as')
+    print('/etc/wireguard/<network>.conf and restarts wg-quick@<network>, on up to')
+    print('--concurrency hosts at a time, 16 by default. --host is the ssh destination,')
+    print("'{name}' by default, where {name} is the node name and {endpoint} the host of")
+    print('its endpoint. A host is tried --retries more times, 2 by default, if it fails')
+    print('or takes longer than --timeout seconds, 60 by default.')
+    print()
+    print('Nodes are deployed in batches of --batch-size, all at once by default. Each')
+    print('batch restarts at most as many hubs as can be down while --hub-quorum of them,')
+    print('a majority by default, stay up. Hubs are the --hubs nodes, or nodes with an')
+    print('endpoint that are not behind NAT. The rollout stops after a batch that failed.')
+    print()
+    print("The local transport writes the files of each node to <directory>/<node>/")
+    print('instead, for testing without a network.')
+
+
+def parse_options(args: List[str]) -> Tuple[Options, List[str]]:
+    transport: Transport = SshTransport()
+    host_template = '{name}'
+    concurrency = 16
+    timeout = 60.0
+    retries = 2
+    batch_size = 0
+    hubs: Optional[List[str]] = None
+    hub_quorum: Optional[int] = None
+    restart = True
+
+    while args and args[0].startswith('--'):
+        if args[0] == '--no-restart':
+            restart = False
+            args = args[1:]
+            continue
+        if args[0] == '--transport':
+            if args[1] == 'ssh':
+                transport = SshTransport()
+            elif args[1].startswith('local:'):
+                transport = LocalTransport(args[1][len('local:'):])
+            else:
+                raise ValueError("unknown transport '{}'".format(args[1]))
+        elif args[0] == '--host':
+            host_template = args[1]
+        elif args[0] == '--concurrency':
+            concurrency = max(int(args[1]), 1)
+        elif args[0] == '--timeout':
+            timeout = float(args[1])
+        elif args[0] == '--retries':
+            retries = max(int(args[1]), 0)
+        elif args[0] == '--batch-size':
+            batch_size = max(int(args[1]), 0)
+        elif args[0] == '--hubs':
+            hubs = [i for i in map(str.strip, args[1].split(',')) if i]
+        elif args[0] == '--hub-quorum':
+            hub_quorum = int(args[1])
+        else:
+            raise ValueError("unknown option '{}'".format(args[0]))
+        args = args[2:]
+
+    return Options(transport, host_template, concurrency, timeout, retries, batch_size, hubs, hub_quorum, restart), args
+
+
+def render_deployments(network_name: str, network: common.Config.NetworkType, nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_names: List[str], options: Options) -> List[Deployment]:
+    deployments: List[Deployment] = []
+    interface = common.interface_name(network_name)
+    for node_name in node_names:
+        node = nodes[node_name]
+        endpoint = node.get('Endpoint') or ''
+        host = options.host_template.format(name=node_name, endpoint=endpoint.rsplit(':', 1)[0].strip('[]') or node_name)
+        if options.hubs is not None:
+            hub = node_name in options.hubs
+        else:
+            hub = bool(node.get('Endpoint')) and not node.get('NAT', False)
+        files = {'/etc/wireguard/{}.conf'.format(interface): api.render_wg_quick(network_name, network, nodes, blacklist, node_name)}
+        command = 'systemctl enable wg-quick@{0} && systemctl restart wg-quick@{0}'.format(shlex.quote(interface)) if options.restart else None
+        deployments.append(Deployment(node_name, host, hub, files, command))
+    return deployments
+
+
+def plan_batches(deployments: List[Deployment], options: Options) -> List[List[Deployment]]:
+    hub_count = sum(1 for i in deployments if i.hub)
+    quorum = options.hub_quorum if options.hub_quorum is not None else hub_count // 2 + 1
+    # At least one hub has to go down at a time to be updated at all
+    hubs_per_batch = max(hub_count - quorum, 1)
+    batch_size = options.batch_size or len(deployments)
+
+    hubs = [i for i in deployments if i.hub]
+    others = [i for i in deployments if not i.hub]
+    batches: List[List[Deployment]] = []
+    while hubs or others:
+        batch = hubs[:min(hubs_per_batch, batch_size)]
+        hubs = hubs[len(batch):]
+        free = batch_size - len(batch)
+        batch += others[:free]
+        others = others[free:]
+        batches.append(batch)
+    return batches
+
+
+async def deploy(batches: List[List[Deployment]], options: Options) -> List[Result]:
+    semaphore = asyncio.Semaphore(options.concurrency)
+    results: List[Result] = []
+
+    for batch_number, batch in enumerate(batches, 1):
+        if len(batches) > 1:
+            print('batch {} of {}: {}'.format(batch_number, len(batches), ', '.join(i.node_name for i in batch)))
+        batch_results = await asyncio.gather(*(deploy_node(i, options, semaphore) for i in batch))
+        results += batch_results
+        if any(i.error is not None for i in batch_results):
+            if batch_number != len(batches):
+                print('vwgen: Stopping the rollout after failures in batch {}'.format(batch_number), file=sys.stderr)
+            break
+
+    return results
+
+
+async def deploy_node(deployment: Deployment, options: Options, semaphore: asyncio.Semaphore) -> Result:
+    async with semaphore:
+        start_time = time.monotonic()
+        error: Optional[str] = None
+        for attempt in range(1, options.retries + 2):
+            try:
+                await asyncio.wait_for(options.transport.push(deployment), options.timeout)
+                error = None
+            except asyncio.TimeoutError:
+                error = 'timed out after {:.0f}s'.format(options.timeout)
+            except (DeployError, OSError) as e:
+                error = str(e)
+            if error is None or attempt == options.retries + 1:
+                break
+            await asyncio.sleep(min(2 ** (attempt - 1), 30))
+
+        seconds = time.monotonic() - start_time
+        if error is None:
+            print('{}: deployed to {} in {:.1f}s'.format(deployment.node_name, deployment.host, seconds))
+        else:
+            print('{}: failed after {} attempts: {}'.format(deployment.node_name, attempt, error), file=sys.stderr)
+        return Result(deployment.node_name, error, attempt, seconds)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import ipaddress
+import json
+import sys
+from typing import Any, Dict, List, Optional, Set, Tuple
+from . import api
+from . import common
+
+
+# Changes of one node, by field, with the old and new value; peers map to
+# 'added', 'removed' or changes by field of the Peer record
+NodeChanges = Dict[str, Any]
+
+# Fields of the own interface whose values are secret
+SECRET_FIELDS = {'private_key'}
+
+
+def main(argv: List[str]) -> int:
+    args = argv[2:]
+    output_json = False
+    if args and args[0] == '--json':
+        output_json = True
+        args = args[1:]
+
+    if len(args) != 2 or args[0] == '--help':
+        print_usage()
+        return 0
+
+    old_config = common.Config()
+    config = common.Config()
+
+    for i, network_name in ((old_config, args[0]), (config, args[1])):
+        if not i.load(network_name):
+            print("vwgen: Unable to find configuration file '{}'".format(network_name), file=sys.stderr)
+            return errno.ENOENT
+
+    network_changes, node_changes = diff_networks(
+        old_config.network(), old_config.nodes(), old_config.blacklist(),
+        config.network(), config.nodes(), config.blacklist(),
+    )
+
+    old_config.close()
+    config.close()
+
+    if output_json:
+        print(json.dumps({'network': network_changes, 'nodes': node_changes}, indent=2, sort_keys=True))
+    else:
+        print_changes(network_changes, node_changes)
+    return 0
+
+
+def print_usage() -> None:
+    print('Usage: vwgen diff [--json] <old network> <network>')
+    print()
+    print('Lists the changes between two versions of a network by node, as they would')
+    print('appear in the generated configurations: interface settings, and peers that')
+    print('are added, removed or changed. Only nodes that change or peer with a changed')
+    print('node are compared, so small changes to large networks are fast.')
+
+
+def diff_networks(old_network: common.Config.NetworkType, old_nodes: common.Config.NodesType, old_blacklist: common.Config.BlacklistType, network: common.Config.NetworkType, nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType) -> Tuple[Dict[str, List[Any]], Dict[str, NodeChanges]]:
+    network_changes = diff_fields(old_network, network)
+    old_names, names = set(old_nodes), set(nodes)
+
+    # Nodes whose own values changed, every pair involving one of them is compared
+    changed_nodes: Set[str] = set()
+    for node_name in old_names | names:
+        if old_nodes.get(node_name) != nodes.get(node_name):
+            changed_nodes.add(node_name)
+
+    # Blacklisting only affects the two nodes of each pair
+    pairs: Set[Tuple[str, str]] = set()
+    for node_name, peer_name in set(map(tuple, old_blacklist)) ^ set(map(tuple, blacklist)):
+        pairs.add((node_name, peer_name))
+        pairs.add((peer_name, node_name))
+    for node_name in changed_nodes:
+        for peer_name in old_names | names:
+            if peer_name != node_name:
+                pairs.add((node_name, peer_name))
+                pairs.add((peer_name, node_name))
+
+    node_changes: Dict[str, NodeChanges] = {}
+
+    for node_name in old_names - names:
+        node_changes[node_name] = {'status': 'removed'}
+    for node_name in names - old_names:
+        node_changes[node_name] = {'status': 'added'}
+
+    # Network settings are part of every interface
+    for node_name in (names & old_names if network_changes else changed_nodes & old_names & names):
+        changes = diff_fields(interface_fields(old_network, old_nodes, old_blacklist, node_name), interface_fields(network, nodes, blacklist, node_name))
+        if changes:
+            node_changes.setdefault(node_name, {'status': 'changed'})['interface'] = changes
+
+    old_public_keys = PublicKeyCache(old_nodes)
+    public_keys = PublicKeyCache(nodes)
+    for node_name, peer_name in pairs:
+        if node_name not in old_nodes or node_name not in nodes:
+            continue
+        # Public keys of unchanged peers are the same on both sides, skip deriving them
+        derive_key = peer_name in changed_nodes
+        old_peer = peer_fields(old_nodes, old_blacklist, node_name, peer_name, old_public_keys if derive_key else None)
+        peer = peer_fields(nodes, blacklist, node_name, peer_name, public_keys if derive_key else None)
+        if old_peer == peer:
+            continue
+        if old_peer is None:
+            change: Any = 'added'
+        elif peer is None:
+            change = 'removed'
+        else:
+            change = diff_fields(old_peer, peer)
+        node_changes.setdefault(node_name, {'status': 'changed'}).setdefault('peers', {})[peer_name] = change
+
+    return network_changes, node_changes
+
+
+def diff_fields(old_values: Dict[str, Any], values: Dict[str, Any]) -> Dict[str, List[Any]]:
+    changes: Dict[str, List[Any]] = {}
+    for key in sorted(set(old_values) | set(values)):
+        if old_values.get(key) != values.get(key):
+            if key in SECRET_FIELDS:
+                changes[key] = ['(secret)', '(secret)']
+            else:
+                changes[key] = [old_values.get(key), values.get(key)]
+    return changes
+
+
+def interface_fields(network: common.Config.NetworkType, nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_name: str) -> Dict[str, Any]:
+    node = nodes[node_name]
+    addresses: List[str] = list(node.get('Address', []))
+    pubkey_ipv6 = common.generate_pubkey_ipv6(network, node)
+    if pubkey_ipv6:
+        addresses.append(pubkey_ipv6)
+
+    segments = api.generate_segments(network, nodes, blacklist, node_name, addresses)
+    fields = {
+        'private_key': node.get('PrivateKey'),
+        'listen_port': node.get('ListenPort', 0),
+        'fwmark': node.get('FwMark', 0),
+        'link_layer_addresses': list(node.get('LinkLayerAddress', [])),
+        'mac_address': common.generate_pubkey_macaddr(node),
+        'vxlan_mtu': segments[0].mtu,
+        'vxlan_port': network.get('VxlanPort', 4789),
+        'addresses': addresses,
+        'vxlan_id': network.get('VxlanID', 0),
+        'segments': ['{}:{}'.format(segment.name, segment.vxlan_id) for segment in segments[1:]],
+        'save_config': node.get('SaveConfig', False),
+        'upnp': node.get('UPnP', False),
+    }
+    for segment in segments[1:]:
+        fields['segment_{}_addresses'.format(segment.name)] = segment.addresses
+        fields['segment_{}_mtu'.format(segment.name)] = segment.mtu
+    for key in ('PreUp', 'PostUp', 'PreDown', 'PostDown'):
+        fields[key.lower().replace('up', '_up').replace('down', '_down')] = list(node.get(key, []))
+
+    if 'AddressPoolIPv4' in network:
+        pool = ipaddress.IPv4Network(network['AddressPoolIPv4'], strict=False)
+        fields['addresses_outside_pool'] = [i for i in node.get('Address', []) if ipaddress.ip_interface(i).version == 4 and ipaddress.ip_interface(i).ip not in pool]
+    return fields
+
+
+class PublicKeyCache(Dict[str, Optional[str]]):
+    def __init__(self, nodes: common.Config.NodesType) -> None:
+        super().__init__()
+        self._nodes = nodes
+
+    def __missing__(self, node_name: str) -> Optional[str]:
+        public_key = common.generate_pubkey(self._nodes[node_name])
+        self[node_name] = public_key
+        return public_key
+
+
+def peer_fields(nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_name: str, peer_name: str, public_keys: Optional[PublicKeyCache]) -> Optional[Dict[str, Any]]:
+    if peer_name not in nodes:
+        return None
+    peer = api.generate_peer(nodes, blacklist, node_name, peer_name, public_keys[peer_name] if public_keys is not None else None)
+    if peer.blacklisted:
+        return None
+    fields = peer._asdict()
+    del fields['name'], fields['blacklisted']
+    return fields
+
+
+def print_changes(network_changes: Dict[str, List[Any]], node_changes: Dict[str, NodeChanges]) -> None:
+    for key, (old_value, value) in network_changes.items():
+        print('network: {} {} -> {}'.format(key, format_value(old_value), format_value(value)))
+
+    for node_name, changes in sorted(node_changes.items()):
+        if changes['status'] != 'changed':
+            print('node {}: {}'.format(node_name, changes['status']))
+            continue
+        print('node {}:'.format(node_name))
+        for key, (old_value, value) in changes.get('interface', {}).items():
+            print('  {} {} -> {}'.format(key.replace('_', ' '), format_value(old_value), format_value(value)))
+        for peer_name, change in sorted(changes.get('peers', {}).items()):
+            if isinstance(change, str):
+                print('  peer {} {}'.format(peer_name, change))
+                continue
+            print('  peer {}: {}'.format(peer_name, ', '.join('{} {} -> {}'.format(key.replace('_', ' '), format_value(old_value), format_value(value)) for key, (old_value, value) in change.items())))
+
+    if not network_changes and not node_changes:
+        print('no changes')
+
+
+def format_value(value: Any) -> str:
+    if value is None or value == []:
+        return '(none)'
+    if isinstance(value, list):
+        return ','.join(map(format_value, value))
+    return str(value)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
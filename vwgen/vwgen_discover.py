@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import sys
+from typing import Dict, List, TextIO, Tuple
+from . import common
+from . import vwgen_showwg
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) < 3 or argv[2] == '--help':
+        print_usage()
+        return 0
+
+    network_name = argv[2]
+
+    # Read everything before taking the lock, input may come from slow pipes
+    observations: Dict[str, Tuple[int, str]] = {}
+    for file_name in argv[3:] or ['-']:
+        if file_name == '-':
+            collect_endpoints(sys.stdin, observations)
+            continue
+        try:
+            with open(file_name, 'r') as f:
+                collect_endpoints(f, observations)
+        except FileNotFoundError:
+            print("vwgen: Unable to find file '{}'".format(file_name), file=sys.stderr)
+            return errno.ENOENT
+
+    config = common.Config()
+
+    if not config.load(network_name, writable=True):
+        print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+        return errno.ENOENT
+
+    network = config.network()
+    nodes = config.nodes()
+    blacklist = config.blacklist()
+    config.save()
+
+    pubkey_index: Dict[str, str] = {}
+    for node_name, node in nodes.items():
+        public_key = common.generate_pubkey(node)
+        if public_key:
+            pubkey_index[public_key] = node_name
+
+    for public_key, (latest_handshake, endpoint) in observations.items():
+        if public_key not in pubkey_index:
+            continue
+        node_name = pubkey_index[public_key]
+        node = nodes[node_name]
+        # A static endpoint is kept, discovered ones belong to nodes behind NAT
+        if (node.get('Endpoint') or node.get('Endpoints')) and not node.get('NAT', False):
+            continue
+        node['NAT'] = True
+        if node.get('Endpoint') == endpoint:
+            continue
+        print('{}: {} -> {}'.format(node_name, node.get('Endpoint') or '(none)', endpoint))
+        node['Endpoint'] = endpoint
+
+    config.save()
+    config.close()
+    return 0
+
+
+def print_usage() -> None:
+    print('Usage: vwgen discover <network> [<file> ...]')
+    print()
+    print("Reads the output of 'wg show <interface> dump', 'wg show all dump' or")
+    print("'wg show <interface> endpoints' collected from any number of nodes, from files")
+    print('or stdin, and updates the endpoint of each node without a static one to the')
+    print('most recently seen one. These nodes are marked as behind NAT.')
+
+
+def collect_endpoints(f: TextIO, observations: Dict[str, Tuple[int, str]]) -> None:
+    dump_lines: List[str] = []
+    for line in f:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) in (2, 3):
+            # wg show <interface> endpoints, or wg show all endpoints with the
+            # interface name in front, which have no handshake time
+            observe(observations, fields[-2], fields[-1], 0)
+        else:
+            dump_lines.append(line)
+
+    for interface in vwgen_showwg.parse_wg_dump(dump_lines):
+        for public_key, peer in interface.peers.items():
+            if peer.endpoint:
+                observe(observations, public_key, peer.endpoint, peer.latest_handshake)
+
+
+def observe(observations: Dict[str, Tuple[int, str]], public_key: str, endpoint: str, latest_handshake: int) -> None:
+    if endpoint == '(none)' or not endpoint:
+        return
+    if public_key not in observations or observations[public_key][0] <= latest_handshake:
+        observations[public_key] = (latest_handshake, endpoint)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
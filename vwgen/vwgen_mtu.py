@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import sys
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from . import common
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) not in (3, 4) or argv[2] == '--help' or (len(argv) == 4 and argv[3] != 'apply'):
+        print_usage()
+        return 0
+
+    network_name = argv[2]
+    apply = len(argv) == 4
+    config = common.Config()
+
+    if not config.load(network_name, writable=apply):
+        print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+        return errno.ENOENT
+
+    network = config.network()
+    nodes = config.nodes()
+    blacklist = config.blacklist()
+    segments = network.get('Segments', {})
+
+    safe_mtus = plan_vxlan_mtu(nodes, blacklist, nodes)
+    # Without a configured VXLAN MTU, each node already uses its safe value
+    vxlan_mtu: Optional[int] = int(network['VxlanMTU']) if 'VxlanMTU' in network else None
+
+    for node_name, node in nodes.items():
+        if node_name not in safe_mtus:
+            continue
+        print('{}: underlay mtu {}, vxlan mtu {} safe{}'.format(node_name, node.get('UnderlayMTU', common.DEFAULT_UNDERLAY_MTU), safe_mtus[node_name], ', fragmenting' if vxlan_mtu is not None and vxlan_mtu > safe_mtus[node_name] else ''))
+
+    if not safe_mtus:
+        config.close()
+        return 0
+
+    # Each segment only runs between its members, so it may allow a larger MTU than the whole network
+    planned: Dict[Optional[str], Tuple[Optional[int], int]] = {None: (vxlan_mtu, min(safe_mtus.values()))}
+    print('network {}: vxlan mtu {} configured, {} safe on all paths'.format(config.network_name(), 'auto' if vxlan_mtu is None else vxlan_mtu, planned[None][1]))
+    for segment_name, segment in segments.items():
+        segment_mtus = plan_vxlan_mtu(nodes, blacklist, [i for i, node in nodes.items() if segment_name in node.get('Segments', [])])
+        if not segment_mtus:
+            continue
+        segment_mtu = segment.get('VxlanMTU', vxlan_mtu)
+        planned[segment_name] = (None if segment_mtu is None else int(segment_mtu), min(segment_mtus.values()))
+        print('segment {}: vxlan mtu {} configured, {} safe on all paths between its members'.format(segment_name, 'auto' if segment_mtu is None else segment_mtu, planned[segment_name][1]))
+
+    if apply:
+        config.save()
+        network['VxlanMTU'] = planned[None][1]
+        for segment_name, (_, safe_mtu) in planned.items():
+            if segment_name is not None:
+                segments[segment_name]['VxlanMTU'] = safe_mtu
+        config.save()
+    elif any(configured_mtu is not None and configured_mtu > safe_mtu for configured_mtu, safe_mtu in planned.values()):
+        print("vwgen: VXLAN MTU will be fragmented on some paths, use 'vwgen mtu {0} apply' to set the safe values, or 'vwgen set {0} vxlan-mtu auto' to let each node use its own".format(config.network_name()), file=sys.stderr)
+
+    config.close()
+    return 0
+
+
+def print_usage() -> None:
+    print('Usage: vwgen mtu <network> [apply]')
+    print()
+    print('Computes the largest VXLAN MTU that is not fragmented on the path to any peer')
+    print("of each node, from the 'underlay-mtu' of nodes and the endpoints they use to")
+    print('reach each other. The same is computed for each segment among its members.')
+    print('Without a configured VXLAN MTU, which is the default, every node already uses')
+    print("the value safe on its own paths. 'apply' sets the VXLAN MTU of the network and")
+    print('of each segment to the value safe on all of their paths instead.')
+
+
+def plan_vxlan_mtu(nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, members: Iterable[str]) -> Dict[str, int]:
+    members = list(members)
+    # Blacklists and Peers lists leave out some pairs, which are checked one by one
+    if blacklist or any('Peers' in nodes[i] for i in members):
+        safe_mtus: Dict[str, int] = {}
+        for index, node_name in enumerate(members):
+            for peer_name in members[index + 1:]:
+                if not common.peering_allowed(nodes, blacklist, node_name, peer_name):
+                    continue
+                mtu = common.path_vxlan_mtu(nodes[node_name], nodes[peer_name])
+                safe_mtus[node_name] = min(safe_mtus.get(node_name, mtu), mtu)
+                safe_mtus[peer_name] = min(safe_mtus.get(peer_name, mtu), mtu)
+        return safe_mtus
+
+    # Otherwise every node peers with every other, and common.path_vxlan_mtu
+    # only depends on the site, the tags and address families of the endpoints
+    # and the underlay MTU of both nodes, so each combination of those is paired
+    # once instead of every pair of nodes
+    groups: Dict[Tuple[Any, ...], List[str]] = {}
+    for node_name in members:
+        node = nodes[node_name]
+        key = (node.get('Site'), tuple((tag, family) for _, tag, family in common.node_endpoints(node)), int(node.get('UnderlayMTU', common.DEFAULT_UNDERLAY_MTU)))
+        groups.setdefault(key, []).append(node_name)
+
+    group_mtus: Dict[Tuple[Any, ...], int] = {}
+    keys = list(groups)
+    for index, key in enumerate(keys):
+        for peer_key in keys[index:]:
+            if peer_key == key and len(groups[key]) < 2:
+                continue
+            mtu = common.path_vxlan_mtu(nodes[groups[key][0]], nodes[groups[peer_key][0]])
+            group_mtus[key] = min(group_mtus.get(key, mtu), mtu)
+            group_mtus[peer_key] = min(group_mtus.get(peer_key, mtu), mtu)
+
+    return {node_name: group_mtus[key] for key, node_names in groups.items() if key in group_mtus for node_name in node_names}
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
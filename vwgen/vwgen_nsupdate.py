@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import os
+import sys
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+from . import api
+from . import common
+
+
+def main(argv: List[str]) -> int:
+    args = argv[2:]
+    dry_run = False
+    commit = False
+    if args and args[0] == '--dry-run':
+        dry_run = True
+        args = args[1:]
+    elif args and args[0] == '--commit':
+        commit = True
+        args = args[1:]
+
+    if len(args) < 2 or len(args) % 2 != 0 or args[0] == '--help':
+        print_usage()
+        return 0
+
+    if commit:
+        return commit_snapshots(args)
+
+    print(';; Generated by VxWireguard-Generator')
+
+    return_value = 0
+
+    for network_name, domain_suffix in zip(args[0::2], args[1::2]):
+        config = common.Config()
+
+        if not config.load(network_name):
+            print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+            return_value = return_value or errno.ENOENT
+            continue
+
+        network_name = config.network_name()
+        domain_suffix = api.normalize_domain_suffix(domain_suffix)
+
+        network: Dict[str, Any] = config.network()
+        nodes: Dict[str, dict] = config.nodes()
+
+        records, error = api.generate_records(network, nodes, domain_suffix)
+        return_value = return_value or error
+        config.close()
+
+        snapshot_name = snapshot_file_name(network_name, domain_suffix)
+        old_records = load_snapshot(snapshot_name)
+
+        old_set: Set[api.Record] = set(old_records)
+        new_set: Set[api.Record] = set(records)
+        deleted = [i for i in old_records if i not in new_set]
+        added = [i for i in records if i not in old_set]
+
+        print()
+        print(';; Network {}, {} to delete, {} to add'.format(network_name, len(deleted), len(added)))
+
+        # Forward records all belong to the zone of the domain suffix, PTR records
+        # to the reverse zone of their address pool, the same zones 'vwgen zone
+        # --reverse-dir' writes. PTR records left over from an old pool are sent
+        # without a zone, nsupdate then looks up the zone they belong to.
+        reverse_zone_names = [api.reverse_zone_name(i) for i in api.reverse_zone_networks(network)]
+        print_update(deleted, added, lambda i: i.rtype != 'PTR', domain_suffix)
+        for zone_name in reverse_zone_names:
+            print_update(deleted, added, lambda i: i.rtype == 'PTR' and reverse_zone_of(i, reverse_zone_names) == zone_name, zone_name)
+        print_update(deleted, added, lambda i: i.rtype == 'PTR' and reverse_zone_of(i, reverse_zone_names) is None and i.owner.endswith('.in-addr.arpa.'), None)
+        print_update(deleted, added, lambda i: i.rtype == 'PTR' and reverse_zone_of(i, reverse_zone_names) is None and i.owner.endswith('.ip6.arpa.'), None)
+
+        # The snapshot only advances with --commit, once nsupdate has succeeded
+        if not dry_run:
+            save_snapshot(snapshot_name + '.pending', records)
+
+    return return_value
+
+
+def print_usage() -> None:
+    print('Usage: vwgen nsupdate [--dry-run | --commit] <network> <domain suffix> [<network> <domain suffix> ...]')
+    print()
+    print('Prints an nsupdate script of the records changed since the last commit. After')
+    print('nsupdate succeeded, run again with --commit to record what was published:')
+    print('  vwgen nsupdate <network> <suffix> | nsupdate && vwgen nsupdate --commit <network> <suffix>')
+    print('--dry-run prints the script without remembering it for --commit.')
+
+
+def commit_snapshots(args: List[str]) -> int:
+    return_value = 0
+
+    for network_name, domain_suffix in zip(args[0::2], args[1::2]):
+        config = common.Config()
+
+        if not config.load(network_name):
+            print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+            return_value = return_value or errno.ENOENT
+            continue
+
+        network_name = config.network_name()
+        config.close()
+
+        # Only the records of the last printed script are committed, not whatever
+        # the configuration holds by now
+        snapshot_name = snapshot_file_name(network_name, api.normalize_domain_suffix(domain_suffix))
+        try:
+            os.replace(snapshot_name + '.pending', snapshot_name)
+        except FileNotFoundError:
+            print("vwgen: No nsupdate script of network '{}' is waiting to be committed".format(network_name), file=sys.stderr)
+            return_value = return_value or errno.ENOENT
+
+    return return_value
+
+
+def snapshot_file_name(network_name: str, domain_suffix: str) -> str:
+    return '{}.{}records'.format(network_name, domain_suffix)
+
+
+def load_snapshot(file_name: str) -> List[api.Record]:
+    records: List[api.Record] = []
+    try:
+        with open(file_name, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 5 or line.startswith(';'):
+                    continue
+                records.append(api.Record(fields[0], fields[3], fields[4]))
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def save_snapshot(file_name: str, records: Iterable[api.Record]) -> None:
+    with open(file_name + '.tmp', 'w') as f:
+        print(';; Last published records, generated by VxWireguard-Generator', file=f)
+        for record in records:
+            print(api.format_record(record), file=f)
+    os.replace(file_name + '.tmp', file_name)
+
+
+def reverse_zone_of(record: api.Record, zone_names: List[str]) -> Optional[str]:
+    for zone_name in zone_names:
+        if record.owner.endswith('.' + zone_name):
+            return zone_name
+    return None
+
+
+def print_update(deleted: List[api.Record], added: List[api.Record], select: Callable[[api.Record], bool], zone: Optional[str]) -> None:
+    deleted = [i for i in deleted if select(i)]
+    added = [i for i in added if select(i)]
+    if not deleted and not added:
+        return
+
+    if zone:
+        print('zone {}'.format(zone))
+
+    for record in deleted:
+        print('update delete {} {} {}'.format(record.owner, record.rtype, record.data))
+
+    for record in added:
+        print('update add {} 300 {} {}'.format(record.owner, record.rtype, record.data))
+
+    print('send')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import csv
+import errno
+import heapq
+import itertools
+import math
+import sys
+from typing import Any, Dict, List, Optional, Set, Tuple
+from . import common
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Unmeasured pairs are only used by the backbone when nothing else connects two parts
+UNMEASURED_COST = 1e9
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) < 4 or argv[2] == '--help':
+        print_usage()
+        return 0
+
+    network_name = argv[2]
+
+    neighbors = 3
+    arg_index = 4
+    while arg_index < len(argv):
+        if argv[arg_index] == 'neighbors' and arg_index + 1 < len(argv):
+            try:
+                neighbors = int(argv[arg_index + 1])
+            except ValueError:
+                neighbors = -1
+            if neighbors < 0:
+                print("vwgen: Invalid number of neighbors '{}'".format(argv[arg_index + 1]), file=sys.stderr)
+                return errno.EINVAL
+            arg_index += 2
+        else:
+            print("vwgen: Invalid directive '{}'".format(argv[arg_index]), file=sys.stderr)
+            return errno.EINVAL
+
+    # Read the measurements before taking the lock, parsing a large matrix takes a while
+    if argv[3] != 'off':
+        try:
+            with open(argv[3], 'r', newline='') as f:
+                if numpy is not None:
+                    names, matrix = read_cost_matrix(f)
+                else:
+                    measurements = read_measurements(f)
+                    names = sorted(set((i for pair in measurements for i in pair)))
+        except FileNotFoundError:
+            print("vwgen: Unable to find file '{}'".format(argv[3]), file=sys.stderr)
+            return errno.ENOENT
+
+    config = common.Config()
+
+    if not config.load(network_name, writable=True):
+        print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+        return errno.ENOENT
+
+    network = config.network()
+    nodes = config.nodes()
+    blacklist = config.blacklist()
+    config.save()
+
+    if argv[3] == 'off':
+        for node in nodes.values():
+            node.pop('Peers', None)
+        config.save()
+        config.close()
+        return 0
+
+    unknown_names = [i for i in names if i not in nodes]
+    if unknown_names:
+        print("vwgen: Network '{}' does not have nodes {}, ignoring".format(network_name, ', '.join(unknown_names)), file=sys.stderr)
+
+    if numpy is not None:
+        # Nodes without any measurement are left out, like in the edge list form
+        keep = [index for index, name in enumerate(names) if name in nodes]
+        if len(keep) != len(names):
+            matrix = matrix[numpy.ix_(keep, keep)]
+        measured = numpy.flatnonzero(numpy.isfinite(matrix).any(axis=1))
+        if len(measured) != len(keep):
+            matrix = matrix[numpy.ix_(measured, measured)]
+        node_names = [names[keep[i]] for i in measured.tolist()]
+    else:
+        node_names = [i for i in names if i in nodes]
+
+    node_index = {name: index for index, name in enumerate(node_names)}
+    # Blacklisted pairs can never be selected, not even to connect the backbone
+    blocked = [(node_index[i], node_index[j]) for i, j in blacklist if i in node_index and j in node_index]
+
+    if numpy is not None:
+        edges = select_edges_numpy(matrix, blocked, neighbors)
+    else:
+        costs = {(node_index[i], node_index[j]): cost for (i, j), cost in measurements.items() if i in node_index and j in node_index and common.NamePair(i, j) not in blacklist}
+        edges = select_edges_python(len(node_names), costs, set(blocked), neighbors)
+
+    parts = count_parts(len(node_names), edges)
+    if parts > 1:
+        print('vwgen: The blacklist splits the optimized nodes into {} parts that cannot reach each other'.format(parts), file=sys.stderr)
+
+    selected: Dict[str, List[str]] = {name: [] for name in node_names}
+    for i, j in edges:
+        selected[node_names[i]].append(node_names[j])
+        selected[node_names[j]].append(node_names[i])
+
+    # Nodes without measurements get no Peers list, so they keep peering with everyone
+    for node_name, node in nodes.items():
+        if node_name in selected:
+            node['Peers'] = sorted(selected[node_name])
+        else:
+            node.pop('Peers', None)
+
+    config.save()
+    config.close()
+
+    if node_names:
+        degrees = [len(i) for i in selected.values()]
+        print('{} nodes optimized, {} links, {:.1f} peers per node on average, {} at most'.format(len(node_names), len(edges), sum(degrees) / len(degrees), max(degrees)))
+    return 0
+
+
+def print_usage() -> None:
+    print('Usage: vwgen optimize <network> <rtt.csv> [neighbors <k>]')
+    print('       vwgen optimize <network> off')
+    print()
+    print('Selects direct peers for each node from measured round-trip times: the k')
+    print('nearest nodes (3 by default) plus a minimum spanning tree that keeps the peering')
+    print('graph connected. The CSV file is either rows of <node>,<node>,<rtt ms>[,<loss 0-1>]')
+    print('or a matrix with node names in the first row and column. Pairs that are not')
+    print('selected are treated as blacklisted, pairs in the blacklist are never selected.')
+    print("'off' restores full peering.")
+    print()
+    print('Nodes only reach their selected peers directly. WireGuard AllowedIPs and the')
+    print('VXLAN forwarding entries cover direct peers only, and vwgen sets up no forwarding,')
+    print('so nodes that are not peers cannot reach each other unless a routing daemon on')
+    print('the nodes forwards between them.')
+
+
+def read_measurements(f: Any) -> Dict[Tuple[str, str], float]:
+    rows = [row for row in csv.reader(f) if row and any(cell.strip() for cell in row)]
+    directed: Dict[Tuple[str, str], float] = {}
+
+    if rows and not rows[0][0].strip():
+        # Matrix form
+        column_names = [i.strip() for i in rows[0][1:]]
+        for row in rows[1:]:
+            row_name = row[0].strip()
+            for column_name, cell in zip(column_names, row[1:]):
+                cost = parse_cost(cell, '')
+                if cost is not None and row_name != column_name:
+                    directed[(row_name, column_name)] = cost
+    else:
+        # Edge list form, a header row is skipped since its RTT is not a number
+        for row in rows:
+            if len(row) < 3:
+                continue
+            cost = parse_cost(row[2], row[3] if len(row) > 3 else '')
+            if cost is not None and row[0].strip() != row[1].strip():
+                directed[(row[0].strip(), row[1].strip())] = cost
+
+    # Average both directions where both are measured
+    measurements: Dict[Tuple[str, str], float] = {}
+    for (i, j), cost in directed.items():
+        pair = (i, j) if i < j else (j, i)
+        if (j, i) in directed:
+            cost = (cost + directed[(j, i)]) / 2
+        measurements[pair] = cost
+    return measurements
+
+
+# Reads either CSV form straight into a symmetric matrix, infinite where unmeasured
+# The matrix form is parsed by numpy.loadtxt, thousands of nodes take a few seconds
+def read_cost_matrix(f: Any) -> Tuple[List[str], Any]:
+    first_line = f.readline()
+    header = next(csv.reader([first_line]), [])
+    if not header or header[0].strip():
+        # Edge list form, usually sparse, so parsed row by row
+        measurements = read_measurements(itertools.chain([first_line], f))
+        names = sorted(set((i for pair in measurements for i in pair)))
+        index = {name: i for i, name in enumerate(names)}
+        matrix = numpy.full((len(names), len(names)), numpy.inf, dtype=numpy.float32)
+        if measurements:
+            pairs = numpy.array([(index[i], index[j]) for i, j in measurements], dtype=numpy.intp)
+            values = numpy.fromiter(measurements.values(), dtype=numpy.float32, count=len(measurements))
+            matrix[pairs[:, 0], pairs[:, 1]] = values
+            matrix[pairs[:, 1], pairs[:, 0]] = values
+        return names, matrix
+
+    column_names = [i.strip() for i in header[1:]]
+    row_names: List[str] = []
+    cells: List[str] = []
+    for line in f:
+        row_name, _, line = line.rstrip('\r\n').partition(',')
+        if not row_name.strip() and not line.strip(','):
+            continue
+        row_names.append(row_name.strip())
+        # loadtxt does not accept empty cells, which are unmeasured pairs, the second
+        # replace catches runs of them
+        line = (',' + line + ',').replace(',,', ',nan,').replace(',,', ',nan,')
+        cells.append(line[1:-1])
+    try:
+        values = numpy.loadtxt(cells, delimiter=',', dtype=numpy.float32, ndmin=2, usecols=range(len(column_names)))
+    except ValueError:
+        # Cells that are not numbers, slower but as forgiving as the edge list form
+        values = numpy.full((len(cells), len(column_names)), numpy.nan, dtype=numpy.float32)
+        for row_index, row in enumerate(cells):
+            for column_index, cell in enumerate(row.split(',')[:len(column_names)]):
+                cost = parse_cost(cell, '')
+                if cost is not None:
+                    values[row_index, column_index] = cost
+    values[~(values >= 0)] = numpy.nan
+
+    names = sorted(set(row_names) | set(column_names))
+    index = {name: i for i, name in enumerate(names)}
+    directed = numpy.full((len(names), len(names)), numpy.nan, dtype=numpy.float32)
+    directed[numpy.ix_([index[i] for i in row_names], [index[i] for i in column_names])] = values
+    numpy.fill_diagonal(directed, numpy.nan)
+
+    # Average both directions where both are measured
+    matrix = directed.T.copy()
+    one_way = numpy.isnan(matrix)
+    matrix[one_way] = directed[one_way]
+    both = ~one_way & ~numpy.isnan(directed)
+    matrix[both] = (matrix[both] + directed[both]) / 2
+    matrix[numpy.isnan(matrix)] = numpy.inf
+    return names, matrix
+
+
+def parse_cost(rtt: str, loss: str) -> Optional[float]:
+    try:
+        cost = float(rtt)
+    except ValueError:
+        return None
+    if math.isnan(cost) or cost < 0:
+        return None
+    if loss.strip():
+        try:
+            # Expected time to get a packet through with retransmission
+            cost /= max(1 - float(loss), 0.01)
+        except ValueError:
+            pass
+    return cost
+
+
+def select_edges_python(count: int, costs: Dict[Tuple[int, int], float], blocked: Set[Tuple[int, int]], neighbors: int) -> Set[Tuple[int, int]]:
+    adjacency: List[Dict[int, float]] = [{} for i in range(count)]
+    for (i, j), cost in costs.items():
+        adjacency[i][j] = cost
+        adjacency[j][i] = cost
+
+    edges: Set[Tuple[int, int]] = set()
+    for i in range(count):
+        for j, cost in heapq.nsmallest(neighbors, adjacency[i].items(), key=lambda item: item[1]):
+            edges.add((min(i, j), max(i, j)))
+
+    # Kruskal's algorithm over measured pairs
+    parent = list(range(count))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for (i, j), cost in sorted(costs.items(), key=lambda item: item[1]):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[root_i] = root_j
+            edges.add((i, j))
+
+    # Link parts that have no measurement between them at all through their first
+    # nodes, other members are only tried where that pair is blacklisted
+    members: Dict[int, List[int]] = {}
+    for i in range(count):
+        members.setdefault(find(i), []).append(i)
+    parts = list(members.values())
+    linked = parts[0] if parts else []
+    unlinked = parts[1:]
+    while unlinked:
+        remaining: List[List[int]] = []
+        for part in unlinked:
+            pair = next(((i, j) for i in part for j in linked if (i, j) not in blocked and (j, i) not in blocked), None)
+            if pair is None:
+                remaining.append(part)
+                continue
+            edges.add((min(pair), max(pair)))
+            linked += part
+        if len(remaining) == len(unlinked):
+            break
+        unlinked = remaining
+
+    return edges
+
+
+def select_edges_numpy(matrix: Any, blocked: List[Tuple[int, int]], neighbors: int) -> Set[Tuple[int, int]]:
+    count = matrix.shape[0]
+    blocked_rows = numpy.array([i for pair in blocked for i in pair], dtype=numpy.intp)
+    blocked_columns = numpy.array([i for pair in blocked for i in reversed(pair)], dtype=numpy.intp)
+    matrix[blocked_rows, blocked_columns] = numpy.inf
+
+    edges: Set[Tuple[int, int]] = set()
+
+    k = min(neighbors, count - 1)
+    if k > 0:
+        nearest = numpy.argpartition(matrix, k - 1, axis=1)[:, :k]
+        rows = numpy.repeat(numpy.arange(count), k)
+        columns = nearest.ravel()
+        measured = numpy.isfinite(matrix[rows, columns])
+        rows, columns = rows[measured], columns[measured]
+        for i, j in zip(numpy.minimum(rows, columns).tolist(), numpy.maximum(rows, columns).tolist()):
+            edges.add((i, j))
+
+    # Prim's algorithm, one vectorized pass over the matrix per node
+    # Unmeasured pairs may link parts of the backbone, blacklisted pairs never do
+    matrix[~numpy.isfinite(matrix)] = UNMEASURED_COST
+    matrix[blocked_rows, blocked_columns] = numpy.inf
+    in_tree = numpy.zeros(count, dtype=bool)
+    distance = numpy.full(count, numpy.inf, dtype=matrix.dtype)
+    closest = numpy.zeros(count, dtype=numpy.intp)
+    current = 0
+    for step in range(count - 1):
+        in_tree[current] = True
+        closer = matrix[current] < distance
+        distance[closer] = matrix[current][closer]
+        closest[closer] = current
+        distance[in_tree] = numpy.inf
+        current = int(numpy.argmin(distance))
+        if numpy.isinf(distance[current]):
+            # The blacklist cuts this node off from the tree, start another one
+            current = int(numpy.argmin(in_tree))
+            continue
+        i, j = int(closest[current]), current
+        edges.add((min(i, j), max(i, j)))
+
+    return edges
+
+
+# Number of parts of the mesh that cannot reach each other over the selected links
+def count_parts(count: int, edges: Set[Tuple[int, int]]) -> int:
+    parent = list(range(count))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    parts = count
+    for i, j in edges:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[root_i] = root_j
+            parts -= 1
+    return parts
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
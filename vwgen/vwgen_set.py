@@ -23,16 +23,12 @@
 # SOFTWARE.
 
 import errno
-import ipaddress
 import sys
 from typing import List, Optional
+from . import api
 from . import common
 
 
-class InvalidNodeError(Exception):
-    pass
-
-
 def main(argv: List[str]) -> int:
     if len(argv) < 3 or argv[2] == '--help':
         print_usage()
@@ -41,7 +37,7 @@ def main(argv: List[str]) -> int:
     network_name = argv[2]
     config = common.Config()
 
-    if not config.load(network_name):
+    if not config.load(network_name, writable=True):
         print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
         return errno.ENOENT
 
@@ -53,131 +49,56 @@ def main(argv: List[str]) -> int:
     arg_index = 3
     return_value = 0
 
-    try:
-        while arg_index < len(argv):
-
-            if argv[arg_index] == 'node':
-                node_name = argv[arg_index + 1]
-                if node_name not in nodes:
-                    print("vwgen: Network '{}' does not have node '{}'".format(network_name, node_name), file=sys.stderr)
-                    return errno.ENOENT
-                node = nodes[node_name]
-                arg_index += 2
-
-            elif argv[arg_index] == 'pool-ipv4':
-                network['AddressPoolIPv4'] = ipaddress.IPv4Network(argv[arg_index + 1], strict=False).compressed
-                arg_index += 2
-
-            elif argv[arg_index] == 'pool-ipv6':
-                network['AddressPoolIPv6'] = ipaddress.IPv6Network(argv[arg_index + 1], strict=False).compressed
-                arg_index += 2
-
-            elif argv[arg_index] == 'vxlan-id':
-                network['VxlanID'] = int(argv[arg_index + 1])
-                arg_index += 2
-
-            elif argv[arg_index] == 'vxlan-mtu':
-                network['VxlanMTU'] = int(argv[arg_index + 1])
-                arg_index += 2
-
-            elif argv[arg_index] == 'vxlan-port':
-                network['VxlanPort'] = int(argv[arg_index + 1])
-                arg_index += 2
-
-            elif argv[arg_index] == 'addr':
-                if node is None:
-                    raise InvalidNodeError
-                node['Address'] = list(map(str.strip, argv[arg_index + 1].split(',')))
-                arg_index += 2
-
-            elif argv[arg_index] == 'allowed-ips':
-                if node is None:
-                    raise InvalidNodeError
-                node['AllowedIPs'] = list(map(str.strip, argv[arg_index + 1].split(',')))
-                arg_index += 2
-
-            elif argv[arg_index] == 'endpoint':
-                if node is None:
-                    raise InvalidNodeError
-                if argv[arg_index + 1]:
-                    endpoint = argv[arg_index + 1]
-                    if endpoint.startswith('[') and endpoint.endswith(']'):
-                        endpoint += str(node.get('ListenPort', 0))
-                    elif ':' not in endpoint:
-                        endpoint += ':' + str(node.get('ListenPort', 0))
-                    elif endpoint.count(':') > 1:
-                        endpoint = '[' + endpoint + ']:' + str(node.get('ListenPort', 0))
-                    node['Endpoint'] = endpoint
-                else:
-                    node['Endpoint'] = None
-                arg_index += 2
-
-            elif argv[arg_index] == 'fwmark':
-                if node is None:
-                    raise InvalidNodeError
-                if argv[arg_index + 1] == 'off':
-                    node['FwMark'] = 0
-                else:
-                    node['FwMark'] = int(argv[arg_index + 1], base=0)
-                arg_index += 2
-
-            elif argv[arg_index] == 'll-addr':
-                if node is None:
-                    raise InvalidNodeError
-                node['LinkLayerAddr'] = argv[arg_index + 1]
-                arg_index += 2
-
-            elif argv[arg_index] == 'listen-port':
-                if node is None:
-                    raise InvalidNodeError
-                node['ListenPort'] = int(argv[arg_index + 1])
-                arg_index += 2
-
-            elif argv[arg_index] == 'persistent-keepalive':
-                if node is None:
-                    raise InvalidNodeError
-                if argv[arg_index + 1] == 'off':
-                    node['PersistentKeepalive'] = 0
-                else:
-                    node['PersistentKeepalive'] = int(argv[arg_index + 1])
-                arg_index += 2
-
-            elif argv[arg_index] == 'private-key':
-                if node is None:
-                    raise InvalidNodeError
-                node['PrivateKey'] = argv[arg_index + 1]
-                arg_index += 2
-
-            elif argv[arg_index] == 'save-config':
-                if node is None:
-                    raise InvalidNodeError
-                node['SaveConfig'] = True
-                arg_index += 1
-            elif argv[arg_index] == 'nosave-config':
-                if node is None:
-                    raise InvalidNodeError
-                node['SaveConfig'] = False
-                arg_index += 1
-
-            elif argv[arg_index] == 'upnp':
-                if node is None:
-                    raise InvalidNodeError
-                node['UPnP'] = True
-                arg_index += 1
-            elif argv[arg_index] == 'noupnp':
-                if node is None:
-                    raise InvalidNodeError
-                node['UPnP'] = False
-                arg_index += 1
-
-            else:
-                print("vwgen: Invalid directive '{}'".format(argv[arg_index]))
+    while arg_index < len(argv):
+        option = argv[arg_index]
+
+        if option == 'node':
+            if arg_index + 1 >= len(argv):
+                print("vwgen: Argument not complete, use '--help' to check for help", file=sys.stderr)
+                break
+            node_name = argv[arg_index + 1]
+            if node_name not in nodes:
+                print("vwgen: Network '{}' does not have node '{}'".format(network_name, node_name), file=sys.stderr)
+                return errno.ENOENT
+            node = nodes[node_name]
+            arg_index += 2
+            continue
+
+        if option == 'assign-ipv6':
+            # Every node that still uses the address derived from its key gets a static one
+            try:
+                allocations = api.assign_ipv6(network, nodes)
+            except ValueError as e:
+                print('vwgen: {}'.format(e), file=sys.stderr)
                 return errno.EINVAL
-
-    except IndexError:
-        print("vwgen: Argument not complete, use '--help' to check for help", file=sys.stderr)
-    except InvalidNodeError:
-        print("vwgen: '{}' must be used after 'node' directive, use '--help' to check for help".format(argv[arg_index]), file=sys.stderr)
+            if None in allocations.values():
+                print('vwgen: IPv6 address pool is full', file=sys.stderr)
+                return_value = errno.ENOSPC
+            arg_index += 1
+            continue
+
+        if option not in api.NETWORK_OPTIONS and option not in api.NODE_OPTIONS:
+            print("vwgen: Invalid directive '{}'".format(option))
+            return errno.EINVAL
+        if option in api.NODE_OPTIONS and node is None:
+            print("vwgen: '{}' must be used after 'node' directive, use '--help' to check for help".format(option), file=sys.stderr)
+            break
+
+        value_count = api.NETWORK_OPTIONS.get(option, api.NODE_OPTIONS.get(option, 0))
+        values = argv[arg_index + 1:arg_index + 1 + value_count]
+        if len(values) < value_count:
+            print("vwgen: Argument not complete, use '--help' to check for help", file=sys.stderr)
+            break
+
+        try:
+            if option in api.NETWORK_OPTIONS:
+                api.set_network_option(network, nodes, option, values)
+            elif node is not None:
+                api.set_node_option(node, option, values)
+        except ValueError as e:
+            print('vwgen: {}'.format(e), file=sys.stderr)
+            return errno.EINVAL
+        arg_index += 1 + value_count
 
     config.save()
     config.close()
@@ -186,15 +107,24 @@ def main(argv: List[str]) -> int:
 
 def print_usage() -> None:
     print('Usage: vwgen set <network> [pool-ipv4 <ipv4/cidr>] [pool-ipv6 <ipv6/cidr>]')
-    print('                           [vxlan-id <vxlan-id>] [vxlan-mtu <vxlan-mtu>]')
-    print('                           [vxlan-port <vxlan-port>]')
+    print('                           [vxlan-id <vxlan-id>] [vxlan-mtu <vxlan-mtu | auto>]')
+    print('                           [vxlan-port <vxlan-port>] [journal <on | off>]')
+    print('                           [snapshots <on | off>]')
+    print('                           [ipv6-allocation <pubkey | sequential | hashed | random>]')
+    print('                           [assign-ipv6]')
+    print('                           [segment <name> <vxlan-id>] [nosegment <name>]')
     print('         [node <node name> [addr <ip1/cidr1>[,<ip2/cidr2>]...]')
     print('                           [allowed-ips <ip1/cidr1>[,<ip2/cidr2>]...]')
+    print('                           [segments <name1>[,<name2>]...]')
+    print('                           [segment-addr <name> <ip1/cidr1>[,<ip2/cidr2>]...]')
     print('                           [endpoint <ip>:<port>] [fwmark <mark>]')
-    print('                           [ll-addr <ipv4/cidr>] [listen-port <port>]')
-    print('                           [persistent-keepalive <interval seconds>]')
+    print('                           [endpoints <ip1>:<port1>[@<site | ipv4 | ipv6>][,<ip2>:<port2>...]...]')
+    print('                           [site <site name>]')
+    print('                           [ll-addr <ipv4/cidr>[,<ipv4/cidr>]...] [listen-port <port>]')
+    print('                           [underlay-mtu <mtu>]')
+    print('                           [persistent-keepalive <interval seconds | auto | off>]')
     print('                           [private-key <file path>] [[no]save-config]')
-    print('                           [[no]upnp ]')
+    print('                           [[no]upnp ] [[no]nat]')
     print('         [node <node name> ...]')
 
 
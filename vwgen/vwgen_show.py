@@ -23,26 +23,108 @@
 # SOFTWARE.
 
 import binascii
+import bisect
 import errno
+import fnmatch
 import sys
-from typing import List
+from typing import Callable, List, NamedTuple, Optional, Set, Tuple
 from . import common
 
+
 NORMAL = '\x1b[0m'
 BOLD = '\x1b[1m'
 GREEN = '\x1b[32m'
 YELLOW = '\x1b[33m'
 
 
+class NodeContext(NamedTuple):
+    network: common.Config.NetworkType
+    nodes: common.Config.NodesType
+    blacklist: common.Config.BlacklistType
+    node_name: str
+    node: common.Config.NodeType
+
+
+class Field(NamedTuple):
+    name: str
+    label: str
+    # Printed even when empty, unless only the given fields are shown
+    always: bool
+    # Lines of label and value, computed only when the field is shown or filtered on
+    lines: Callable[[NodeContext], List[Tuple[str, str]]]
+    # Values matched by --where, the values of the lines when not given
+    values: Optional[Callable[[NodeContext], List[str]]] = None
+
+
+def public_key_lines(context: NodeContext) -> List[Tuple[str, str]]:
+    secret = binascii.a2b_base64(context.node.get('PrivateKey', ''))
+    if len(secret) != 32:
+        return [('public key', '(error)')]
+    return [('public key', binascii.b2a_base64(common.pubkey(secret), newline=False).decode('ascii'))]
+
+
+def vtep_address_lines(context: NodeContext) -> List[Tuple[str, str]]:
+    addresses = list(context.node.get('Address', []))
+    pubkey_ipv6 = common.generate_pubkey_ipv6(context.network, context.node)
+    if pubkey_ipv6:
+        addresses.append(pubkey_ipv6)
+    return [('vtep address', ', '.join(addresses))]
+
+
+def format_keepalive(interval: int) -> str:
+    if interval == common.PERSISTENT_KEEPALIVE_AUTO:
+        return 'auto'
+    return '{} {}'.format(interval, 'seconds' if interval != 1 else 'second')
+
+
+def optional_line(label: str, key: str, format_value: Callable[[common.Config.NodeType], str] = lambda i: str(i)) -> Callable[[NodeContext], List[Tuple[str, str]]]:
+    return lambda context: [(label, format_value(context.node[key]))] if context.node.get(key) else []
+
+
+FIELDS: List[Field] = [
+    Field('pubkey', 'public key', True, public_key_lines),
+    Field('privkey', 'private key', True, lambda context: [('private key', context.node.get('PrivateKey', ''))]),
+    Field('endpoint', 'public ip', True, lambda context: [('public ip', context.node.get('Endpoint') or '')]),
+    Field('endpoints', 'other endpoints', False, optional_line('other endpoints', 'Endpoints', ', '.join)),
+    Field('site', 'site', False, optional_line('site', 'Site')),
+    Field('listen-port', 'listen port', True, lambda context: [('listen port', str(context.node.get('ListenPort', 0)))]),
+    Field('vtep-address', 'vtep address', True, vtep_address_lines),
+    Field('segments', 'segment', False, lambda context: [('segment ' + i, ', '.join(context.node.get('SegmentAddress', {}).get(i, []))) for i in context.node.get('Segments', [])], lambda context: list(context.node.get('Segments', []))),
+    Field('allowed-ips', 'allowed ips', True, lambda context: [('allowed ips', ', '.join(context.node.get('AllowedIPs', [])))]),
+    Field('ll-addr', 'link-layer address', True, lambda context: [('link-layer address', ', '.join(context.node.get('LinkLayerAddress', [])))]),
+    Field('fwmark', 'fwmark', False, optional_line('fwmark', 'FwMark', '{:x}'.format)),
+    Field('persistent-keepalive', 'persistent keepalive', False, optional_line('persistent keepalive', 'PersistentKeepalive', format_keepalive)),
+    Field('underlay-mtu', 'underlay mtu', False, lambda context: [('underlay mtu', str(context.node['UnderlayMTU']))] if 'UnderlayMTU' in context.node else []),
+    Field('nat', 'behind nat', False, optional_line('behind nat', 'NAT', lambda i: 'true')),
+    Field('peers', 'selected peers', False, lambda context: [('selected peers', ', '.join(context.node['Peers']))] if 'Peers' in context.node else []),
+    Field('save-config', 'save config', False, optional_line('save config', 'SaveConfig', lambda i: 'true')),
+    Field('upnp', 'upnp', False, optional_line('upnp', 'UPnP', lambda i: 'true')),
+    Field('blacklist', 'blacklist', True, lambda context: [('blacklist', ', '.join(str(i[1]) for i in context.blacklist if i[0] == context.node_name))]),
+    Field('whitelist', 'whitelist', True, lambda context: [('whitelist', ', '.join(i for i in context.nodes if i != context.node_name and common.peering_allowed(context.nodes, context.blacklist, context.node_name, i)))]),
+]
+FIELDS_BY_NAME = {field.name: field for field in FIELDS}
+
+
+class Query(NamedTuple):
+    node_patterns: List[str]
+    conditions: List[Tuple[str, str]]
+    fields: Optional[List[str]]
+
+
 def main(argv: List[str]) -> int:
     if len(argv) < 3 or argv[2] == '--help':
         print_usage()
         return 0
 
+    try:
+        query, network_names = parse_query(argv[2:])
+    except (IndexError, ValueError) as e:
+        print('vwgen: Invalid option: {}'.format(e), file=sys.stderr)
+        return errno.EINVAL
+
     return_value = 0
 
-    for network_name in argv[2:]:
-        network_name = argv[2]
+    for network_name in network_names:
         config = common.Config()
 
         if not config.load(network_name):
@@ -54,76 +136,123 @@ def main(argv: List[str]) -> int:
         nodes = config.nodes()
         blacklist = config.blacklist()
 
-        print('{}network:{} {}{}{}'.format(BOLD, NORMAL, GREEN, config.network_name(), NORMAL))
+        if not query.node_patterns and not query.conditions and query.fields is None:
+            print_network(config.network_name(), network)
 
-        print('  {}address pool ipv4:{} {}'.format(BOLD, NORMAL, network.get('AddressPoolIPv4', '')))
+        for node_name in select_nodes(nodes, network, blacklist, query):
+            context = NodeContext(network, nodes, blacklist, node_name, nodes[node_name])
 
-        print('  {}address pool ipv6:{} {}'.format(BOLD, NORMAL, network.get('AddressPoolIPv6', '')))
+            print('{}node:{} {}{}{}'.format(BOLD, NORMAL, YELLOW, node_name, NORMAL))
 
-        print('  {}vxlan port:{} {}'.format(BOLD, NORMAL, network.get('VxlanPort', 4789)))
+            for field in FIELDS if query.fields is None else [FIELDS_BY_NAME[i] for i in query.fields]:
+                lines = field.lines(context)
+                if not lines and (field.always or query.fields is not None):
+                    lines = [(field.label, '')]
+                for label, value in lines:
+                    print('  {}{}:{} {}'.format(BOLD, label, NORMAL, value))
 
-        print('  {}vxlan mtu:{} {}'.format(BOLD, NORMAL, network.get('VxlanMTU', 1500)))
+            print()
 
-        print('  {}vxlan id:{} {}'.format(BOLD, NORMAL, network.get('VxlanID', 0)))
+        config.close()
 
-        print()
+    return return_value
 
-        for node_name, node in nodes.items():
 
-            print('{}node:{} {}{}{}'.format(BOLD, NORMAL, YELLOW, node_name, NORMAL))
+def print_usage() -> None:
+    print('Usage: vwgen show [--node <pattern>]... [--where <field>=<pattern>]...')
+    print('                  [--fields <field>[,<field>...]] <network> [<network> ...]')
+    print()
+    print('Shows the nodes whose name matches any --node pattern and whose fields match')
+    print("every --where pattern, 'none' matches an empty field. --fields shows only the")
+    print('given fields. Fields are:')
+    print('  ' + ', '.join(field.name for field in FIELDS))
 
-            secret_base64 = node.get('PrivateKey', '')
-            secret = binascii.a2b_base64(secret_base64)
-            if len(secret) != 32:
-                pubkey = '(error)'
-            else:
-                pubkey = binascii.b2a_base64(common.pubkey(secret), newline=False).decode('ascii')
 
-            print('  {}public key:{} {}'.format(BOLD, NORMAL, pubkey))
+def parse_query(args: List[str]) -> Tuple[Query, List[str]]:
+    node_patterns: List[str] = []
+    conditions: List[Tuple[str, str]] = []
+    fields: Optional[List[str]] = None
 
-            print('  {}private key:{} {}'.format(BOLD, NORMAL, secret_base64))
+    while args and args[0].startswith('--'):
+        if args[0] == '--node':
+            node_patterns.append(args[1])
+        elif args[0] == '--where':
+            field_name, separator, pattern = args[1].partition('=')
+            if not separator or field_name not in FIELDS_BY_NAME:
+                raise ValueError("'{}' is not <field>=<pattern>".format(args[1]))
+            conditions.append((field_name, pattern))
+        elif args[0] == '--fields':
+            fields = [i for i in map(str.strip, args[1].split(',')) if i]
+            for field_name in fields:
+                if field_name not in FIELDS_BY_NAME:
+                    raise ValueError("unknown field '{}'".format(field_name))
+        else:
+            raise ValueError("unknown option '{}'".format(args[0]))
+        args = args[2:]
 
-            print('  {}public ip:{} {}'.format(BOLD, NORMAL, node.get('Endpoint') or ''))
+    if not args:
+        raise ValueError('no network given')
+    return Query(node_patterns, conditions, fields), args
 
-            print('  {}listen port:{} {}'.format(BOLD, NORMAL, node.get('ListenPort', 0)))
 
-            address = node.get('Address', [])
-            pubkey_ipv6 = common.generate_pubkey_ipv6(network, node)
-            if pubkey_ipv6:
-                address.append(pubkey_ipv6)
+def print_network(network_name: str, network: common.Config.NetworkType) -> None:
+    print('{}network:{} {}{}{}'.format(BOLD, NORMAL, GREEN, network_name, NORMAL))
 
-            print('  {}vtep address:{} {}'.format(BOLD, NORMAL, ', '.join(address)))
+    print('  {}address pool ipv4:{} {}'.format(BOLD, NORMAL, network.get('AddressPoolIPv4', '')))
 
-            print('  {}allowed ips:{} {}'.format(BOLD, NORMAL, ', '.join(node.get('AllowedIPs', []))))
+    print('  {}address pool ipv6:{} {}'.format(BOLD, NORMAL, network.get('AddressPoolIPv6', '')))
 
-            print('  {}link-layer address:{} {}'.format(BOLD, NORMAL, ', '.join(node.get('LinkLayerAddress', []))))
+    if network.get('IPv6Allocation', 'pubkey') != 'pubkey':
+        print('  {}ipv6 allocation:{} {}'.format(BOLD, NORMAL, network['IPv6Allocation']))
 
-            if node.get('FwMark', 0) != 0:
-                print('  {}fwmark:{} {:x}'.format(BOLD, NORMAL, node['FwMark']))
+    print('  {}vxlan port:{} {}'.format(BOLD, NORMAL, network.get('VxlanPort', 4789)))
 
-            if node.get('PersistentKeepalive', 0) != 0:
-                print('  {}persistent keepalive:{} {} {}'.format(BOLD, NORMAL, node['PersistentKeepalive'], 'seconds' if node['PersistentKeepalive'] != 1 else 'second'))
+    print('  {}vxlan mtu:{} {}'.format(BOLD, NORMAL, network.get('VxlanMTU', 'auto')))
 
-            if node.get('SaveConfig', False):
-                print('  {}save config:{} true'.format(BOLD, NORMAL))
+    print('  {}vxlan id:{} {}'.format(BOLD, NORMAL, network.get('VxlanID', 0)))
 
-            if node.get('UPnP', False):
-                print('  {}upnp:{} true'.format(BOLD, NORMAL))
+    for segment_name, segment in network.get('Segments', {}).items():
+        print('  {}segment {}:{} vxlan id {}, vxlan mtu {}'.format(BOLD, segment_name, NORMAL, segment.get('VxlanID', 0), segment.get('VxlanMTU', network.get('VxlanMTU', 'auto'))))
 
-            node_blacklist: List[str] = [str(i[1]) for i in blacklist if i[0] == node_name]
-            node_whitelist: List[str] = sorted(set(nodes) - set(node_blacklist) - {node_name})
-            print('  {}blacklist:{} {}'.format(BOLD, NORMAL, ', '.join(node_blacklist)))
-            print('  {}whitelist:{} {}'.format(BOLD, NORMAL, ', '.join(node_whitelist)))
+    print()
 
-            print()
 
-        config.close()
+def select_nodes(nodes: common.Config.NodesType, network: common.Config.NetworkType, blacklist: common.Config.BlacklistType, query: Query) -> List[str]:
+    names: List[str] = list(nodes.keys())
+    if query.node_patterns:
+        selected: Set[str] = set()
+        for pattern in query.node_patterns:
+            selected.update(match_names(names, nodes, pattern))
+        names = sorted(selected)
 
-    return return_value
+    for field_name, pattern in query.conditions:
+        field = FIELDS_BY_NAME[field_name]
+        names = [i for i in names if match_field(field, NodeContext(network, nodes, blacklist, i, nodes[i]), pattern)]
 
+    return names
 
-def print_usage() -> None:
-    print('Usage: vwgen show <network> [<network> ...]')
+
+def has_wildcard(pattern: str) -> bool:
+    return any(i in pattern for i in '*?[')
+
+
+def match_names(names: List[str], nodes: common.Config.NodesType, pattern: str) -> List[str]:
+    if not has_wildcard(pattern):
+        return [pattern] if pattern in nodes else []
+    # Names are sorted, so only those starting with the literal prefix are checked
+    prefix = pattern[:min(pattern.index(i) for i in '*?[' if i in pattern)]
+    start = bisect.bisect_left(names, prefix)
+    end = start
+    while end < len(names) and names[end].startswith(prefix):
+        end += 1
+    return [i for i in names[start:end] if fnmatch.fnmatchcase(i, pattern)]
+
+
+def match_field(field: Field, context: NodeContext, pattern: str) -> bool:
+    values = field.values(context) if field.values else [value for _, value in field.lines(context) if value]
+    if pattern == 'none':
+        return not values
+    return any(fnmatch.fnmatchcase(value, pattern) for value in values)
 
 
 if __name__ == '__main__':
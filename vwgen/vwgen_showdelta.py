@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import sys
+from typing import Dict, List, Tuple
+from . import api
+from . import common
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) not in (5, 6) or argv[2] == '--help':
+        print_usage()
+        return 0
+
+    old_network_name, network_name, node_name = argv[2], argv[3], argv[4]
+    old_config = common.Config()
+    config = common.Config()
+
+    if not old_config.load(old_network_name):
+        print("vwgen: Unable to find configuration file '{}.conf'".format(old_network_name), file=sys.stderr)
+        return errno.ENOENT
+    if not config.load(network_name):
+        print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+        return errno.ENOENT
+
+    interface = argv[5] if len(argv) == 6 else common.interface_name(config.network_name())
+
+    old_network = old_config.network()
+    old_nodes = old_config.nodes()
+    network = config.network()
+    nodes = config.nodes()
+
+    if node_name not in old_nodes:
+        print("vwgen: Network '{}' does not have node '{}'".format(old_config.network_name(), node_name), file=sys.stderr)
+        return errno.ENOENT
+    if node_name not in nodes:
+        print("vwgen: Network '{}' does not have node '{}'".format(config.network_name(), node_name), file=sys.stderr)
+        return errno.ENOENT
+    old_node = old_nodes[node_name]
+    node = nodes[node_name]
+
+    old_peers = active_peers(api.generate_peers(old_nodes, old_config.blacklist(), node_name))
+    peers = active_peers(api.generate_peers(nodes, config.blacklist(), node_name))
+
+    print('#!/bin/sh')
+    print('# Network {}, node {}, changes since {}, generated by VxWireguard-Generator'.format(config.network_name(), node_name, old_config.network_name()))
+
+    # Removals go first, so that addresses moved between peers do not collide
+    for public_key, old_peer in old_peers.items():
+        if public_key not in peers:
+            print('# Peer node {} removed'.format(old_peer.name))
+            print('wg set {} peer {} remove'.format(interface, public_key))
+
+    old_segments = api.generate_segments(old_network, old_nodes, old_config.blacklist(), node_name, [])
+    segments = api.generate_segments(network, nodes, config.blacklist(), node_name, [])
+    if [(i.name, i.vxlan_id) for i in old_segments] != [(i.name, i.vxlan_id) for i in segments]:
+        print("vwgen: Node '{}' changed its VXLAN segments, restart the interface to apply them".format(node_name), file=sys.stderr)
+
+    old_fdb = fdb_entries(old_peers, interface)
+    new_fdb = fdb_entries(peers, interface)
+    new_fdb_set = set(new_fdb)
+    old_fdb_set = set(old_fdb)
+    for device, address in old_fdb:
+        if (device, address) not in new_fdb_set:
+            print('bridge fdb del 00:00:00:00:00:00 dev {} dst {} || true'.format(device, address))
+
+    print_interface_changes(old_network, old_node, old_segments, network, node, segments, interface)
+
+    for public_key, peer in peers.items():
+        old_peer = old_peers.get(public_key)
+        arguments: List[str] = []
+
+        if old_peer is None or old_peer.allowed_ips != peer.allowed_ips:
+            arguments.append('allowed-ips "{}"'.format(','.join(peer.allowed_ips)))
+
+        # WireGuard cannot forget an endpoint, a removed one stays as the last roamed address
+        if peer.endpoint and (old_peer is None or old_peer.endpoint != peer.endpoint):
+            arguments.append('endpoint {}'.format(peer.endpoint))
+
+        if (old_peer is None and peer.persistent_keepalive != 0) or (old_peer is not None and old_peer.persistent_keepalive != peer.persistent_keepalive):
+            arguments.append('persistent-keepalive {}'.format(peer.persistent_keepalive or 'off'))
+
+        if arguments:
+            print('# Peer node {} {}'.format(peer.name, 'added' if old_peer is None else 'changed'))
+            print('wg set {} peer {} {}'.format(interface, public_key, ' '.join(arguments)))
+
+    for device, address in new_fdb:
+        if (device, address) not in old_fdb_set:
+            print('bridge fdb append 00:00:00:00:00:00 dev {} dst {} via {}'.format(device, address, interface))
+
+    print('# Network {}, node {}, generated by VxWireguard-Generator'.format(config.network_name(), node_name))
+
+    old_config.close()
+    config.close()
+    return 0
+
+
+def print_usage() -> None:
+    print('Usage: vwgen showdelta <old network> <network> <node> [<interface>]')
+    print()
+    print('Compares two versions of a network, then generates a shell script that')
+    print('applies the changes of the given node to its running interface without')
+    print('restarting it. <interface> defaults to the network name.')
+
+
+def active_peers(peers: List[api.Peer]) -> Dict[str, api.Peer]:
+    return {peer.public_key: peer for peer in peers if not peer.blacklisted and peer.public_key}
+
+
+def fdb_entries(peers: Dict[str, api.Peer], interface: str) -> List[Tuple[str, str]]:
+    return [(device, address) for peer in peers.values() for device in [common.vxlan_device_name(interface)] + peer.segments for address in peer.link_layer_addresses]
+
+
+def print_interface_changes(old_network: common.Config.NetworkType, old_node: common.Config.NodeType, old_segments: List[api.Segment], network: common.Config.NetworkType, node: common.Config.NodeType, segments: List[api.Segment], interface: str) -> None:
+    if old_network.get('VxlanID', 0) != network.get('VxlanID', 0) or old_network.get('VxlanPort', 4789) != network.get('VxlanPort', 4789):
+        print("vwgen: VXLAN ID or port has changed, interface '{}' needs to be restarted".format(interface), file=sys.stderr)
+        print('# VXLAN ID or port has changed, restart the interface to apply')
+
+    for key in ('PreUp', 'PostUp', 'PreDown', 'PostDown'):
+        if old_node.get(key, []) != node.get(key, []):
+            print('# {} scripts have changed, restart the interface to apply'.format(key))
+
+    if old_node.get('PrivateKey') != node.get('PrivateKey') and node.get('PrivateKey'):
+        for command in api.private_key_commands(interface, node['PrivateKey']):
+            print(command)
+
+    if old_node.get('ListenPort', 0) != node.get('ListenPort', 0):
+        print('wg set {} listen-port {:d}'.format(interface, node.get('ListenPort', 0)))
+
+    if old_node.get('FwMark', 0) != node.get('FwMark', 0):
+        print('wg set {} fwmark {}'.format(interface, '0x{:x}'.format(node['FwMark']) if node.get('FwMark', 0) != 0 else 'off'))
+
+    if api.wireguard_mtu(old_segments) != api.wireguard_mtu(segments):
+        print('ip link set {} mtu {}'.format(interface, api.wireguard_mtu(segments)))
+    old_mtus = {segment.name: segment.mtu for segment in old_segments}
+    for segment in segments:
+        if segment.name in old_mtus and old_mtus[segment.name] != segment.mtu:
+            print('ip link set {} mtu {}'.format(segment.name or common.vxlan_device_name(interface), segment.mtu))
+
+    mac_address = common.generate_pubkey_macaddr(node)
+    if mac_address and common.generate_pubkey_macaddr(old_node) != mac_address:
+        for segment in segments:
+            print('ip link set {} address {}'.format(segment.name or common.vxlan_device_name(interface), mac_address))
+
+    print_address_changes(old_node.get('LinkLayerAddress', []), node.get('LinkLayerAddress', []), interface)
+
+    print_address_changes(common.vtep_addresses(old_network, old_node), common.vtep_addresses(network, node), common.vxlan_device_name(interface))
+
+    # Added or removed segments need a restart, which main already reports
+    old_segment_addresses = {segment.name: segment.addresses for segment in old_segments[1:]}
+    for segment in segments[1:]:
+        if segment.name in old_segment_addresses:
+            print_address_changes(old_segment_addresses[segment.name], segment.addresses, segment.name)
+
+
+def print_address_changes(old_addresses: List[str], addresses: List[str], device: str) -> None:
+    for address in old_addresses:
+        if address not in addresses:
+            print('ip address del {} dev {} || true'.format(address, device))
+    for address in addresses:
+        if address not in old_addresses:
+            print('ip address add {} dev {} || true'.format(address, device))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import os
+import sys
+from typing import List, Optional
+from . import api
+from . import common
+
+
+NETWORKD_DIR = '/etc/systemd/network'
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) < 4 or argv[2] == '--help':
+        print_usage()
+        return 0
+
+    network_name, output_dir = argv[2], argv[3]
+    config = common.Config()
+
+    if not config.load(network_name):
+        print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+        return errno.ENOENT
+
+    network = config.network()
+    nodes = config.nodes()
+    blacklist = config.blacklist()
+
+    return_value = 0
+
+    for node_name in argv[4:] or list(nodes):
+        if node_name not in nodes:
+            print("vwgen: Network '{}' does not have node '{}'".format(network_name, node_name), file=sys.stderr)
+            return_value = return_value or errno.ENOENT
+            continue
+
+        node_dir = os.path.join(output_dir, node_name)
+        os.makedirs(node_dir, exist_ok=True)
+        write_units(config.network_name(), network, nodes, blacklist, node_name, node_dir)
+
+    config.close()
+    return return_value
+
+
+def print_usage() -> None:
+    print('Usage: vwgen shownetworkd <network> <directory> [<node> ...]')
+    print()
+    print('Generates systemd-networkd units for the given nodes, or all nodes if')
+    print('none is given, into <directory>/<node>/. Copy them to /etc/systemd/network, and')
+    print('the files in <directory>/<node>/sysctl.d/ to /etc/sysctl.d. The private key is')
+    print('written to a separate .key file, which must be owned by the systemd-network user.')
+
+
+def write_units(network_name: str, network: common.Config.NetworkType, nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_name: str, node_dir: str) -> None:
+    node = nodes[node_name]
+    wg_name = common.interface_name(network_name)
+    vxlan_name = common.vxlan_device_name(wg_name)
+
+    for key in ('PreUp', 'PostUp', 'PreDown', 'PostDown'):
+        if node.get(key):
+            print("vwgen: Node '{}' has {} scripts, which systemd-networkd does not support".format(node_name, key), file=sys.stderr)
+
+    segments = api.generate_segments(network, nodes, blacklist, node_name, common.vtep_addresses(network, node))
+
+    lines = header(network_name, node_name)
+    lines += ['[NetDev]', 'Name={}'.format(wg_name), 'Kind=wireguard', 'MTUBytes={}'.format(api.wireguard_mtu(segments)), '']
+    lines += ['[WireGuard]']
+    if 'PrivateKey' in node:
+        # The key stays in its own file, so the .netdev file can be world-readable like any other unit
+        lines.append('PrivateKeyFile={}'.format(os.path.join(NETWORKD_DIR, wg_name + '.key')))
+        write_file(os.path.join(node_dir, wg_name + '.key'), [node['PrivateKey'], ''], 0o600)
+    # Without ListenPort, the kernel picks a random port
+    if node.get('ListenPort', 0) != 0:
+        lines.append('ListenPort={:d}'.format(node['ListenPort']))
+    if node.get('FwMark', 0) != 0:
+        lines.append('FirewallMark={:d}'.format(node['FwMark']))
+    lines.append('')
+
+    peers = api.generate_peers(nodes, blacklist, node_name)
+
+    for peer in peers:
+        if peer.blacklisted:
+            continue
+        lines += ['# Peer node {}'.format(peer.name), '[WireGuardPeer]']
+        if peer.public_key:
+            lines.append('PublicKey={}'.format(peer.public_key))
+        for allowed_ip in peer.allowed_ips:
+            lines.append('AllowedIPs={}'.format(allowed_ip))
+        if peer.endpoint:
+            lines.append('Endpoint={}'.format(peer.endpoint))
+        if peer.persistent_keepalive != 0:
+            lines.append('PersistentKeepalive={}'.format(peer.persistent_keepalive))
+        lines.append('')
+
+    write_file(os.path.join(node_dir, wg_name + '.netdev'), lines)
+
+    lines = header(network_name, node_name)
+    lines += ['[Match]', 'Name={}'.format(wg_name), '']
+    lines += ['[Network]']
+    for address in node.get('LinkLayerAddress', []):
+        lines.append('Address={}'.format(address))
+    for segment in segments:
+        lines.append('VXLAN={}'.format(segment.name or vxlan_name))
+    lines.append('')
+    write_file(os.path.join(node_dir, wg_name + '.network'), lines)
+
+    for segment in segments:
+        write_vxlan_units(network_name, network, node_name, node, peers, segment, segment.name or vxlan_name, node_dir)
+
+    # systemd-networkd has no setting for ICMP redirects, systemd-sysctl applies these when the devices appear
+    lines = header(network_name, node_name)
+    for segment in segments:
+        for key in ('net.ipv4.conf.{}.accept_redirects', 'net.ipv4.conf.{}.send_redirects', 'net.ipv6.conf.{}.accept_redirects'):
+            lines.append('{} = 0'.format(key.format(segment.name or vxlan_name)))
+    lines.append('')
+    os.makedirs(os.path.join(node_dir, 'sysctl.d'), exist_ok=True)
+    write_file(os.path.join(node_dir, 'sysctl.d', '60-{}.conf'.format(wg_name)), lines)
+
+
+def write_vxlan_units(network_name: str, network: common.Config.NetworkType, node_name: str, node: common.Config.NodeType, peers: List[api.Peer], segment: api.Segment, vxlan_name: str, node_dir: str) -> None:
+    wg_name = common.interface_name(network_name)
+
+    lines = header(network_name, node_name)
+    lines += ['[NetDev]', 'Name={}'.format(vxlan_name), 'Kind=vxlan', 'MTUBytes={}'.format(segment.mtu)]
+    mac_address: Optional[str] = common.generate_pubkey_macaddr(node)
+    if mac_address:
+        lines.append('MACAddress={}'.format(mac_address))
+    lines += ['']
+    lines += ['[VXLAN]', 'VNI={}'.format(segment.vxlan_id), 'DestinationPort={}'.format(network.get('VxlanPort', 4789)), 'TTL=1', 'UDPChecksum=no', '']
+    write_file(os.path.join(node_dir, vxlan_name + '.netdev'), lines)
+
+    lines = header(network_name, node_name)
+    lines += ['[Match]', 'OriginalName={}'.format(vxlan_name), '']
+    lines += ['[Link]', 'ReceiveChecksumOffload=no', 'TransmitChecksumOffload=no', '']
+    write_file(os.path.join(node_dir, vxlan_name + '.link'), lines)
+
+    lines = header(network_name, node_name)
+    lines += ['[Match]', 'Name={}'.format(vxlan_name), '']
+    lines += ['[Network]']
+    for address in segment.addresses:
+        lines.append('Address={}'.format(address))
+    lines.append('')
+
+    for peer in peers:
+        if peer.blacklisted or (segment.name is not None and segment.name not in peer.segments):
+            continue
+        for address in peer.link_layer_addresses:
+            lines += ['# Peer node {}'.format(peer.name), '[BridgeFDB]', 'MACAddress=00:00:00:00:00:00', 'Destination={}'.format(address), 'OutgoingInterface={}'.format(wg_name), '']
+
+    write_file(os.path.join(node_dir, vxlan_name + '.network'), lines)
+
+
+def header(network_name: str, node_name: str) -> List[str]:
+    return ['# Network {}, node {}, generated by VxWireguard-Generator'.format(network_name, node_name), '']
+
+
+def write_file(file_name: str, lines: List[str], mode: int = 0o644) -> None:
+    fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    os.fchmod(fd, mode)
+    with open(fd, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
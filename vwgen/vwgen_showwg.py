@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import sys
+from typing import Dict, Iterable, List, NamedTuple, Optional
+from . import api
+from . import common
+
+
+class WgPeer(NamedTuple):
+    public_key: str
+    endpoint: Optional[str]
+    allowed_ips: List[str]
+    latest_handshake: int
+    persistent_keepalive: int
+
+
+class WgInterface(NamedTuple):
+    name: str
+    public_key: str
+    listen_port: int
+    fwmark: int
+    peers: Dict[str, WgPeer]
+
+
+def main(argv: List[str]) -> int:
+    args = argv[2:]
+    setup_file: Optional[str] = None
+    dump_file: Optional[str] = None
+    while len(args) >= 2 and args[0] in ('--setup', '--compare'):
+        if args[0] == '--setup':
+            setup_file = args[1]
+        else:
+            dump_file = args[1]
+        args = args[2:]
+
+    if len(args) != 2 or args[0] == '--help':
+        print_usage()
+        return 0
+
+    network_name, node_name = args[0], args[1]
+
+    live: Optional[List[WgInterface]] = None
+    if dump_file is not None:
+        try:
+            if dump_file == '-':
+                live = parse_wg_dump(sys.stdin)
+            else:
+                with open(dump_file, 'r') as f:
+                    live = parse_wg_dump(f)
+        except FileNotFoundError:
+            print("vwgen: Unable to find file '{}'".format(dump_file), file=sys.stderr)
+            return errno.ENOENT
+
+    config = common.Config()
+
+    if not config.load(network_name):
+        print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+        return errno.ENOENT
+
+    network = config.network()
+    nodes = config.nodes()
+    blacklist = config.blacklist()
+
+    if node_name not in nodes:
+        print("vwgen: Network '{}' does not have node '{}'".format(network_name, node_name), file=sys.stderr)
+        return errno.ENOENT
+
+    if setup_file is not None:
+        with open(setup_file, 'w') as f:
+            f.write(render_setup_script(config.network_name(), network, nodes, blacklist, node_name))
+
+    if live is None:
+        print(render_wg_conf(config.network_name(), nodes, blacklist, node_name), end='')
+    else:
+        interface = common.interface_name(config.network_name())
+        # wg show <interface> dump does not name the interface
+        sections = [i for i in live if i.name == interface] or [i for i in live if i.name == '']
+        if not sections:
+            print("vwgen: Interface '{}' not found in '{}'".format(interface, dump_file), file=sys.stderr)
+            return errno.ENOENT
+        if len(sections) > 1:
+            print("vwgen: '{}' has {} dumps of interface '{}', expected the one of node '{}'".format(dump_file, len(sections), interface, node_name), file=sys.stderr)
+            return errno.EINVAL
+        print(render_sync_script(config.network_name(), nodes, blacklist, node_name, sections[0]), end='')
+
+    config.close()
+    return 0
+
+
+def print_usage() -> None:
+    print('Usage: vwgen showwg [--setup <file>] [--compare <dump file>] <network> <node>')
+    print()
+    print("Generates a configuration for 'wg setconf' or 'wg syncconf', without the keys")
+    print('only understood by wg-quick. --setup writes a shell script that creates the')
+    print('interfaces, addresses and forwarding entries and loads the configuration from')
+    print('/etc/wireguard/<network>.conf.')
+    print()
+    print("--compare reads the output of 'wg show all dump' from the node, or '-' for")
+    print("stdin, and prints the 'wg set' commands that bring it in line with the network.")
+
+
+def render_wg_conf(network_name: str, nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_name: str) -> str:
+    node = nodes[node_name]
+    lines = ['# Network {}, node {}, generated by VxWireguard-Generator'.format(network_name, node_name), '', '[Interface]']
+
+    if 'PrivateKey' in node:
+        lines.append('PrivateKey = {}'.format(node['PrivateKey']))
+    lines.append('ListenPort = {:d}'.format(node.get('ListenPort', 0)))
+    if node.get('FwMark', 0) != 0:
+        lines.append('FwMark = 0x{:x}'.format(node['FwMark']))
+    lines.append('')
+
+    for peer in api.generate_peers(nodes, blacklist, node_name):
+        if peer.blacklisted or not peer.public_key:
+            continue
+        lines += ['# Peer node {}'.format(peer.name), '[Peer]', 'PublicKey = {}'.format(peer.public_key)]
+        if peer.allowed_ips:
+            lines.append('AllowedIPs = {}'.format(', '.join(peer.allowed_ips)))
+        if peer.endpoint:
+            lines.append('Endpoint = {}'.format(peer.endpoint))
+        if peer.persistent_keepalive != 0:
+            lines.append('PersistentKeepalive = {}'.format(peer.persistent_keepalive))
+        lines.append('')
+
+    return ''.join(i + '\n' for i in lines)
+
+
+def render_setup_script(network_name: str, network: common.Config.NetworkType, nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_name: str) -> str:
+    node = nodes[node_name]
+    interface = common.interface_name(network_name)
+    lines = ['#!/bin/sh', '# Network {}, node {}, generated by VxWireguard-Generator'.format(network_name, node_name)]
+
+    for script in node.get('PreUp', []):
+        lines.append(script.replace('%i', interface))
+
+    lines.append('ip link add {} type wireguard || true'.format(interface))
+    lines.append('wg setconf {0} /etc/wireguard/{0}.conf'.format(interface))
+    for address in node.get('LinkLayerAddress', []):
+        lines.append('ip address add {} dev {} || true'.format(address, interface))
+    segments = api.generate_segments(network, nodes, blacklist, node_name, common.vtep_addresses(network, node))
+    lines.append('ip link set {} mtu {} up'.format(interface, api.wireguard_mtu(segments)))
+
+    peers = api.generate_peers(nodes, blacklist, node_name)
+
+    for segment in segments:
+        device = segment.name or common.vxlan_device_name(interface)
+        setup = common.vxlan_setup(network, node, device, segment.vxlan_id, segment.mtu, segment.addresses)
+        lines.append('ip {} || true'.format(setup.link))
+        lines += setup.tuning
+        for command in setup.addresses:
+            lines.append('ip {} || true'.format(command))
+        for peer in peers:
+            if peer.blacklisted or (segment.name is not None and segment.name not in peer.segments):
+                continue
+            for address in peer.link_layer_addresses:
+                lines.append('bridge fdb append 00:00:00:00:00:00 dev {} dst {} via {}'.format(device, address, interface))
+        lines.append('ip link set {} up'.format(device))
+
+    if node.get('UPnP', False) and node.get('ListenPort', 0) != 0:
+        lines.append('upnpc -r {} udp &'.format(node['ListenPort']))
+
+    for script in node.get('PostUp', []):
+        lines.append(script.replace('%i', interface))
+
+    return ''.join(i + '\n' for i in lines)
+
+
+def render_sync_script(network_name: str, nodes: common.Config.NodesType, blacklist: common.Config.BlacklistType, node_name: str, live: WgInterface) -> str:
+    node = nodes[node_name]
+    interface = common.interface_name(network_name)
+    lines = ['#!/bin/sh', '# Network {}, node {}, changes to the running interface, generated by VxWireguard-Generator'.format(network_name, node_name)]
+
+    if common.generate_pubkey(node) not in (None, live.public_key):
+        lines += api.private_key_commands(interface, node['PrivateKey'])
+    if node.get('ListenPort', 0) not in (0, live.listen_port):
+        lines.append('wg set {} listen-port {:d}'.format(interface, node['ListenPort']))
+    if node.get('FwMark', 0) != live.fwmark:
+        lines.append('wg set {} fwmark {}'.format(interface, '0x{:x}'.format(node['FwMark']) if node.get('FwMark', 0) != 0 else 'off'))
+
+    peers = {peer.public_key: peer for peer in api.generate_peers(nodes, blacklist, node_name) if not peer.blacklisted and peer.public_key}
+
+    for public_key in live.peers:
+        if public_key not in peers:
+            lines.append('wg set {} peer {} remove'.format(interface, public_key))
+
+    for public_key, peer in peers.items():
+        live_peer = live.peers.get(public_key)
+        arguments: List[str] = []
+        if live_peer is None or sorted(live_peer.allowed_ips) != sorted(peer.allowed_ips):
+            arguments.append('allowed-ips "{}"'.format(','.join(peer.allowed_ips)))
+        # A roamed endpoint is only replaced when the peer has not been heard from
+        if peer.endpoint and (live_peer is None or (live_peer.endpoint != peer.endpoint and live_peer.latest_handshake == 0)):
+            arguments.append('endpoint {}'.format(peer.endpoint))
+        if live_peer is None or live_peer.persistent_keepalive != peer.persistent_keepalive:
+            arguments.append('persistent-keepalive {}'.format(peer.persistent_keepalive or 'off'))
+        if arguments:
+            lines.append('# Peer node {} {}'.format(peer.name, 'missing' if live_peer is None else 'differs'))
+            lines.append('wg set {} peer {} {}'.format(interface, public_key, ' '.join(arguments)))
+
+    return ''.join(i + '\n' for i in lines)
+
+
+# Reads 'wg show all dump', or 'wg show <interface> dump' under the name ''
+# Returns one entry per interface line, so that the dumps of several nodes can
+# be concatenated even though they use the same interface name
+def parse_wg_dump(f: Iterable[str]) -> List[WgInterface]:
+    interfaces: List[WgInterface] = []
+    for line in f:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) in (4, 8):
+            fields = [''] + fields
+        if len(fields) == 5:
+            interface_name, _, public_key, listen_port, fwmark = fields
+            interfaces.append(WgInterface(interface_name, public_key, int(listen_port), 0 if fwmark == 'off' else int(fwmark, base=16), {}))
+        elif len(fields) == 9 and interfaces and interfaces[-1].name == fields[0]:
+            interface_name, public_key, _, endpoint, allowed_ips, latest_handshake, _, _, persistent_keepalive = fields
+            interfaces[-1].peers[public_key] = WgPeer(
+                public_key=public_key,
+                endpoint=None if endpoint == '(none)' else endpoint,
+                allowed_ips=[] if allowed_ips == '(none)' else allowed_ips.split(','),
+                latest_handshake=int(latest_handshake),
+                persistent_keepalive=0 if persistent_keepalive == 'off' else int(persistent_keepalive),
+            )
+    return interfaces
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
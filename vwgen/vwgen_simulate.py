@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import difflib
+import errno
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Callable, Dict, List, NamedTuple, Tuple
+from . import common
+
+# Rough costs on a typical server, used to estimate bring-up time
+FORK_COST = 0.002
+NETLINK_COST = 0.00005
+
+# Separators of the fields and records the stubs log
+FIELD_SEPARATOR = '\x1f'
+RECORD_SEPARATOR = '\x1e'
+
+# Commands wg-quick hooks usually call, replaced by stubs that only log their
+# arguments; the stubs are the only programs on PATH while the hooks run
+# Each one returns the number of netlink or sysctl operations the command performs
+STUBS: Dict[str, Callable[[List[str], str, int], int]] = {
+    'bridge': lambda argv, conf_file, peers: batch_operations(argv, conf_file),
+    'ethtool': lambda argv, conf_file, peers: 1,
+    'ip': lambda argv, conf_file, peers: batch_operations(argv, conf_file),
+    'sysctl': lambda argv, conf_file, peers: max(1, len([i for i in argv[1:] if '=' in i])),
+    'upnpc': lambda argv, conf_file, peers: 0,
+    'wg': lambda argv, conf_file, peers: 1 + peers if argv[1:2] == ['setconf'] else 1,
+}
+
+
+class Command(NamedTuple):
+    hook: str
+    argv: List[str]
+    forks: int
+    operations: int
+
+
+class Simulation(NamedTuple):
+    interface: str
+    peers: int
+    commands: List[Command]
+
+
+def main(argv: List[str]) -> int:
+    args = argv[2:]
+    verbose = False
+    diff = False
+    while args and args[0] in ('--verbose', '--diff'):
+        verbose = verbose or args[0] == '--verbose'
+        diff = diff or args[0] == '--diff'
+        args = args[1:]
+
+    if len(args) < 1 or args[0] == '--help' or (diff and len(args) != 2):
+        print_usage()
+        return 0
+
+    if shutil.which('bash') is None:
+        print('vwgen: Unable to find bash, which wg-quick runs the hooks with', file=sys.stderr)
+        return errno.ENOENT
+
+    simulations: List[Simulation] = []
+    for file_name in args:
+        try:
+            simulations.append(simulate(file_name))
+        except FileNotFoundError:
+            print("vwgen: Unable to find configuration file '{}'".format(file_name), file=sys.stderr)
+            return errno.ENOENT
+
+    if diff:
+        print_diff(args[0], simulations[0], args[1], simulations[1])
+        return 0
+
+    for file_name, simulation in zip(args, simulations):
+        print_report(file_name, simulation, verbose)
+
+    if len(simulations) > 1:
+        print_report('total', Simulation('', sum((i.peers for i in simulations)), [j for i in simulations for j in i.commands]), False)
+
+    return 0
+
+
+def print_usage() -> None:
+    print('Usage: vwgen simulate [--verbose] <config file> [<config file> ...]')
+    print('       vwgen simulate --diff <old config file> <new config file>')
+    print()
+    print('Runs the hooks of configuration files generated by showconf in bash, the way')
+    print('wg-quick would to bring the interface up, with stubs in place of ip, wg,')
+    print('bridge, ethtool, sysctl and upnpc, and reports the commands they ran. Only')
+    print('the stubs are on PATH, other commands are logged instead of run, but commands')
+    print('given with an absolute path do run, so only simulate files you trust.')
+
+
+def simulate(file_name: str) -> Simulation:
+    interface = conf_stem(file_name)
+
+    hooks: Dict[str, List[str]] = collections.defaultdict(list)
+    addresses: List[str] = []
+    peers = 0
+    mtu = ''
+    section = ''
+
+    with open(file_name, 'r') as f:
+        for line in f:
+            line = line.strip()
+            # wg-quick names the interface after the file, showconf after the network
+            match = re.match(r'# Network ([^,]*), generated by VxWireguard-Generator$', line)
+            if match:
+                interface = common.interface_name(match.group(1))
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('['):
+                section = line
+                if section == '[Peer]':
+                    peers += 1
+                continue
+            if section != '[Interface]' or '=' not in line:
+                continue
+            key, value = (i.strip() for i in line.split('=', 1))
+            if key in ('PreUp', 'PostUp', 'PreDown', 'PostDown'):
+                hooks[key].append(value)
+            elif key == 'Address':
+                addresses.extend((i.strip() for i in value.split(',') if i.strip()))
+            elif key == 'MTU':
+                mtu = value
+
+    # The steps of wg-quick up, each hook is run like its execute_hooks does,
+    # except that commands started in the background are waited for to log them
+    script = [
+        'command_not_found_handle() {{ {{ printf "%s{}" "$VWGEN_HOOK" "$@"; printf "{}"; }} >> "$VWGEN_SIMULATE_LOG"; }}'.format(FIELD_SEPARATOR, RECORD_SEPARATOR),
+    ]
+    for hook in hooks['PreUp']:
+        script += ['export VWGEN_HOOK=PreUp', '(eval {}; wait)'.format(shlex.quote(hook.replace('%i', interface)))]
+    script.append('export VWGEN_HOOK=wg-quick')
+    script.append('ip link add {} type wireguard'.format(shlex.quote(interface)))
+    script.append('wg setconf {} /dev/fd/63'.format(shlex.quote(interface)))
+    for address in addresses:
+        script.append('ip address add {} dev {}'.format(shlex.quote(address), shlex.quote(interface)))
+    if mtu:
+        script.append('ip link set mtu {} up dev {}'.format(shlex.quote(mtu), shlex.quote(interface)))
+    else:
+        script.append('ip link set up dev {}'.format(shlex.quote(interface)))
+    for hook in hooks['PostUp']:
+        script += ['export VWGEN_HOOK=PostUp', '(eval {}; wait)'.format(shlex.quote(hook.replace('%i', interface)))]
+
+    with tempfile.TemporaryDirectory(prefix='vwgen-simulate-') as stub_dir:
+        log_file = os.path.join(stub_dir, 'log')
+        for program in STUBS:
+            write_stub(os.path.join(stub_dir, program), program)
+        subprocess.run([shutil.which('bash') or 'bash', '-c', '\n'.join(script)], env={'PATH': stub_dir, 'VWGEN_SIMULATE_LOG': log_file}, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=False)
+        try:
+            with open(log_file, 'r') as f:
+                log = f.read()
+        except FileNotFoundError:
+            log = ''
+
+    commands: List[Command] = []
+    for record in log.split(RECORD_SEPARATOR):
+        fields = record.split(FIELD_SEPARATOR)[:-1]
+        if len(fields) < 2:
+            continue
+        hook, argv = fields[0], fields[1:]
+        program = os.path.basename(argv[0])
+        commands.append(Command(hook, argv, 1, STUBS[program](argv, file_name, peers) if program in STUBS else 0))
+
+    return Simulation(interface, peers, commands)
+
+
+def write_stub(file_name: str, program: str) -> None:
+    with open(file_name, 'w') as f:
+        f.write('#!/bin/sh\n{{ printf "%s{}" "$VWGEN_HOOK" {} "$@"; printf "{}"; }} >> "$VWGEN_SIMULATE_LOG"\n'.format(FIELD_SEPARATOR, program, RECORD_SEPARATOR))
+    os.chmod(file_name, 0o755)
+
+
+def conf_stem(file_name: str) -> str:
+    stem = os.path.basename(file_name)
+    if stem.endswith('.conf'):
+        stem = stem[:-5]
+    return stem
+
+
+def batch_operations(argv: List[str], conf_file: str) -> int:
+    if '-batch' not in argv or argv.index('-batch') + 1 >= len(argv):
+        return 1
+    batch_file = argv[argv.index('-batch') + 1]
+    # showconf --batch <directory> writes <node>.ip.batch into that directory, which
+    # the Readme calls batch/ next to <node>.conf, or the directory of <node>.conf itself
+    conf_dir = os.path.dirname(conf_file)
+    batch_name = conf_stem(conf_file) + '.' + os.path.basename(batch_file).split('.', 1)[-1]
+    for candidate in (batch_file, os.path.join(conf_dir, 'batch', batch_name), os.path.join(conf_dir, batch_name)):
+        try:
+            with open(candidate, 'r') as f:
+                return sum((1 for line in f if line.strip() and not line.lstrip().startswith('#')))
+        except OSError:
+            continue
+    print("vwgen: Unable to find batch file '{}', counted as one operation".format(batch_file), file=sys.stderr)
+    return 1
+
+
+def summarize(simulation: Simulation) -> Tuple[int, int, float, Dict[str, int]]:
+    forks = sum((i.forks for i in simulation.commands))
+    operations = sum((i.operations for i in simulation.commands))
+    per_program: Dict[str, int] = common.SortedDict()
+    for command in simulation.commands:
+        program = os.path.basename(command.argv[0])
+        per_program[program] = per_program.get(program, 0) + 1
+    return forks, operations, forks * FORK_COST + operations * NETLINK_COST, per_program
+
+
+def print_report(file_name: str, simulation: Simulation, verbose: bool) -> None:
+    forks, operations, cost, per_program = summarize(simulation)
+
+    print('{}:'.format(file_name))
+    if simulation.interface:
+        print('  interface: {}'.format(simulation.interface))
+    print('  peers: {}'.format(simulation.peers))
+    print('  commands: {}'.format(len(simulation.commands)))
+    for program, count in per_program.items():
+        print('    {}: {}'.format(program, count))
+    print('  forks: {}'.format(forks))
+    print('  netlink operations: {}'.format(operations))
+    print('  estimated bring-up time: {:.1f} ms'.format(cost * 1000))
+
+    if verbose:
+        print('  sequence:')
+        for command in simulation.commands:
+            print('    [{}] {}'.format(command.hook, ' '.join((shlex.quote(i) for i in command.argv))))
+
+    print()
+
+
+def print_diff(old_file_name: str, old: Simulation, new_file_name: str, new: Simulation) -> None:
+    old_forks, old_operations, old_cost, old_per_program = summarize(old)
+    new_forks, new_operations, new_cost, new_per_program = summarize(new)
+
+    print('{} -> {}:'.format(old_file_name, new_file_name))
+    print('  peers: {} -> {} ({:+d})'.format(old.peers, new.peers, new.peers - old.peers))
+    print('  commands: {} -> {} ({:+d})'.format(len(old.commands), len(new.commands), len(new.commands) - len(old.commands)))
+    for program in sorted(set(old_per_program) | set(new_per_program)):
+        old_count, new_count = old_per_program.get(program, 0), new_per_program.get(program, 0)
+        print('    {}: {} -> {} ({:+d})'.format(program, old_count, new_count, new_count - old_count))
+    print('  forks: {} -> {} ({:+d})'.format(old_forks, new_forks, new_forks - old_forks))
+    print('  netlink operations: {} -> {} ({:+d})'.format(old_operations, new_operations, new_operations - old_operations))
+    print('  estimated bring-up time: {:.1f} ms -> {:.1f} ms ({:+.1f} ms)'.format(old_cost * 1000, new_cost * 1000, (new_cost - old_cost) * 1000))
+    print()
+
+    old_lines = ['[{}] {}'.format(i.hook, ' '.join((shlex.quote(j) for j in i.argv))) for i in old.commands]
+    new_lines = ['[{}] {}'.format(i.hook, ' '.join((shlex.quote(j) for j in i.argv))) for i in new.commands]
+    for line in difflib.unified_diff(old_lines, new_lines, old_file_name, new_file_name, lineterm=''):
+        print(line)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
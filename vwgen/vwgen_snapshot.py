@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import sys
+import time
+import toml
+from typing import Any, Dict, List, Optional
+from . import common
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) < 3 or argv[2] == '--help':
+        print_usage()
+        return 0
+
+    network_name = argv[2]
+    action = argv[3] if len(argv) > 3 else 'list'
+    config = common.Config()
+
+    if not config.load(network_name, writable=action == 'restore'):
+        print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+        return errno.ENOENT
+
+    store = config.snapshot_store()
+
+    if action == 'list' and len(argv) <= 4:
+        for snapshot in store.snapshots():
+            print('{:6d}  {}  {} nodes  {}'.format(snapshot.id, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot.time)), snapshot.node_count, snapshot.manifest[:12]))
+        config.close()
+        return 0
+
+    if action not in ('show', 'restore') or len(argv) != 5:
+        print_usage()
+        config.close()
+        return errno.EINVAL
+
+    snapshot = find_snapshot(store, argv[4])
+    if snapshot is None:
+        print("vwgen: Network '{}' does not have snapshot '{}'".format(config.network_name(), argv[4]), file=sys.stderr)
+        config.close()
+        return errno.ENOENT
+    conf = store.load(snapshot.manifest)
+
+    if action == 'show':
+        print(toml.dumps(conf), end='')
+        config.close()
+        return 0
+
+    network = config.network()
+    nodes = config.nodes()
+    blacklist = config.blacklist()
+    config.save()
+
+    # Only nodes that differ are replaced, so that journals and SQLite only
+    # record those
+    removed = [i for i in nodes if i not in conf['Node']]
+    for node_name in removed:
+        del nodes[node_name]
+    changed = 0
+    for node_name, node in conf['Node'].items():
+        if node_name not in nodes or without_none(nodes[node_name]) != without_none(node):
+            changed += 1
+            nodes[node_name] = node
+
+    if without_none(network) != without_none(conf['Network']):
+        network.clear()
+        network.update(conf['Network'])
+
+    old_pairs = set(blacklist)
+    new_pairs = set(conf['PeerBlacklist']['Blacklist'])
+    for pair in old_pairs - new_pairs:
+        blacklist.remove(pair)
+    for pair in new_pairs - old_pairs:
+        blacklist.add(pair)
+
+    config.save()
+    config.close()
+    print('Restored snapshot {}: {} nodes replaced, {} removed'.format(snapshot.id, changed, len(removed)))
+    return 0
+
+
+def print_usage() -> None:
+    print('Usage: vwgen snapshot <network> [list]')
+    print('       vwgen snapshot <network> show <snapshot>')
+    print('       vwgen snapshot <network> restore <snapshot>')
+    print()
+    print("With 'vwgen set <network> snapshots on', every save that changes the network is")
+    print('kept in <network>.snapshots, storing only the parts that changed. A snapshot is')
+    print("given by its number from 'list', or a negative number counting back from the")
+    print('latest one.')
+
+
+# Snapshots drop None values, as TOML does, while SQLite keeps them as null
+def without_none(values: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in values.items() if value is not None}
+
+
+def find_snapshot(store: common.SnapshotStore, snapshot_id: str) -> Optional[common.Snapshot]:
+    try:
+        number = int(snapshot_id)
+    except ValueError:
+        return None
+    snapshots = store.snapshots()
+    if number < 0:
+        return snapshots[number] if -number <= len(snapshots) else None
+    for snapshot in snapshots:
+        if snapshot.id == number:
+            return snapshot
+    return None
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# Copyright (c) 2018 Star Brilliant
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import sys
+from typing import List
+from . import common
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) < 3 or argv[2] == '--help':
+        print_usage()
+        return 0
+
+    network_name = argv[2]
+    config = common.Config()
+
+    if not config.load(network_name):
+        print("vwgen: Unable to find configuration file '{}.conf'".format(network_name), file=sys.stderr)
+        return errno.ENOENT
+
+    warnings: List[str] = []
+    errors = config.validate(warnings)
+    config.close()
+
+    for warning in warnings:
+        print('{}: warning: {}'.format(network_name, warning))
+
+    for error in errors:
+        print('{}: {}'.format(network_name, error))
+
+    if errors:
+        print('vwgen: Found {} error{} in network \'{}\''.format(len(errors), '' if len(errors) == 1 else 's', network_name), file=sys.stderr)
+        return errno.EINVAL
+    return 0
+
+
+def print_usage() -> None:
+    print('Usage: vwgen validate <network>')
+    print()
+    print('Checks the configuration for unknown fields, invalid keys, ports and addresses,')
+    print('and values that must be unique but are used by several nodes. All errors are')
+    print('reported at once. Addresses outside of the address pools are warnings, they')
+    print('are expected for a while after a pool has changed.')
+    print()
+    print('Commands that change the network run the same checks before saving, and do')
+    print('not save if they would introduce a new error. An error that was already there')
+    print('is not new when only its details change, like the node an address collides with.')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -22,25 +22,33 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import encodings.idna
 import errno
-import ipaddress
+import os
+import re
 import sys
 import time
 from typing import Any, Dict, List, Optional
+from . import api
 from . import common
 
 
 def main(argv: List[str]) -> int:
-    if len(argv) < 4 or len(argv) % 2 != 0 or argv[2] == '--help':
+    args = argv[2:]
+    reverse_dir: Optional[str] = None
+    if len(args) >= 2 and args[0] == '--reverse-dir':
+        reverse_dir = args[1]
+        args = args[2:]
+
+    if len(args) < 2 or len(args) % 2 != 0 or args[0] == '--help':
         print_usage()
         return 0
 
     print(';; Generated by VxWireguard-Generator')
 
     return_value = 0
+    reverse_zones: Dict[str, api.ReverseZone] = {}
 
-    for network_name, domain_suffix in zip(argv[2::2], argv[3::2]):
+    for network_name, domain_suffix in zip(args[0::2], args[1::2]):
         config = common.Config()
 
         if not config.load(network_name):
@@ -49,87 +57,59 @@ def main(argv: List[str]) -> int:
             continue
 
         network_name = config.network_name()
-        domain_suffix = encodings.idna.ToASCII(''.join((c for c in domain_suffix.strip('.') + '.' if ord(c) > 32))).decode('ascii').lstrip('.')
+        domain_suffix = api.normalize_domain_suffix(domain_suffix)
 
         network: Dict[str, Any] = config.network()
         nodes: Dict[str, dict] = config.nodes()
 
-        print()
-        print(';; Network {}'.format(network_name))
-        print('$ORIGIN                         {}'.format(domain_suffix))
-        print('$TTL                            300')
-
-        A_records: List[str] = []
-        AAAA_records: List[str] = []
-        PTR_IP_records: List[str] = []
-        PTR_IP6_records: List[str] = []
-
-        for node_name, node in nodes.items():
-            safe_node_name = encodings.idna.ToASCII(''.join((c for c in node_name if ord(c) > 32))).decode('ascii')
-
-            addresses: List[str] = node.get('Address', [])
-
-            pubkey_ipv6: Optional[str] = common.generate_pubkey_ipv6(network, node)
-            if pubkey_ipv6:
-                addresses.append(pubkey_ipv6)
-
-            for address in addresses:
-                address = address.split('/', 1)[0]
-                ip: Optional[ipaddress._BaseAddress] = None
-
-                try:
-                    ip = ipaddress.IPv4Address(address)
-                except ipaddress.AddressValueError:
-                    ip = None
-
-                if ip is None:
-                    try:
-                        ip = ipaddress.IPv6Address(address)
-                    except ipaddress.AddressValueError:
-                        pass
-
-                if ip is None:
-                    print("vwgen: Invalid IP address '{}'".format(address), file=sys.stderr)
-                    return_value = return_value or errno.EADDRNOTAVAIL
-                    continue
-
-                if isinstance(ip, ipaddress.IPv4Address):
-
-                    A_records.append('{}300     IN      A       {}'.format(pad_to_tab(safe_node_name + '.' + domain_suffix, 32), ip.compressed))
-
-                    PTR_IP_records.append('{}300     IN      PTR     {}.{}'.format(pad_to_tab(ip.reverse_pointer + '.', 32), safe_node_name, domain_suffix))
-
-                elif isinstance(ip, ipaddress.IPv6Address):
-
-                    AAAA_records.append('{}300     IN      AAAA    {}'.format(pad_to_tab(safe_node_name + '.' + domain_suffix, 32), ip.compressed))
-
-                    PTR_IP6_records.append('{}300     IN      PTR     {}.{}'.format(pad_to_tab(ip.reverse_pointer + '.', 80), safe_node_name, domain_suffix))
-
-        print('{}300     IN      SOA     ns1.{} hostmaster.{} {:.0f} 86400 7200 604800 300'.format(pad_to_tab(domain_suffix, 32), domain_suffix, domain_suffix, time.time()))
-
-        for line in A_records:
-            print(line)
-
-        for line in AAAA_records:
-            print(line)
-
-        for line in PTR_IP_records:
-            print(line)
-
-        for line in PTR_IP6_records:
-            print(line)
+        zone, error = api.render_zone(network_name, network, nodes, domain_suffix, reverse_zones if reverse_dir is not None else None)
+        return_value = return_value or error
+        print(zone, end='')
 
         config.close()
 
+    if reverse_dir is not None:
+        for zone_name, zone in sorted(reverse_zones.items()):
+            write_reverse_zone(os.path.join(reverse_dir, zone_name + 'zone'), zone_name, zone)
+
     return return_value
 
 
 def print_usage() -> None:
-    print('Usage: vwgen zone <network> <domain suffix> [<network> <domain suffix> ...]')
-
-
-def pad_to_tab(s: str, min_width: int) -> str:
-    return s.ljust(max(len(s), min_width - 1) // 8 * 8 + 8)
+    print('Usage: vwgen zone [--reverse-dir <directory>] <network> <domain suffix> [<network> <domain suffix> ...]')
+    print()
+    print('With --reverse-dir, PTR records are written to one reverse zone file per')
+    print('address pool prefix in that directory instead of the forward zone.')
+
+
+def write_reverse_zone(file_name: str, zone_name: str, zone: api.ReverseZone) -> bool:
+    def render(serial: int) -> str:
+        lines = [
+            ';; Generated by VxWireguard-Generator',
+            '$ORIGIN                         {}'.format(zone_name),
+            '$TTL                            300',
+            '{}300     IN      SOA     ns1.{} hostmaster.{} {} 86400 7200 604800 300'.format(api.pad_to_tab(zone_name, 32), zone.domain_suffix, zone.domain_suffix, serial),
+        ]
+        lines.extend((api.format_record(record) for record in zone.records))
+        return '\n'.join(lines) + '\n'
+
+    old_serial = 0
+    try:
+        with open(file_name, 'r') as f:
+            old_content = f.read()
+        match = re.search(r'\sIN\s+SOA\s+\S+\s+\S+\s+(\d+)\s', old_content)
+        if match:
+            old_serial = int(match.group(1))
+            if render(old_serial) == old_content:
+                return False
+    except FileNotFoundError:
+        pass
+
+    # Each zone keeps its own serial, which must increase on every change
+    with open(file_name + '.tmp', 'w') as f:
+        f.write(render(max(old_serial + 1, int(time.time()))))
+    os.replace(file_name + '.tmp', file_name)
+    return True
 
 
 if __name__ == '__main__':